@@ -76,17 +76,14 @@ class Badger:
         """
         fc = self.client
         result = fc.createDirectory(dir)
-        if result['OK']:
-            if result['Value']['Successful']:
-                if result['Value']['Successful'].has_key(dir):
-                    return S_OK() 
-                elif result['Value']['Failed']:
-                    if result['Value']['Failed'].has_key(dir):
-                        print 'Failed to create directory %s:%s'%(dir,result['Value']['Failed'][dir])
-                        return S_ERROR() 
-        else:
+        if not result['OK']:
             print 'Failed to create directory %s:%s'%(dir,result['Message'])
-            return S_ERROR() 
+            return S_ERROR(result['Message'])
+        if result['Value']['Failed'].has_key(dir):
+            print 'Failed to create directory %s:%s'%(dir,result['Value']['Failed'][dir])
+            return S_ERROR(result['Value']['Failed'][dir])
+        return S_OK()
+
     def __registerFileMetadata(self,lfn,attributes):
         """Internal function to set metadata values on a given lfn. 
           Returns True for success, False for failure.
@@ -127,41 +124,37 @@ class Badger:
         fc = self.client
         dir_exists = 0
         result = fc.listDirectory(parentDir)
-        if result['OK']:
+        if result['OK'] and result['Value']['Successful'].has_key(parentDir):
             for i,v in enumerate(result['Value']['Successful'][parentDir]['SubDirs']):
                 if v == dir: 
                     dir_exists = 1
                     break
-        else:
+        elif not result['OK']:
             print 'Failed to list subdirectories of %s:%s'%(parentDir,result['Message'])
         
         return dir_exists
 
-    def __registerSubDirs(self,dirs_dict,dirs_meta):
-        """Internal function to create directories in dirs_dict
-           Returns True for sucess, False for failure
+    def __registerDirsOneByOne(self,lastDir,dirMetaDict,rootDir):
+        """Internal function to create the missing directories down to lastDir
+           one by one, for the catalogs without makeDirectoryTree.
+           Returns True for success, False for failure
         """
-        creation_ok = True
-        
-        for dir in dirs_dict:
-            if (dir != 'dir_file')&(dir !='dir_data_mc' ):
-                if self.__registerDir(dirs_meta[dir][0])['OK']:
-                    result = self.__registerDirMetadata(dirs_meta[dir][0],{dir.split('_')[1]:dirs_meta[dir][1]})
-                    if not result['OK']:
-                        creation_ok = False
-                        break
-                else:
-                    print 'Failed to create %s'%dir
-                    creation_ok = False
-                    break
-            else:
-                if not self.__registerDir(dirs_meta[dir])['OK']:
-                    print 'Failed to create %s'%dir
-                    creation_ok = False
-                    break
+        dirs = []
+        dir = lastDir
+        while dir != rootDir and dir != '/':
+            dirs.insert(0,dir)
+            dir = os.path.dirname(dir)
+        for dir in dirs:
+            if not self.__dirExists(dir,os.path.dirname(dir)):
+                if not self.__registerDir(dir)['OK']:
+                    return False
+            elif dir != lastDir:
+                continue
+            if dirMetaDict.has_key(dir):
+                if not self.__registerDirMetadata(dir,dirMetaDict[dir])['OK']:
+                    return False
+        return True
 
-        return creation_ok
-            
     def registerHierarchicalDir(self,metaDict,rootDir='/bes'):
         """
            Create a hierarchical directory according the metadata dictionary
@@ -178,14 +171,6 @@ class Badger:
            >>>badger.registerHierarchicalDir(metaDic)
            1
         """
-        #Save about 20 lines compared with last one
-        fc = self.client
-        
-        dir_exists = 0
-        #0 for failure,1 for success,2 for existing directory
-        creation_OK = 0
-        lastDirMetaDict = {'dataType':metaDict['dataType'],'streamId':metaDict['streamId']}
-
         dir_file = rootDir + '/File'
         dir_resonance = dir_file + '/' + metaDict['resonance']
         dir_bossVer = dir_resonance + '/' + metaDict['bossVer']
@@ -198,77 +183,31 @@ class Badger:
         dir_round = dir_eventType + '/' + metaDict['round']
         dir_streamId = dir_round + '/' + metaDict['streamId']
 
-        # if dir_round has been created,create_round=1 
-        create_round = 0
-
-        dirs_dict = ['dir_file','dir_resonance','dir_bossVer','dir_data_mc','dir_eventType','dir_round']
-        dirs_meta = {'dir_file':dir_file,'dir_data_mc':dir_data_mc,'dir_resonance':[dir_resonance,metaDict['resonance']],'dir_bossVer':[dir_bossVer,metaDict['bossVer']],'dir_eventType':[dir_eventType,metaDict['eventType']],'dir_round':[dir_round,metaDict['round']]}
-
-        dir_exists = self.__dirExists(dir_file,rootDir)
-        if not dir_exists:
-            result = self.__registerSubDirs(dirs_dict,dirs_meta)
-            if result:
-                create_round = 1
+        lastDirMetaDict = {'dataType':metaDict['dataType'],'streamId':metaDict['streamId']}
+        dirMetaDict = {dir_resonance:{'resonance':metaDict['resonance']},
+                       dir_bossVer:{'bossVer':metaDict['bossVer']},
+                       dir_eventType:{'eventType':metaDict['eventType']},
+                       dir_round:{'round':metaDict['round']}}
+        if metaDict['streamId'] == 'stream0':
+            lastDir = dir_round
+            dirMetaDict[dir_round].update(lastDirMetaDict)
         else:
-            dir_exists = self.__dirExists(dir_resonance,dir_file)
-            if not dir_exists:
-                dirs_dict = dirs_dict[1:]
-                result = self.__registerSubDirs(dirs_dict,dirs_meta)
-                if result:
-                    create_round = 1
-            else:
-                dir_exists = self.__dirExists(dir_bossVer,dir_resonance)
-                if not dir_exists:
-                    dirs_dict = dirs_dict[2:]
-                    result = self.__registerSubDirs(dirs_dict,dirs_meta)
-                    if result:
-                        create_round = 1
-                else:
-                    dir_exists = self.__dirExists(dir_data_mc,dir_bossVer)
-                    if not dir_exists:
-                        dirs_dict = dirs_dict[3:]
-                        result = self.__registerSubDirs(dirs_dict,dirs_meta)
-                        if result:
-                            create_round = 1
-                    else:
-                        dir_exists = self.__dirExists(dir_eventType,dir_data_mc)
-                        if not dir_exists:
-                            dirs_dict = dirs_dict[4:]
-                            result = self.__registerSubDirs(dirs_dict,dirs_meta)
-                            if result:
-                                create_round = 1
-                        else:
-                            dir_exists = self.__dirExists(dir_round,dir_eventType)
-                            if not dir_exists:
-                                dirs_dict = dirs_dict[5:]
-                                result = self.__registerSubDirs(dirs_dict,dirs_meta)
-                                if result:
-                                    create_round = 1
-                            else:
-                                create_round = 1
-        
-        if create_round:
-            if metaDict['streamId'] != "stream0":
-                dir_exists = self.__dirExists(dir_streamId,dir_round)
-                if not dir_exists:
-                    if self.__registerDir(dir_streamId)['OK']:
-                        result = self.__registerDirMetadata(dir_streamId,{'streamId':metaDict['streamId']})
-                        if result['OK']:
-                            result = self.__registerDirMetadata(dir_streamId,lastDirMetaDict)
-                            if result['OK']:
-                                creation_OK = 1
-                else:
-                    creation_OK = 2
-            else:
-                result = self.__registerDirMetadata(dir_round,lastDirMetaDict)
-                if result['OK']:
-                    creation_OK = 1
-    
-        if (creation_OK==1)|(creation_OK==2):
-            if metaDict['streamId'] == "stream0":
-                return dir_round
-            else:   
-                return dir_streamId
+            lastDir = dir_streamId
+            dirMetaDict[dir_streamId] = lastDirMetaDict
+
+        # The missing directories and their metadata are created in one call
+        result = self.besclient.makeDirectoryTree([lastDir],dirMetaDict)
+        if not result['OK']:
+            # Directory trees without bulk creation, e.g. DirectorySimpleTree
+            print 'Bulk creation of %s failed, creating the directories one by one: %s'%(lastDir,result['Message'])
+            if not self.__registerDirsOneByOne(lastDir,dirMetaDict,rootDir):
+                return None
+            return lastDir
+        if result['Value']['Failed']:
+            for dir,error in result['Value']['Failed'].items():
+                print 'Failed to create %s: %s'%(dir,error)
+            return None
+        return lastDir
     def removeDir(self,dir):
         """remove the dir include files and subdirs
         """
@@ -305,6 +244,22 @@ class Badger:
         else:
             print 'Error:%s'%(result['Message'])
             return S_ERROR(result['Message'])
+
+    def registerFileMetadataBulk(self,lfnMetaDict):
+        """Add file level metadata to many entries with a single call
+           Returns S_OK with the Successful and Failed dictionaries
+           Example:
+           >>>entries = {'/bes/File/.../run_0011414_All_file001_SFO-1':{'runL':11414,'runH':11414},
+           ...           '/bes/File/.../run_0011415_All_file001_SFO-1':{'runL':11415,'runH':11415}}
+           >>>badger.registerFileMetadataBulk(entries)
+        """
+        result = self.besclient.setFileMetadataBulk(lfnMetaDict)
+        if not result['OK']:
+            print 'Error:%s'%(result['Message'])
+            return S_ERROR(result['Message'])
+        for lfn,error in result['Value']['Failed'].items():
+            print 'Failed to set metadata for %s: %s'%(lfn,error)
+        return result
     #################################################################################
     # meta fields operations
     #
@@ -454,8 +409,13 @@ class Badger:
            Example usage:
            >>> badger.getFilesByDatasetName('psipp_661_data_all_exp2')
            ['/bes/File/psipp/6.6.1/data/all/exp2/file1', .....]
+           The frozen file list is used if the dataset has a snapshot
         """
 
+        result = self.besclient.getDatasetSnapshot(dataset_name, True)
+        if result['OK']:
+            return result['Value']['LFNs']
+
         fc = self.client
         #sfc = self.besclient
         result = fc.getMetadataSet(dataset_name, True)
@@ -469,6 +429,20 @@ class Badger:
         else:
             print "ERROR: Dataset", dataset_name," not found"
             return S_ERROR(result)
+
+    def freezeDataset(self, dataset_name, refresh=False):
+        """Take a snapshot of the current file list of the dataset, later
+           getFilesByDatasetName calls return the frozen list.
+           With refresh=True add the files registered since the last snapshot.
+
+           Example usage:
+           >>> badger.freezeDataset('psipp_661_data_all_exp2')
+           {'OK': True, 'Value': {'NFiles': 1200, 'NewFiles': 1200, 'TotalSize': ..., 'EventSum': ...}}
+        """
+        result = self.besclient.createDatasetSnapshot(dataset_name, refresh)
+        if not result['OK']:
+            print 'Error:%s'%(result['Message'])
+        return result
             
     def getFilesByMetadataQuery(self, query):
         """Return a list of LFNs satisfying given query conditions.
@@ -0,0 +1,184 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog in-memory caches. LRUCache is bounded by the memory size
+    of its entries, QueryResultCache keeps compressed results of the metadata
+    queries valid for a given catalog generation
+"""
+
+__RCSID__ = "$Id$"
+
+import types, threading, zlib, cPickle
+
+class LRUCache:
+  """ Least recently used cache bounded by the total size of its entries
+  """
+
+  def __init__( self, maxSize ):
+    self.maxSize = maxSize
+    self.size = 0
+    self.entries = {}
+    self.tick = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__( self ):
+    return len( self.entries )
+
+  def get( self, key ):
+    """ Get the cached value or None
+    """
+    self.lock.acquire()
+    try:
+      if not key in self.entries:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.tick += 1
+      entry = self.entries[key]
+      entry[1] = self.tick
+      return entry[2]
+    finally:
+      self.lock.release()
+
+  def put( self, key, value, size ):
+    """ Add a value of the given size to the cache evicting the least recently
+        used entries if necessary. Values bigger than the cache are not kept
+    """
+    self.lock.acquire()
+    try:
+      self.__remove( key )
+      if size > self.maxSize:
+        return
+      if self.entries and self.size + size > self.maxSize:
+        self.__evict( self.size + size - self.maxSize )
+      self.tick += 1
+      self.entries[key] = [size, self.tick, value]
+      self.size += size
+    finally:
+      self.lock.release()
+
+  def remove( self, key ):
+    self.lock.acquire()
+    try:
+      self.__remove( key )
+    finally:
+      self.lock.release()
+
+  def __evict( self, needed ):
+    """ Evict the least recently used entries freeing at least the needed size
+        and a tenth of the cache, so that the scan of the entries is amortized
+        over many insertions
+    """
+    target = max( needed, self.maxSize / 10 )
+    freed = 0
+    for key in sorted( self.entries, key = lambda x: self.entries[x][1] ):
+      if freed >= target:
+        break
+      freed += self.entries[key][0]
+      self.__remove( key )
+      self.evictions += 1
+
+  def __remove( self, key ):
+    if key in self.entries:
+      self.size -= self.entries[key][0]
+      del self.entries[key]
+
+  def clear( self ):
+    self.lock.acquire()
+    try:
+      self.entries = {}
+      self.size = 0
+    finally:
+      self.lock.release()
+
+  def getStatistics( self ):
+    """ Get the usage statistics of the cache
+    """
+    self.lock.acquire()
+    try:
+      return { 'Entries'   : len( self.entries ),
+               'Size'      : self.size,
+               'MaxSize'   : self.maxSize,
+               'Hits'      : self.hits,
+               'Misses'    : self.misses,
+               'Evictions' : self.evictions }
+    finally:
+      self.lock.release()
+
+def normalizeQuery( value ):
+  """ Get a canonical string representation of a metadata query, the same for
+      all the equivalent dictionaries and value lists
+  """
+  if type( value ) == types.DictType:
+    items = [ '%s:%s' % ( normalizeQuery( key ), normalizeQuery( value[key] ) ) for key in sorted( value ) ]
+    return '{%s}' % ','.join( items )
+  elif type( value ) in [ types.ListType, types.TupleType ]:
+    return '[%s]' % ','.join( sorted( [ normalizeQuery( x ) for x in value ] ) )
+  return repr( value )
+
+class QueryResultCache:
+  """ Cache of metadata query results. The results are kept compressed and are
+      only valid for the catalog generation they were obtained with
+  """
+
+  def __init__( self, maxSize ):
+    self.cache = LRUCache( maxSize )
+    self.generation = None
+    self.invalidations = 0
+    self.lock = threading.Lock()
+
+  def getKey( self, queryDict, path ):
+    """ Cache key for the query in the given path
+    """
+    path = path or '/'
+    if len( path ) > 1:
+      path = path.rstrip( '/' )
+    return '%s:%s' % ( path, normalizeQuery( queryDict ) )
+
+  def __checkGeneration( self, generation ):
+    """ All the entries are dropped as soon as the catalog has changed. Returns
+        False for a generation older than the current one
+    """
+    self.lock.acquire()
+    try:
+      if self.generation is None or generation > self.generation:
+        if self.generation is not None:
+          self.invalidations += 1
+        self.cache.clear()
+        self.generation = generation
+      return generation == self.generation
+    finally:
+      self.lock.release()
+
+  def get( self, key, generation ):
+    """ Get the cached result or None
+    """
+    if not self.__checkGeneration( generation ):
+      return None
+    entry = self.cache.get( key )
+    if entry is None:
+      return None
+    entryGeneration, data = entry
+    if entryGeneration != generation:
+      self.cache.remove( key )
+      return None
+    return cPickle.loads( zlib.decompress( data ) )
+
+  def put( self, key, generation, value ):
+    """ Store the result obtained with the given catalog generation
+    """
+    if not self.__checkGeneration( generation ):
+      # Obtained before the last catalog change
+      return
+    data = zlib.compress( cPickle.dumps( value, 2 ) )
+    self.cache.put( key, ( generation, data ), len( data ) + len( key ) )
+
+  def getStatistics( self ):
+    statDict = self.cache.getStatistics()
+    statDict['Generation'] = self.generation
+    statDict['Invalidations'] = self.invalidations
+    return statDict
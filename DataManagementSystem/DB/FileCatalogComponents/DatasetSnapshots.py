@@ -0,0 +1,312 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog dataset snapshots. The files selected by a metadata set
+    are frozen into a snapshot keeping their sorted, delta encoded FileIDs and
+    their LFNs in compressed form, by chunks of SNAPSHOT_FILES_PER_CHUNK files
+    so that no statement grows with the dataset, together with the number of
+    files, their total size and number of events. The file list of the
+    dataset is then served from the snapshot instead of evaluating the
+    metadata query again. A refresh appends the files registered since the
+    snapshot as new chunks
+"""
+
+__RCSID__ = "$Id$"
+
+import os, zlib, binascii
+from DIRAC import S_OK, S_ERROR
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.IDSet import encodeIDs, decodeIDs
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.MetaQueryCompiler import MetaQueryCompiler, \
+                                                                                  isCompilerSupported, formatValue
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.CatalogCache import normalizeQuery
+
+# Number of files summed up by one statement
+SNAPSHOT_CHUNK_SIZE = 1000
+# Number of files stored in one row of the snapshot file list
+SNAPSHOT_FILES_PER_CHUNK = 5000
+
+def toBlob( data ):
+  """ SQL literal of binary data
+  """
+  return "X'%s'" % binascii.hexlify( data )
+
+def encodeLFNs( lfns ):
+  return zlib.compress( '\n'.join( lfns ) )
+
+def decodeLFNs( data ):
+  if not data:
+    return []
+  text = zlib.decompress( data )
+  if not text:
+    return []
+  return text.split( '\n' )
+
+class DatasetSnapshots:
+
+  def __init__( self, database = None ):
+    self.db = database
+
+  def setDatabase( self, database ):
+    self.db = database
+
+  def createTables( self ):
+    """ Create the snapshot tables if they do not exist yet
+    """
+    req = "CREATE TABLE IF NOT EXISTS FC_DatasetSnapshots ( MetaSetName VARCHAR(64) NOT NULL, Query TEXT, "
+    req += "CreationDate DATETIME, UpdateDate DATETIME, LastFileID INTEGER NOT NULL DEFAULT 0, "
+    req += "NFiles INTEGER NOT NULL DEFAULT 0, TotalSize BIGINT NOT NULL DEFAULT 0, "
+    req += "EventSum BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (MetaSetName) )"
+    result = self.db._update( req )
+    if not result['OK']:
+      return result
+    req = "CREATE TABLE IF NOT EXISTS FC_DatasetSnapshotFiles ( MetaSetName VARCHAR(64) NOT NULL, "
+    req += "ChunkID INTEGER NOT NULL, FileIDs MEDIUMBLOB, LFNs MEDIUMBLOB, PRIMARY KEY (MetaSetName,ChunkID) )"
+    return self.db._update( req )
+
+  def __getDatasetQuery( self, metaSetName, credDict ):
+    result = self.db.dmeta.getMetadataSet( metaSetName, True, credDict )
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_ERROR( 'Dataset %s not found' % metaSetName )
+    return result
+
+  def __selectFiles( self, metaDict, credDict, afterFileID = 0 ):
+    """ Get the FileIDs and the LFNs of the files selected by the dataset
+        query and registered after the given FileID
+    """
+    result = MetaQueryCompiler( self.db ).compileQuery( metaDict, '/', credDict, afterFileID = afterFileID )
+    if not result['OK']:
+      return result
+    req = result['Value']
+    if not req:
+      return S_ERROR( 'Dataset query does not select any metadata' )
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    fileIDs = []
+    lfns = []
+    for fileID, dirName, fileName in result['Value']:
+      fileIDs.append( fileID )
+      lfns.append( os.path.join( dirName, fileName ) )
+    return S_OK( ( fileIDs, lfns ) )
+
+  def __getCounters( self, fileIDs, credDict ):
+    """ Get the total size and the number of events of the given files
+    """
+    result = self.db.fmeta.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    eventField = self.db.facetEventField
+    if not eventField in result['Value']:
+      eventField = ''
+
+    totalSize = 0
+    eventSum = 0
+    for i in range( 0, len( fileIDs ), SNAPSHOT_CHUNK_SIZE ):
+      idString = ','.join( [ str( x ) for x in fileIDs[i:i + SNAPSHOT_CHUNK_SIZE] ] )
+      req = "SELECT IFNULL(SUM(Size),0) FROM FC_Files WHERE FileID IN (%s)" % idString
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      totalSize += int( result['Value'][0][0] )
+      if eventField:
+        req = "SELECT IFNULL(SUM(Value),0) FROM FC_FileMeta_%s WHERE FileID IN (%s)" % ( eventField, idString )
+        result = self.db._query( req )
+        if not result['OK']:
+          return result
+        eventSum += int( result['Value'][0][0] )
+    return S_OK( ( totalSize, eventSum ) )
+
+  def __readFiles( self, metaSetName, withLFNs = True ):
+    """ Get the sorted FileIDs and LFNs stored in the chunks of the snapshot
+    """
+    fileIDs = []
+    lfns = []
+    columns = 'FileIDs'
+    if withLFNs:
+      columns += ',LFNs'
+    req = "SELECT %s FROM FC_DatasetSnapshotFiles WHERE MetaSetName=%s ORDER BY ChunkID" % \
+          ( columns, formatValue( metaSetName ) )
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    for row in result['Value']:
+      fileIDs += decodeIDs( row[0] )
+      if withLFNs:
+        lfns += decodeLFNs( row[1] )
+    fileIDs.sort()
+    lfns.sort()
+    return S_OK( ( fileIDs, lfns ) )
+
+  def __writeFiles( self, metaSetName, firstChunk, fileIDs, lfns, connection ):
+    """ Store the file list by chunks of SNAPSHOT_FILES_PER_CHUNK files, one
+        statement per chunk
+    """
+    chunkID = firstChunk
+    for i in range( 0, len( fileIDs ), SNAPSHOT_FILES_PER_CHUNK ):
+      req = "INSERT INTO FC_DatasetSnapshotFiles (MetaSetName,ChunkID,FileIDs,LFNs) VALUES (%s,%d,%s,%s)" % \
+            ( formatValue( metaSetName ), chunkID, toBlob( encodeIDs( fileIDs[i:i + SNAPSHOT_FILES_PER_CHUNK] ) ),
+              toBlob( encodeLFNs( sorted( lfns[i:i + SNAPSHOT_FILES_PER_CHUNK] ) ) ) )
+      result = self.db._update( req, connection )
+      if not result['OK']:
+        return result
+      chunkID += 1
+    return S_OK()
+
+  def createSnapshot( self, metaSetName, credDict, refresh = False ):
+    """ Freeze the current file list of the dataset. With refresh the files
+        registered since the existing snapshot are appended to it; a full
+        snapshot is made if there is none or the dataset definition changed
+    """
+    if not isCompilerSupported( self.db ):
+      return S_ERROR( 'Dataset snapshots need the DirectoryLevelTree' )
+    result = self.__getDatasetQuery( metaSetName, credDict )
+    if not result['OK']:
+      return result
+    metaDict = result['Value']
+    query = normalizeQuery( metaDict )
+
+    snapshot = None
+    if refresh:
+      req = "SELECT Query,LastFileID,NFiles,TotalSize,EventSum FROM FC_DatasetSnapshots "
+      req += "WHERE MetaSetName=%s" % formatValue( metaSetName )
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      if result['Value'] and result['Value'][0][0] == query:
+        snapshot = result['Value'][0]
+
+    # Files registered while the query runs are picked up by the next refresh
+    result = self.db._query( "SELECT IFNULL(MAX(FileID),0) FROM FC_Files" )
+    if not result['OK']:
+      return result
+    lastFileID = int( result['Value'][0][0] )
+
+    afterFileID = 0
+    if snapshot:
+      afterFileID = int( snapshot[1] )
+    result = self.__selectFiles( metaDict, credDict, afterFileID )
+    if not result['OK']:
+      return result
+    fileIDs, lfns = result['Value']
+
+    firstChunk = 0
+    nOldFiles = 0
+    if snapshot:
+      # Files registered during the previous snapshot can already be there
+      result = self.__readFiles( metaSetName, withLFNs = False )
+      if not result['OK']:
+        return result
+      oldIDs = result['Value'][0]
+      oldIDSet = set( oldIDs )
+      newFiles = [ ( fileID, lfn ) for fileID, lfn in zip( fileIDs, lfns ) if not fileID in oldIDSet ]
+      fileIDs = [ fileID for fileID, _lfn in newFiles ]
+      lfns = [ lfn for _fileID, lfn in newFiles ]
+      nOldFiles = len( oldIDs )
+      req = "SELECT IFNULL(MAX(ChunkID)+1,0) FROM FC_DatasetSnapshotFiles WHERE MetaSetName=%s" % \
+            formatValue( metaSetName )
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      firstChunk = int( result['Value'][0][0] )
+    result = self.__getCounters( fileIDs, credDict )
+    if not result['OK']:
+      return result
+    totalSize, eventSum = result['Value']
+    nNewFiles = len( fileIDs )
+    if snapshot:
+      totalSize += int( snapshot[3] )
+      eventSum += int( snapshot[4] )
+
+    result = self.db._getConnection()
+    if not result['OK']:
+      return result
+    connection = result['Value']
+    result = self.db._update( 'START TRANSACTION', connection )
+    if not result['OK']:
+      return result
+    result = self.__storeSnapshot( metaSetName, query, snapshot, firstChunk, fileIDs, lfns,
+                                   lastFileID, nOldFiles + nNewFiles, totalSize, eventSum, connection )
+    if not result['OK']:
+      self.db._update( 'ROLLBACK', connection )
+      return result
+    result = self.db._update( 'COMMIT', connection )
+    if not result['OK']:
+      return result
+
+    return S_OK( { 'NFiles'    : nOldFiles + nNewFiles,
+                   'NewFiles'  : nNewFiles,
+                   'TotalSize' : totalSize,
+                   'EventSum'  : eventSum } )
+
+  def __storeSnapshot( self, metaSetName, query, snapshot, firstChunk, fileIDs, lfns,
+                       lastFileID, nFiles, totalSize, eventSum, connection ):
+    """ Write the snapshot row and the chunks of its file list. A full snapshot
+        replaces the chunks, a refresh appends the new files
+    """
+    if not snapshot:
+      req = "DELETE FROM FC_DatasetSnapshotFiles WHERE MetaSetName=%s" % formatValue( metaSetName )
+      result = self.db._update( req, connection )
+      if not result['OK']:
+        return result
+    result = self.__writeFiles( metaSetName, firstChunk, fileIDs, lfns, connection )
+    if not result['OK']:
+      return result
+
+    req = "INSERT INTO FC_DatasetSnapshots (MetaSetName,Query,CreationDate,UpdateDate,LastFileID,NFiles,"
+    req += "TotalSize,EventSum) VALUES (%s,%s,UTC_TIMESTAMP(),UTC_TIMESTAMP(),%d,%d,%d,%d)" % \
+           ( formatValue( metaSetName ), formatValue( query ), lastFileID, nFiles, totalSize, eventSum )
+    req += " ON DUPLICATE KEY UPDATE Query=VALUES(Query),UpdateDate=VALUES(UpdateDate),"
+    req += "LastFileID=VALUES(LastFileID),NFiles=VALUES(NFiles),TotalSize=VALUES(TotalSize),"
+    req += "EventSum=VALUES(EventSum)"
+    if not snapshot:
+      req += ",CreationDate=VALUES(CreationDate)"
+    return self.db._update( req, connection )
+
+  def getSnapshot( self, metaSetName, withFiles = True ):
+    """ Get the snapshot summary and, if requested, the frozen LFN list of the dataset
+    """
+    req = "SELECT CreationDate,UpdateDate,NFiles,TotalSize,EventSum FROM FC_DatasetSnapshots "
+    req += "WHERE MetaSetName=%s" % formatValue( metaSetName )
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_ERROR( 'No snapshot of dataset %s' % metaSetName )
+    row = result['Value'][0]
+    snapshotDict = { 'Name'         : metaSetName,
+                     'CreationDate' : str( row[0] ),
+                     'UpdateDate'   : str( row[1] ),
+                     'NFiles'       : int( row[2] ),
+                     'TotalSize'    : int( row[3] ),
+                     'EventSum'     : int( row[4] ) }
+    if withFiles:
+      result = self.__readFiles( metaSetName )
+      if not result['OK']:
+        return result
+      snapshotDict['LFNs'] = result['Value'][1]
+    return S_OK( snapshotDict )
+
+  def getSnapshotFileIDs( self, metaSetName ):
+    """ Get the sorted FileIDs frozen in the snapshot of the dataset
+    """
+    req = "SELECT NFiles FROM FC_DatasetSnapshots WHERE MetaSetName=%s" % formatValue( metaSetName )
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_ERROR( 'No snapshot of dataset %s' % metaSetName )
+    result = self.__readFiles( metaSetName, withLFNs = False )
+    if not result['OK']:
+      return result
+    return S_OK( result['Value'][0] )
+
+  def removeSnapshot( self, metaSetName ):
+    req = "DELETE FROM FC_DatasetSnapshotFiles WHERE MetaSetName=%s" % formatValue( metaSetName )
+    result = self.db._update( req )
+    if not result['OK']:
+      return result
+    req = "DELETE FROM FC_DatasetSnapshots WHERE MetaSetName=%s" % formatValue( metaSetName )
+    return self.db._update( req )
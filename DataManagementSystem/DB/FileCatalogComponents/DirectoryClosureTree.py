@@ -0,0 +1,193 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog component representing a directory tree with
+    enumerated paths and an ancestor/descendant closure table.
+
+    The directories are kept in FC_DirectoryLevelTree as with the
+    DirectoryLevelTree, the FC_DirectoryClosure table has a row for every
+    directory and each of its ancestors, itself included at Depth 0. The
+    parent chain and the subtrees of the directories are then read with one
+    indexed query whatever the depth of the tree. The closure table is filled
+    from FC_DirectoryLevelTree the first time the service starts with this
+    manager, besdirac-dms-build-directory-closure fills it again
+"""
+
+__RCSID__ = "$Id$"
+
+from types import ListType
+from DIRAC import S_OK, S_ERROR, gLogger
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryLevelTree import DirectoryLevelTree, \
+                                                                                   MAX_LEVELS, SUBTREE_CHUNK_SIZE
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.QueryProfiler import profileStage
+
+class DirectoryClosureTree(DirectoryLevelTree):
+  """ Directory tree with enumerated paths and a closure table
+  """
+
+  def createTables(self):
+    """ Create the closure table and fill it if the tree has directories already
+    """
+    req = "CREATE TABLE IF NOT EXISTS FC_DirectoryClosure ( AncestorID INTEGER NOT NULL, "
+    req += "DescendantID INTEGER NOT NULL, Depth INTEGER NOT NULL, "
+    req += "PRIMARY KEY (AncestorID,DescendantID), INDEX (DescendantID,Depth) )"
+    result = self.db._update(req)
+    if not result['OK']:
+      return result
+
+    result = self.db._query("SELECT COUNT(*) FROM FC_DirectoryClosure")
+    if not result['OK']:
+      return result
+    if result['Value'][0][0]:
+      return S_OK()
+    gLogger.notice('Filling the directory closure table from FC_DirectoryLevelTree')
+    return self.__fillClosure()
+
+  def __fillClosure(self):
+    """ Add the closure rows of all the directories, one statement per level
+    """
+    req = "INSERT IGNORE INTO FC_DirectoryClosure (AncestorID,DescendantID,Depth) "
+    req += "SELECT DirID,DirID,0 FROM FC_DirectoryLevelTree"
+    result = self.db._update(req)
+    if not result['OK']:
+      return result
+    nRows = result['Value']
+
+    for level in range(1,MAX_LEVELS+1):
+      req = "INSERT IGNORE INTO FC_DirectoryClosure (AncestorID,DescendantID,Depth) "
+      req += "SELECT C.AncestorID,T.DirID,C.Depth+1 FROM FC_DirectoryLevelTree AS T "
+      req += "JOIN FC_DirectoryClosure AS C ON C.DescendantID=T.Parent WHERE T.Level=%d" % level
+      result = self.db._update(req)
+      if not result['OK']:
+        return result
+      nRows += result['Value']
+    return S_OK(nRows)
+
+  def rebuildClosure(self):
+    """ Fill again the closure table from the parent links of FC_DirectoryLevelTree
+    """
+    result = self.db._update("DELETE FROM FC_DirectoryClosure")
+    if not result['OK']:
+      return result
+    return self.__fillClosure()
+
+  def makeDir(self,path):
+    """ Create a new directory entry together with its closure rows
+    """
+    result = DirectoryLevelTree.makeDir(self,path)
+    if not result['OK'] or not result.get('NewDirectory'):
+      return result
+    dirID = result['Value']
+
+    req = "INSERT IGNORE INTO FC_DirectoryClosure (AncestorID,DescendantID,Depth) "
+    req += "SELECT C.AncestorID,T.DirID,C.Depth+1 FROM FC_DirectoryLevelTree AS T "
+    req += "JOIN FC_DirectoryClosure AS C ON C.DescendantID=T.Parent WHERE T.DirID=%d " % dirID
+    req += "UNION ALL SELECT %d,%d,0" % (dirID,dirID)
+    resClosure = self.db._update(req)
+    if not resClosure['OK']:
+      return resClosure
+    return result
+
+  def _makeDirs(self,paths,connection=False):
+    """ Insert the given new directories and their closure rows level by level
+    """
+    result = DirectoryLevelTree._makeDirs(self,paths,connection)
+    if not result['OK']:
+      return result
+    newDirs = result['Value']
+
+    levelDict = {}
+    for path,dirID in newDirs.items():
+      levelDict.setdefault(len( [ x for x in path.split('/') if x ] ),[]).append(dirID)
+    for level in sorted(levelDict.keys()):
+      dirString = ','.join( [ str(dirID) for dirID in levelDict[level] ] )
+      req = "INSERT IGNORE INTO FC_DirectoryClosure (AncestorID,DescendantID,Depth) "
+      req += "SELECT C.AncestorID,T.DirID,C.Depth+1 FROM FC_DirectoryLevelTree AS T "
+      req += "JOIN FC_DirectoryClosure AS C ON C.DescendantID=T.Parent WHERE T.DirID IN (%s) " % dirString
+      req += "UNION ALL SELECT DirID,DirID,0 FROM FC_DirectoryLevelTree WHERE DirID IN (%s)" % dirString
+      result = self.db._update(req,connection)
+      if not result['OK']:
+        return result
+    return S_OK(newDirs)
+
+  def removeDir(self,path):
+    """ Remove directory and its closure rows
+    """
+    result = DirectoryLevelTree.removeDir(self,path)
+    if not result['OK'] or not result['DirID']:
+      return result
+    dirID = result['DirID']
+
+    req = "DELETE FROM FC_DirectoryClosure WHERE DescendantID=%d" % dirID
+    resClosure = self.db._update(req)
+    if not resClosure['OK']:
+      return resClosure
+    return result
+
+  def recoverOrphanDirectories(self,credDict):
+    """ Recover orphan directories and rebuild the closure of their new parents
+    """
+    result = DirectoryLevelTree.recoverOrphanDirectories(self,credDict)
+    if not result['OK']:
+      return result
+    result = self.rebuildClosure()
+    if not result['OK']:
+      return result
+    return S_OK()
+
+  def getPathIDsByID(self,dirID):
+    """ Get IDs of all the directories in the parent hierarchy for a directory
+        specified by its ID
+    """
+    req = "SELECT AncestorID FROM FC_DirectoryClosure WHERE DescendantID=%d ORDER BY Depth DESC" % dirID
+    result = self.db._query(req)
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_ERROR('No result for the path of Directory with ID %d' % dirID)
+
+    return S_OK([ x[0] for x in result['Value'] ])
+
+  @profileStage
+  def getSubdirectoriesByID(self,dirID,requestString=False,includeParent=False):
+    """ Get all the subdirectories of the given directory at a given level
+    """
+    minDepth = 1
+    if includeParent:
+      minDepth = 0
+
+    if requestString:
+      req = "SELECT DescendantID AS DirID FROM FC_DirectoryClosure WHERE AncestorID=%d AND Depth>=%d" % (dirID,minDepth)
+      return S_OK(req)
+
+    req = "SELECT T.Level,C.DescendantID FROM FC_DirectoryClosure AS C JOIN FC_DirectoryLevelTree AS T "
+    req += "ON T.DirID=C.DescendantID WHERE C.AncestorID=%d AND C.Depth>=%d" % (dirID,minDepth)
+    result = self.db._query(req)
+    if not result['OK']:
+      return result
+
+    resDict = {}
+    for row in result['Value']:
+      resDict[row[1]] = row[0]
+
+    return S_OK(resDict)
+
+  @profileStage
+  def getAllSubdirectoriesByID(self,dirList):
+    """ Get IDs of all the subdirectories of directories in a given list
+    """
+    dirs = dirList
+    if type(dirList) != ListType:
+      dirs = [dirList]
+
+    subdirs = set()
+    for i in range(0,len(dirs),SUBTREE_CHUNK_SIZE):
+      dirListString = ','.join( [ str(dir_) for dir_ in dirs[i:i+SUBTREE_CHUNK_SIZE] ] )
+      req = "SELECT DISTINCT DescendantID FROM FC_DirectoryClosure WHERE AncestorID IN (%s) AND Depth>0" % dirListString
+      result = self.db._query(req)
+      if not result['OK']:
+        return result
+      subdirs.update( [ row[0] for row in result['Value'] ] )
+
+    return S_OK(list(subdirs))
@@ -7,7 +7,7 @@ __RCSID__ = "$Id$"
 
 import time, os, types,stat
 from DIRAC                                                                     import S_OK, S_ERROR
-from DIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase     import DirectoryTreeBase
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase     import DirectoryTreeBase
 from DIRAC.Core.Utilities.List                                                 import stringListToString,intListToString
 
 class DirectoryFlatTree(DirectoryTreeBase):
@@ -88,13 +88,22 @@ class DirectoryFlatTree(DirectoryTreeBase):
         successful[dirName]['Execute'] = mode & stat.S_IXOTH
     return S_OK({'Successful':successful,'Failed':res['Value']['Failed']})
 
-  def findDir(self,path):
+  def _findDir(self,path):
     res = self.__findDirs([path])
     if not res['OK']:
       return res
     if not res['Value']:
       return S_OK(0)
     return S_OK(res['Value'].keys()[0])
+
+  def _findDirs(self,paths,connection=False):
+    res = self._findDirectories(paths)
+    if not res['OK']:
+      return res
+    dirDict = {}
+    for dirName,metaDict in res['Value']['Successful'].items():
+      dirDict[dirName] = (metaDict['DirID'],None)
+    return S_OK(dirDict)
   
   def removeDir(self,path):
     """ Remove directory """
@@ -105,7 +114,9 @@ class DirectoryFlatTree(DirectoryTreeBase):
       return S_OK()
     dirID = res['Value']
     req = "DELETE FROM DirectoryInfo WHERE DirID=%d" % dirID
-    return self.db._update(req)
+    result = self.db._update(req)
+    self._directoriesRemoved()
+    return result
 
 
  
@@ -116,6 +127,7 @@ class DirectoryFlatTree(DirectoryTreeBase):
     if path[0] != '/':
       return S_ERROR('Not an absolute path')
 
+    self._dropCachedDir(path)
     result = self.findDir(path)
     if not result['OK']:
       return result
@@ -141,6 +153,7 @@ class DirectoryFlatTree(DirectoryTreeBase):
     return S_OK(result['lastRowId'])
 
   def makeDir(self,path):
+    self._dropCachedDir(path)
     result = self.findDir(path)
     if not result['OK']:
       return result
@@ -182,7 +195,7 @@ class DirectoryFlatTree(DirectoryTreeBase):
       return S_ERROR('No parent found')
     return S_OK(result['Value'][0][0])
 
-  def getDirectoryPath(self,dirID):
+  def _getDirectoryPath(self,dirID):
     """ Get directory name by directory ID """
     req = "SELECT DirName FROM DirectoryInfo WHERE DirID=%d" % int(dirID)
     result = self.db._query(req)
@@ -192,6 +205,19 @@ class DirectoryFlatTree(DirectoryTreeBase):
       return S_ERROR('Directory with id %d not found' % int(dirID) )
     return S_OK(result['Value'][0][0])
 
+  def _getDirs(self,dirIDs,connection=False):
+    """ Get the ( path, ParentID, Level ) of the given directories with one query """
+    dirListString = ','.join( [ str(dir_) for dir_ in dirIDs ] )
+    req = "SELECT DirID,DirName,Parent FROM DirectoryInfo WHERE DirID IN (%s)" % dirListString
+    result = self.db._query(req,connection)
+    if not result['OK']:
+      return result
+
+    dirDict = {}
+    for dirID,dirName,parentID in result['Value']:
+      dirDict[dirID] = (dirName,parentID,len( [ x for x in dirName.split('/') if x ] ))
+    return S_OK(dirDict)
+
   def getDirectoryName(self,dirID):
     """ Get directory name by directory ID """
     result = self.getDirectoryPath(dirID)
@@ -11,10 +11,18 @@ __RCSID__ = "$Id$"
 
 import os
 from types import ListType, StringTypes
-from DIRAC import S_OK, S_ERROR
-from DIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase import DirectoryTreeBase
+from DIRAC import S_OK, S_ERROR, gLogger
+from DIRAC.Core.Utilities.List import stringListToString
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase import DirectoryTreeBase
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.QueryProfiler import profileStage, profileCall
 
 MAX_LEVELS = 15
+# Number of directories handled by one subtree expansion query
+SUBTREE_CHUNK_SIZE = 500
+# Number of directories renumbered by one statement when rebuilding level indexes
+REINDEX_CHUNK_SIZE = 1000
+# Number of rebuild passes catching up with directories created during a rebuild
+REINDEX_PASSES = 3
 
 class DirectoryLevelTree(DirectoryTreeBase):
   """ Class managing Directory Tree as a simple self-linked structure 
@@ -29,7 +37,19 @@ class DirectoryLevelTree(DirectoryTreeBase):
     
     return 'Directory'
 
-  def findDir(self,path,connection=False):
+  def createIndexes(self):
+    """ Add the index on the enumerated paths if the table does not have it yet.
+        The subtrees are then selected by equality on the leading LPATH columns
+    """
+    result = self.db._query("SHOW INDEX FROM FC_DirectoryLevelTree WHERE Key_name='LPATHIndex'")
+    if not result['OK']:
+      return result
+    if result['Value']:
+      return S_OK()
+    epathString = ','.join( [ 'LPATH%d' % (i+1) for i in range( MAX_LEVELS ) ] )
+    return self.db._update("ALTER TABLE FC_DirectoryLevelTree ADD INDEX LPATHIndex (%s)" % epathString)
+
+  def _findDir(self,path,connection=False):
     """  Find directory ID for the given path
     """
     
@@ -45,6 +65,23 @@ class DirectoryLevelTree(DirectoryTreeBase):
     res = S_OK(result['Value'][0][0])  
     res['Level'] = result['Value'][0][1]
     return res
+
+  def _findDirs(self,paths,connection=False):
+    """  Find directory IDs and levels for the given paths in one query
+    """
+    pathDict = {}
+    for path in paths:
+      pathDict.setdefault(os.path.normpath(path),[]).append(path)
+    req = "SELECT DirName,DirID,Level FROM FC_DirectoryLevelTree WHERE DirName IN (%s)" % stringListToString(pathDict.keys())
+    result = self.db._query(req,connection)
+    if not result['OK']:
+      return result
+
+    dirDict = {}
+    for dirName,dirID,level in result['Value']:
+      for path in pathDict.get(dirName,[]):
+        dirDict[path] = (dirID,level)
+    return S_OK(dirDict)
   
   def removeDir(self,path):
     """ Remove directory
@@ -61,6 +98,7 @@ class DirectoryLevelTree(DirectoryTreeBase):
     dirID = result['Value']
     req = "DELETE FROM FC_DirectoryLevelTree WHERE DirID=%d" % dirID
     result = self.db._update(req)
+    self._directoriesRemoved()
     result['DirID'] = dirID
     return result
 
@@ -88,6 +126,7 @@ class DirectoryLevelTree(DirectoryTreeBase):
   def makeDir(self,path):
     """ Create a new directory entry
     """      
+    self._dropCachedDir(path)
     result = self.findDir(path)
     if not result['OK']:
       return result
@@ -166,6 +205,75 @@ class DirectoryLevelTree(DirectoryTreeBase):
     return result  
   
   
+  def _makeDirs(self,paths,connection=False):
+    """ Insert the given new directories, sorted by level, with one statement per
+        level. The enumerated path numbers are read with locks on the children of
+        the parents, a concurrent makeDir waits for the end of the transaction
+    """
+    levelDict = {}
+    for path in paths:
+      level = len( [ x for x in path.split('/') if x ] )
+      if level > MAX_LEVELS:
+        return S_ERROR('Too many directory levels: %d' % level)
+      levelDict.setdefault(level,[]).append(path)
+
+    # Enumerated paths of the existing parents
+    known = {}
+    parents = set( [ os.path.dirname(path) for path in paths if path != '/' ] ) - set(paths)
+    if parents:
+      epathString = ','.join( [ 'LPATH%d' % (i+1) for i in range( MAX_LEVELS ) ] )
+      req = "SELECT DirName,DirID,Level,%s FROM FC_DirectoryLevelTree WHERE DirName IN (%s)" % \
+            (epathString,stringListToString(list(parents)))
+      result = self.db._query(req,connection)
+      if not result['OK']:
+        return result
+      for row in result['Value']:
+        known[row[0]] = (row[1],tuple(row[3:3+row[2]]))
+
+    newDirs = {}
+    for level in sorted(levelDict.keys()):
+      levelPaths = levelDict[level]
+      lpathDict = {}
+      if level == 0:
+        req = "INSERT INTO FC_DirectoryLevelTree (DirName,Level,Parent) VALUES ('/',0,0)"
+        lpathDict['/'] = ()
+      else:
+        for path in levelPaths:
+          if not os.path.dirname(path) in known:
+            return S_ERROR('Parent directory not found for %s' % path)
+        parentIDs = set( [ known[os.path.dirname(path)][0] for path in levelPaths ] )
+        lPath = 'LPATH%d' % level
+        req = "SELECT Parent,MAX(%s) FROM FC_DirectoryLevelTree WHERE Parent IN (%s) GROUP BY Parent FOR UPDATE" % \
+              (lPath,','.join( [ str(parentID) for parentID in parentIDs ] ))
+        result = self.db._query(req,connection)
+        if not result['OK']:
+          return result
+        lastIndex = dict.fromkeys(parentIDs,0)
+        for parentID,maxIndex in result['Value']:
+          lastIndex[parentID] = maxIndex or 0
+
+        values = []
+        for path in levelPaths:
+          parentID,parentLPaths = known[os.path.dirname(path)]
+          lastIndex[parentID] += 1
+          lpathDict[path] = parentLPaths + (lastIndex[parentID],)
+          values.append( "('%s',%d,%d,%s)" % (path,level,parentID,','.join( [ str(x) for x in lpathDict[path] ] )) )
+        names = ','.join( [ 'LPATH%d' % (i+1) for i in range(level) ] )
+        req = "INSERT INTO FC_DirectoryLevelTree (DirName,Level,Parent,%s) VALUES %s" % (names,','.join(values))
+      result = self.db._update(req,connection)
+      if not result['OK']:
+        return result
+
+      req = "SELECT DirName,DirID FROM FC_DirectoryLevelTree WHERE DirName IN (%s)" % stringListToString(levelPaths)
+      result = self.db._query(req,connection)
+      if not result['OK']:
+        return result
+      for dirName,dirID in result['Value']:
+        newDirs[dirName] = dirID
+        known[dirName] = (dirID,lpathDict[dirName])
+
+    return S_OK(newDirs)
+  
   def existsDir(self,path):
     """ Check the existence of a directory at the specified path
     """
@@ -207,7 +315,7 @@ class DirectoryLevelTree(DirectoryTreeBase):
     
     return S_OK(result['Value'][0][0])
   
-  def getDirectoryPath(self,dirID):
+  def _getDirectoryPath(self,dirID):
     """ Get directory name by directory ID
     """
     req = "SELECT DirName FROM FC_DirectoryLevelTree WHERE DirID=%d" % int(dirID)
@@ -219,27 +327,19 @@ class DirectoryLevelTree(DirectoryTreeBase):
     
     return S_OK(result['Value'][0][0])
 
-  def getDirectoryPaths(self,dirIDList):
-    """ Get directory name by directory ID list
+  def _getDirs(self,dirIDs,connection=False):
+    """ Get the ( path, ParentID, Level ) of the given directories with one query
     """
-    dirs = dirIDList
-    if type(dirIDList) != ListType:
-      dirs = [dirIDList]
-      
-    dirListString = ','.join( [ str(dir_) for dir_ in dirs ] )
-
-    req = "SELECT DirID,DirName FROM FC_DirectoryLevelTree WHERE DirID in ( %s )" % dirListString
-    result = self.db._query(req)
+    dirListString = ','.join( [ str(dir_) for dir_ in dirIDs ] )
+    req = "SELECT DirID,DirName,Parent,Level FROM FC_DirectoryLevelTree WHERE DirID IN (%s)" % dirListString
+    result = self.db._query(req,connection)
     if not result['OK']:
       return result
-    if not result['Value']:
-      return S_ERROR('Directories not found: %s' % dirListString )
-
-    resultDict = {}
-    for row in result['Value']:
-      resultDict[int(row[0])] = row[1]
 
-    return S_OK(resultDict) 
+    dirDict = {}
+    for dirID,dirName,parentID,level in result['Value']:
+      dirDict[dirID] = (dirName,parentID,level)
+    return S_OK(dirDict)
  
   def getDirectoryName(self,dirID):
     """ Get directory name by directory ID
@@ -334,6 +434,7 @@ class DirectoryLevelTree(DirectoryTreeBase):
     
     return S_OK([ x[0] for x in result['Value'] ])
   
+  @profileStage
   def getSubdirectoriesByID(self,dirID,requestString=False,includeParent=False):
     """ Get all the subdirectories of the given directory at a given level
     """
@@ -381,8 +482,58 @@ class DirectoryLevelTree(DirectoryTreeBase):
 
     return S_OK(resDict)
   
+  def __getNumericPaths(self,dirIDs):
+    """ Get the enumerated paths of the given directories as tuples of LPATH values
+    """
+    epathString = ','.join( [ 'LPATH%d' % (i+1) for i in range( MAX_LEVELS ) ] )
+    lpathDict = {}
+    for i in range(0,len(dirIDs),SUBTREE_CHUNK_SIZE):
+      dirListString = ','.join( [ str(dir_) for dir_ in dirIDs[i:i+SUBTREE_CHUNK_SIZE] ] )
+      req = "SELECT DirID,Level,%s FROM FC_DirectoryLevelTree WHERE DirID IN (%s)" % (epathString,dirListString)
+      result = self.db._query(req)
+      if not result['OK']:
+        return result
+      for row in result['Value']:
+        lpathDict[row[0]] = tuple(row[2:2+row[1]])
+    return S_OK(lpathDict)
+
+  @profileStage
   def getAllSubdirectoriesByID(self,dirList):
-    """ Get IDs of all the subdirectories of directories in a given list
+    """ Get IDs of all the subdirectories of directories in a given list. The
+        subtrees are selected by the enumerated paths of their roots instead of
+        walking the tree level by level
+    """
+
+    dirs = dirList
+    if type(dirList) != ListType:
+      dirs = [dirList]
+    result = self.__getNumericPaths(dirs)
+    if not result['OK']:
+      return result
+    lpathSet = set(result['Value'].values())
+
+    # The directories inside the subtree of another one add nothing
+    selections = []
+    for lpaths in lpathSet:
+      if any([ lpaths[:l] in lpathSet for l in range(len(lpaths)) ]):
+        continue
+      sel = [ 'LPATH%d=%d' % (l+1,lpaths[l]) for l in range(len(lpaths)) ]
+      selections.append( ' AND '.join( sel + [ 'Level>%d' % len(lpaths) ] ) )
+
+    resultList = []
+    for i in range(0,len(selections),SUBTREE_CHUNK_SIZE):
+      req = "SELECT DirID FROM FC_DirectoryLevelTree WHERE (%s)" % ') OR ('.join(selections[i:i+SUBTREE_CHUNK_SIZE])
+      result = self.db._query(req)
+      if not result['OK']:
+        return result
+      resultList += [ row[0] for row in result['Value'] ]
+
+    return S_OK(resultList)
+
+  @profileStage
+  def _getAllSubdirectoriesLevelByLevel(self,dirList):
+    """ Get IDs of all the subdirectories of directories in a given list walking
+        the tree one level per query, kept as reference for the benchmark
     """
 
     dirs = dirList
@@ -406,6 +557,40 @@ class DirectoryLevelTree(DirectoryTreeBase):
     return S_OK(resultList)  
       
   
+  def benchmarkSubdirectoryExpansion(self,path,depth=1):
+    """ Compare the level by level and the enumerated path expansion of the
+        subtrees of all the directories depth levels below the given path
+    """
+    result = self.findDir(path)
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_ERROR('Directory does not exists: %s' % path )
+    dirID = result['Value']
+    level = result['Level']
+
+    result = self.getSubdirectoriesByID(dirID,includeParent=True)
+    if not result['OK']:
+      return result
+    roots = [ subID for subID,subLevel in result['Value'].items() if subLevel == level+depth ]
+    if not roots:
+      return S_ERROR('No directories %d levels below %s' % (depth,path))
+
+    resultDict = {'Roots':len(roots)}
+    subdirs = {}
+    for name,method in [ ('LevelByLevel',self._getAllSubdirectoriesLevelByLevel),
+                         ('EnumeratedPaths',self.getAllSubdirectoriesByID) ]:
+      result = profileCall(method,roots)
+      profile = result['Value']['Profile']
+      result = result['Value']['Result']
+      if not result['OK']:
+        return result
+      subdirs[name] = set(result['Value'])
+      resultDict[name] = {'Time':profile['TotalTime'],'RoundTrips':profile['RoundTrips']}
+    resultDict['Subdirectories'] = len(subdirs['EnumeratedPaths'])
+    resultDict['Match'] = subdirs['LevelByLevel'] == subdirs['EnumeratedPaths']
+    return S_OK(resultDict)
+
   def getSubdirectories(self,path):
     """ Get subdirectories of the given directory
     """    
@@ -425,18 +610,13 @@ class DirectoryLevelTree(DirectoryTreeBase):
     """
     # Find out orphan directories
     treeTable = 'FC_DirectoryLevelTree'
-    req = "SELECT DirID,Parent,Level FROM %s WHERE Parent NOT IN ( SELECT DirID from %s )" % (treeTable,treeTable)
+    req = "SELECT DirID,Parent,DirName FROM %s WHERE Parent NOT IN ( SELECT DirID from %s )" % (treeTable,treeTable)
     result = self.db._query( req )
     if not result['OK']:
       return result
 
     parentDict = {}
-    for dirID,parentID,level in result['Value']:
-
-      result = self.getDirectoryPath( dirID )
-      if not result['OK']:
-        continue
-      dirPath = result['Value']
+    for dirID,parentID,dirPath in result['Value']:
       parentPath = os.path.dirname( dirPath )
       if not dirPath == '/':
         parentDict.setdefault( parentPath, {} )
@@ -485,14 +665,12 @@ class DirectoryLevelTree(DirectoryTreeBase):
       if not result['OK']:
         continue
 
-      connection = self._getConnection()
-      result = self.db._query("LOCK TABLES FC_DirectoryLevelTree WRITE", connection )
+      result = self.__rebuildLevelIndexes( parentID )
       if not result['OK']:
-        resUnlock = self.db._query("UNLOCK TABLES", connection )
-        return result
-      result = self.__rebuildLevelIndexes( parentID, connection)
-      resUnlock = self.db._query("UNLOCK TABLES", connection )       
+        gLogger.warn( 'Failed to rebuild the level indexes under %s' % parentPath, result['Message'] )
       
+    # Recreated parents took over the DirIDs of the lost ones
+    self._directoriesRemoved()
     return S_OK()
 
   def _getConnection( self, connection=False ):
@@ -504,30 +682,90 @@ class DirectoryLevelTree(DirectoryTreeBase):
     return connection
 
   def __rebuildLevelIndexes( self, parentID, connection=False ):
-    """ Rebuild level indexes for all the subdirectories
-    """        
-    result = self.__getNumericPath( parentID, connection )
-    if not result['OK']:
-      return result  
-    
-    parentIndexList = result['Value']
-    parentLevel = result['Level']
-    result = self.getChildren( parentID, connection )
-    if not result['OK']:
-      return result  
-    subIDList = result['Value']
-      
-    indexList = list( parentIndexList )
-    indexList.append( 0 )  
-    for dirID in subIDList:
-      indexList[-1] += 1
-      lpaths = [ 'LPATH%d=%d' % (i+1,indexList[i]) for i in range(parentLevel+1) ]
-      lpathString = 'SET '+','.join( lpaths )
-      req = "UPDATE FC_DirectoryLevelTree %s WHERE DirID=%s" % ( lpathString, dirID )    
-      result = self.db._update( req, connection )
+    """ Rebuild level indexes for all the subdirectories. The new indexes are
+        computed in memory and only the changed rows are written, by chunks.
+        The subtree is read again after each write to catch up with the
+        directories created meanwhile
+    """
+    passes = 0
+    while True:
+      result = self.__getSubtreeLevelIndexes( parentID, connection )
       if not result['OK']:
         return result
-      result = self.__rebuildLevelIndexes( dirID, connection )
-      
+      lpathDict = result['Value']
+      if not lpathDict:
+        return S_OK()
+      if passes == REINDEX_PASSES:
+        return S_ERROR( 'Level indexes under directory %d still changing after %d passes' % ( parentID, passes ) )
+      result = self.__applyLevelIndexes( lpathDict, connection )
+      if not result['OK']:
+        return result
+      passes += 1
+
+  def __getSubtreeLevelIndexes( self, parentID, connection=False ):
+    """ Compute the level indexes of all the subdirectories of the given directory,
+        reading the tree one level at a time. The children of a directory are
+        numbered in the order of their IDs. Returns { dirID : lpath tuple } for
+        the directories whose indexes differ from the computed ones
+    """
+    result = self.__getNumericPath( parentID, connection )
+    if not result['OK']:
+      return result
+    if not 'Level' in result:
+      return S_ERROR( 'Directory with id %d not found' % parentID )
+    level = result['Level']
+    lpathDict = { parentID: tuple( result['Value'] ) }
+
+    epathString = ','.join( [ 'LPATH%d' % (i+1) for i in range( MAX_LEVELS ) ] )
+    changed = {}
+    parents = [parentID]
+    while parents and level < MAX_LEVELS:
+      level += 1
+      children = []
+      for i in range( 0, len( parents ), REINDEX_CHUNK_SIZE ):
+        parentString = ','.join( [ str( x ) for x in parents[i:i+REINDEX_CHUNK_SIZE] ] )
+        req = "SELECT DirID,Parent,%s FROM FC_DirectoryLevelTree WHERE Parent IN (%s) ORDER BY Parent,DirID" % \
+              ( epathString, parentString )
+        result = self.db._query( req, connection )
+        if not result['OK']:
+          return result
+        lastParent = None
+        for row in result['Value']:
+          dirID, parent = row[0], row[1]
+          if parent != lastParent:
+            lastParent = parent
+            index = 0
+          index += 1
+          lpath = lpathDict[parent] + ( index, )
+          lpathDict[dirID] = lpath
+          children.append( dirID )
+          if tuple( row[2:2+level] ) != lpath:
+            changed[dirID] = lpath
+      parents = children
+
+    return S_OK( changed )
+
+  def __applyLevelIndexes( self, lpathDict, connection=False ):
+    """ Write the given level indexes with one statement per chunk of directories
+        of the same level, the table is only locked for the time of one statement
+    """
+    levelDict = {}
+    for dirID, lpath in lpathDict.items():
+      levelDict.setdefault( len( lpath ), [] ).append( dirID )
+
+    for level in sorted( levelDict.keys() ):
+      dirIDs = levelDict[level]
+      for i in range( 0, len( dirIDs ), REINDEX_CHUNK_SIZE ):
+        chunk = dirIDs[i:i+REINDEX_CHUNK_SIZE]
+        setList = []
+        for k in range( level ):
+          cases = ' '.join( [ 'WHEN %d THEN %d' % ( dirID, lpathDict[dirID][k] ) for dirID in chunk ] )
+          setList.append( 'LPATH%d=CASE DirID %s END' % ( k+1, cases ) )
+        req = "UPDATE FC_DirectoryLevelTree SET %s WHERE DirID IN (%s)" % \
+              ( ','.join( setList ), ','.join( [ str( x ) for x in chunk ] ) )
+        result = self.db._update( req, connection )
+        if not result['OK']:
+          return result
+
     return S_OK() 
   
\ No newline at end of file
@@ -7,9 +7,26 @@
 
 __RCSID__ = "$Id$"
 
-import os, types
-from DIRAC import S_OK, S_ERROR
+import os, types, datetime, decimal
+from DIRAC import S_OK, S_ERROR, gLogger
 from DIRAC.DataManagementSystem.DB.FileCatalogComponents.Utilities import queryTime
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.IDSet import IDSet, intersectIDs
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.MetaQueryCompiler import createValueCondition, \
+                                                                                  isCompilerSupported, formatValue, getValueKind
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.RunIndex import isRunQuery
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.QueryProfiler import profileStage
+
+# Number of directories updated by one effective metadata statement
+EFFECTIVE_CHUNK_SIZE = 1000
+# Number of rows moved at once when a meta parameter becomes an indexed field
+MIGRATION_CHUNK_SIZE = 5000
+# Number of removed directories and of metadata tables cleaned by one statement,
+# MySQL joins at most 61 tables
+CLEANUP_CHUNK_SIZE = 1000
+CLEANUP_TABLES = 40
+
+# MySQL types read back as exact decimal values
+DECIMAL_TYPES = [ 'DECIMAL', 'NUMERIC' ]
 
 class DirectoryMetadata:
 
@@ -41,23 +58,22 @@ class DirectoryMetadata:
       return result
     if pname in result['Value'].keys():
       if ptype.lower() == result['Value'][pname].lower():
+        # Complete an interrupted migration of the parameter values
+        result = self.__transformMetaParameterToData( pname )
+        if not result['OK']:
+          return result
+        if result['Value']:
+          if self.db.effectiveMetadata:
+            result = self.__rebuildEffectiveField( pname, ptype )
+            if not result['OK']:
+              return result
+          self.__rebuildRunIndex( pname, credDict )
         return S_OK( 'Already exists' )
       else:
         return S_ERROR( 'Attempt to add an existing metadata with different type: %s/%s' %
                         ( ptype, result['Value'][pname] ) )
 
-    valueType = ptype
-    if ptype.lower()[:3] == 'int':
-      valueType = 'INT'
-    elif ptype.lower() == 'string':
-      valueType = 'VARCHAR(128)'
-    elif ptype.lower() == 'float':
-      valueType = 'FLOAT'
-    elif ptype.lower() == 'date':
-      valueType = 'DATETIME'
-    elif ptype == "MetaSet":
-      valueType = "VARCHAR(64)"
-
+    valueType = self.__getValueType( ptype )
     req = "CREATE TABLE FC_Meta_%s ( DirID INTEGER NOT NULL, Value %s, PRIMARY KEY (DirID), INDEX (Value) )" \
                               % ( pname, valueType )
     result = self.db._query( req )
@@ -67,14 +83,37 @@ class DirectoryMetadata:
     result = self.db._insert( 'FC_MetaFields', ['MetaName', 'MetaType'], [pname, ptype] )
     if not result['OK']:
       return result
+    self.__invalidateMetadataFields()
 
     metadataID = result['lastRowId']
     result = self.__transformMetaParameterToData( pname )
     if not result['OK']:
       return result
 
+    if self.db.effectiveMetadata:
+      result = self.__rebuildEffectiveField( pname, ptype )
+      if not result['OK']:
+        return result
+    self.__rebuildRunIndex( pname, credDict )
+
     return S_OK( "Added new metadata: %d" % metadataID )
 
+  def __getValueType( self, ptype ):
+    """ Get the MySQL type of the metadata value column
+    """
+    valueType = ptype
+    if ptype.lower()[:3] == 'int':
+      valueType = 'INT'
+    elif ptype.lower() == 'string':
+      valueType = 'VARCHAR(128)'
+    elif ptype.lower() == 'float':
+      valueType = 'FLOAT'
+    elif ptype.lower() == 'date':
+      valueType = 'DATETIME'
+    elif ptype == "MetaSet":
+      valueType = "VARCHAR(64)"
+    return valueType
+
   def deleteMetadataField( self, pname, credDict ):
     """ Remove metadata field
     """
@@ -84,17 +123,44 @@ class DirectoryMetadata:
     error = ''
     if not result['OK']:
       error = result["Message"]
+    req = "DROP TABLE IF EXISTS FC_EffMeta_%s" % pname
+    result = self.db._update( req )
+    if not result['OK']:
+      if error:
+        error += "; "
+      error += result["Message"]
     req = "DELETE FROM FC_MetaFields WHERE MetaName='%s'" % pname
     result = self.db._update( req )
+    self.__invalidateMetadataFields()
+    self.__rebuildRunIndex( pname, credDict )
     if not result['OK']:
       if error:
         result["Message"] = error + "; " + result["Message"]
     return result
 
+  def __invalidateMetadataFields( self ):
+    """ Drop the cached field definitions here and in the other service instances
+    """
+    self.db.metaFields.pop( 'Directory', None )
+    result = self.db.bumpGeneration( 'MetaFields' )
+    if not result['OK']:
+      gLogger.warn( 'Failed to update the MetaFields generation', result['Message'] )
+    self.db.catalogChanged()
+
   def getMetadataFields( self, credDict ):
-    """ Get all the defined metadata fields
+    """ Get all the defined metadata fields. The definitions are cached and
+        reloaded when the MetaFields generation changes
     """
 
+    result = self.db.getGeneration( 'MetaFields' )
+    if not result['OK']:
+      return result
+    generation = result['Value']
+    if 'Directory' in self.db.metaFields:
+      cachedGeneration, metaDict = self.db.metaFields['Directory']
+      if cachedGeneration == generation:
+        return S_OK( dict( metaDict ) )
+
     req = "SELECT MetaName,MetaType FROM FC_MetaFields"
     result = self.db._query( req )
     if not result['OK']:
@@ -104,20 +170,81 @@ class DirectoryMetadata:
     for row in result['Value']:
       metaDict[row[0]] = row[1]
 
-    return S_OK( metaDict )
+    self.db.metaFields['Directory'] = ( generation, metaDict )
+    return S_OK( dict( metaDict ) )
+
+  def __getMetadataSetDefinitions( self ):
+    """ Get the definitions of all the metadata sets as { setName : { key : value } },
+        loaded in one query. The definitions are cached and reloaded when the
+        MetaSets generation changes
+    """
+    result = self.db.getGeneration( 'MetaSets' )
+    if not result['OK']:
+      return result
+    generation = result['Value']
+    if self.db.metaSets is not None:
+      cachedGeneration, metaSets = self.db.metaSets
+      if cachedGeneration == generation:
+        return S_OK( metaSets )
+
+    req = "SELECT N.MetaSetName,S.MetaKey,S.MetaValue FROM FC_MetaSetNames AS N "
+    req += "LEFT JOIN FC_MetaSets AS S ON S.MetaSetID=N.MetaSetID"
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+
+    metaSets = {}
+    for metaSetName, key, value in result['Value']:
+      setDict = metaSets.setdefault( metaSetName, {} )
+      if key is not None:
+        setDict[key] = value
+
+    self.db.metaSets = ( generation, metaSets )
+    return S_OK( metaSets )
+
+  def __expandMetadataSet( self, metaSetName, metaSets, metaTypeDict, expanded, path = None ):
+    """ Expand the nested sets of the metadata set in memory. The expanded
+        sets are kept in the expanded dictionary for reuse
+    """
+    path = path or []
+    if metaSetName in expanded:
+      return S_OK( expanded[metaSetName] )
+    if metaSetName in path:
+      return S_ERROR( 'Cyclic metadata set definition %s' % ' -> '.join( path + [metaSetName] ) )
+
+    resultDict = {}
+    for key, value in metaSets.get( metaSetName, {} ).items():
+      if not key in metaTypeDict:
+        return S_ERROR( 'Unknown key %s' % key )
+      if metaTypeDict[key] == "MetaSet":
+        result = self.__expandMetadataSet( value, metaSets, metaTypeDict, expanded, path + [metaSetName] )
+        if not result['OK']:
+          return result
+        resultDict.update( result['Value'] )
+      else:
+        resultDict[key] = value
+    expanded[metaSetName] = resultDict
+    return S_OK( resultDict )
 
   def listMetadataSets(self, credDict):
     """ List all metadata sets
     """
-    res = self.db.getFields('FC_MetaSetNames',['MetaSetName'])
-    if not res['OK']:
-      return res
+    result = self.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaTypeDict = result['Value']
+    result = self.__getMetadataSetDefinitions()
+    if not result['OK']:
+      return result
+    metaSets = result['Value']
+
+    expanded = {}
     metasets = {}
-    for row in res['Value']:
-      res = self.getMetadataSet(row[0], True, credDict)
-      if not res['OK']:
-        return res
-      metasets.setdefault(row[0], res['Value'])
+    for metaSetName in metaSets:
+      result = self.__expandMetadataSet( metaSetName, metaSets, metaTypeDict, expanded )
+      if not result['OK']:
+        return result
+      metasets[metaSetName] = dict( result['Value'] )
     return S_OK(metasets)
   
   def addMetadataSet( self, metaSetName, metaSetDict, credDict ):
@@ -144,6 +271,12 @@ class DirectoryMetadata:
       vList.append( "(%d,'%s','%s')" % ( metaSetID, key, str( value ) ) )
     vString = ','.join( vList )
     result = self.db._update( req % vString )
+    self.db.metaSets = None
+    genResult = self.db.bumpGeneration( 'MetaSets' )
+    if not genResult['OK']:
+      gLogger.warn( 'Failed to update the MetaSets generation', genResult['Message'] )
+    if result['OK']:
+      self.db.catalogChanged()
     return result
 
   def getMetadataSet( self, metaSetName, expandFlag, credDict ):
@@ -154,30 +287,21 @@ class DirectoryMetadata:
       return result
     metaTypeDict = result['Value']
 
-    req = "SELECT S.MetaKey,S.MetaValue FROM FC_MetaSets as S, FC_MetaSetNames as N "
-    req += "WHERE N.MetaSetName='%s' AND N.MetaSetID=S.MetaSetID" % metaSetName
-    result = self.db._query( req )
+    result = self.__getMetadataSetDefinitions()
     if not result['OK']:
       return result
+    metaSets = result['Value']
 
-    if not result['Value']:
-      return S_OK( {} )
+    if not expandFlag:
+      for key in metaSets.get( metaSetName, {} ):
+        if not key in metaTypeDict:
+          return S_ERROR( 'Unknown key %s' % key )
+      return S_OK( dict( metaSets.get( metaSetName, {} ) ) )
 
-    resultDict = {}
-    for key, value in result['Value']:
-      if not key in metaTypeDict:
-        return S_ERROR( 'Unknown key %s' % key )
-      if expandFlag:
-        if metaTypeDict[key] == "MetaSet":
-          result = self.getMetadataSet( value, expandFlag, credDict )
-          if not result['OK']:
-            return result
-          resultDict.update( result['Value'] )
-        else:
-          resultDict[key] = value
-      else:
-        resultDict[key] = value
-    return S_OK( resultDict )
+    result = self.__expandMetadataSet( metaSetName, metaSets, metaTypeDict, {} )
+    if not result['OK']:
+      return result
+    return S_OK( dict( result['Value'] ) )
 
 #############################################################################################  
 #
@@ -222,7 +346,101 @@ class DirectoryMetadata:
             return result
         else:
           return result
+      if self.db.effectiveMetadata:
+        result = self.__propagateEffectiveMetadata( metaName, dirID )
+        if not result['OK']:
+          return result
 
+    if self.db.runIndex and self.db.runIndex.isIndexed( metadict, metaFields ):
+      self.__updateRunIndex( dirID )
+    return S_OK()
+
+  def setNewDirectoryMetadata( self, newDirs, pathMetaDict, credDict, connection = False ):
+    """ Insert the metadata of directories created together, one statement per
+        field. newDirs maps the paths of the new directories to their DirIDs and
+        pathMetaDict maps them to their metadata. The values must not be defined
+        by the parent directories, new or existing
+    """
+    result = self.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+
+    parentMeta = {}
+    fieldRows = {}
+    parameterRows = []
+    for path, metaDict in pathMetaDict.items():
+      definedMeta = set()
+      dirPath = path
+      parent = os.path.dirname( dirPath )
+      while parent != dirPath:
+        if not parent in newDirs:
+          if not parent in parentMeta:
+            result = self.getDirectoryMetadata( parent, credDict )
+            if not result['OK']:
+              return result
+            parentMeta[parent] = result['Value']
+          definedMeta.update( parentMeta[parent] )
+          break
+        definedMeta.update( pathMetaDict.get( parent, {} ) )
+        dirPath = parent
+        parent = os.path.dirname( dirPath )
+
+      dirID = newDirs[path]
+      for metaName, metaValue in metaDict.items():
+        if not metaName in metaFields:
+          parameterRows.append( "(%d,%s,%s)" % ( dirID, formatValue( metaName ), formatValue( str( metaValue ) ) ) )
+          continue
+        if metaName in definedMeta:
+          return S_ERROR( 'Metadata conflict detected for %s for directory %s' % ( metaName, path ) )
+        try:
+          fieldRows.setdefault( metaName, [] ).append( "(%d,%s)" % ( dirID, formatValue( metaValue, metaFields[metaName] ) ) )
+        except ( TypeError, ValueError ), x:
+          return S_ERROR( 'Illegal value of %s for directory %s: %s' % ( metaName, path, str( x ) ) )
+
+    for metaName, rows in fieldRows.items():
+      req = "INSERT INTO FC_Meta_%s (DirID,Value) VALUES %s" % ( metaName, ','.join( rows ) )
+      result = self.db._update( req, connection )
+      if not result['OK']:
+        return result
+    if parameterRows:
+      req = "INSERT INTO FC_DirMeta (DirID,MetaKey,MetaValue) VALUES %s" % ','.join( parameterRows )
+      result = self.db._update( req, connection )
+      if not result['OK']:
+        return result
+    return S_OK()
+
+  def indexNewDirectories( self, newDirs, pathMetaDict, credDict ):
+    """ Fill the effective metadata and the run index of the directories created
+        with setNewDirectoryMetadata once the transaction is committed
+    """
+    result = self.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+    paths = newDirs.keys()
+    paths.sort( key = lambda x: x.rstrip( '/' ).count( '/' ) )
+
+    if self.db.effectiveMetadata:
+      # The parents first inherit the values, then the new definitions override them
+      for path in paths:
+        result = self.inheritEffectiveMetadata( newDirs[path] )
+        if not result['OK']:
+          return result
+      for path in paths:
+        for metaName in pathMetaDict.get( path, {} ):
+          if metaName in metaFields:
+            result = self.__propagateEffectiveMetadata( metaName, newDirs[path] )
+            if not result['OK']:
+              return result
+
+    if self.db.runIndex:
+      runDirs = [ newDirs[path] for path in paths
+                  if self.db.runIndex.isIndexed( pathMetaDict.get( path, {} ), metaFields ) ]
+      if runDirs:
+        result = self.db.runIndex.update( 'D', runDirs )
+        if not result['OK']:
+          return result
     return S_OK()
 
   def removeMetadata( self, dpath, metadata, credDict ):
@@ -246,8 +464,10 @@ class DirectoryMetadata:
         # Indexed meta case
         req = "DELETE FROM FC_Meta_%s WHERE DirID=%d" % ( meta, dirID )
         result = self.db._update( req )
+        if result['OK'] and self.db.effectiveMetadata:
+          result = self.__withdrawEffectiveMetadata( meta, dirID )
         if not result['OK']:
-          failedMeta[meta] = result['Value']
+          failedMeta[meta] = result['Message']
       else:
         # Meta parameter case
         req = "DELETE FROM FC_DirMeta WHERE MetaKey='%s' AND DirID=%d" % ( meta, dirID )
@@ -255,6 +475,8 @@ class DirectoryMetadata:
         if not result['OK']:
           failedMeta[meta] = result['Value']
 
+    if self.db.runIndex and self.db.runIndex.isIndexed( metadata, metaFields ):
+      self.__updateRunIndex( dirID )
     if failedMeta:
       metaExample = failedMeta.keys()[0]
       result = S_ERROR( 'Failed to remove %d metadata, e.g. %s' % ( len( failedMeta ), failedMeta[metaExample] ) )
@@ -262,6 +484,21 @@ class DirectoryMetadata:
     else:
       return S_OK()
 
+  def __updateRunIndex( self, dirID ):
+    """ Keep the run range index in line with the run metadata of the directory
+    """
+    result = self.db.runIndex.update( 'D', [dirID] )
+    if not result['OK']:
+      gLogger.warn( 'Failed to update the run index', result['Message'] )
+
+  def __rebuildRunIndex( self, pname, credDict ):
+    """ The index changes completely when a run metadata field is added or removed
+    """
+    if self.db.runIndex and pname in [ self.db.runIndex.lowField, self.db.runIndex.highField ]:
+      result = self.db.runIndex.rebuild( credDict )
+      if not result['OK']:
+        gLogger.warn( 'Failed to rebuild the run index', result['Message'] )
+
   def setMetaParameter( self, dpath, metaName, metaValue, credDict ):
     """ Set an meta parameter - metadata which is not used in the the data
         search operations
@@ -318,10 +555,34 @@ class DirectoryMetadata:
 
     return S_OK( metaDict )
 
+  def __castMetaValue( self, value, metaType ):
+    """ Convert the value obtained as a string back to the type of the metadata field,
+        the declared MySQL type being classified as in the query compiler
+    """
+    if value is None:
+      return value
+    kind = getValueKind( metaType )
+    sqlType = ''.join( metaType.upper().split( '(' )[0].split()[:1] )
+    try:
+      if kind == 'int':
+        return int( value )
+      elif kind == 'float':
+        if sqlType in DECIMAL_TYPES:
+          return decimal.Decimal( value )
+        return float( value )
+      elif kind == 'date':
+        if sqlType == 'DATE':
+          return datetime.datetime.strptime( value, '%Y-%m-%d' ).date()
+        # Fractional seconds are only present for columns declared with them
+        return datetime.datetime.strptime( value.split( '.' )[0], '%Y-%m-%d %H:%M:%S' )
+    except ( ValueError, decimal.InvalidOperation ):
+      pass
+    return value
+
   def getDirectoryMetadata( self, path, credDict, inherited = True, owndata = True ):
     """ Get metadata for the given directory aggregating metadata for the directory itself
         and for all the parent directories if inherited flag is True. Get also the non-indexed
-        metadata parameters.
+        metadata parameters. All the values are obtained with a single query.
     """
 
     result = self.db.dtree.getPathIDs( path )
@@ -338,32 +599,52 @@ class DirectoryMetadata:
     metaOwnerDict = {}
     metaTypeDict = {}
     dirID = pathIDs[-1]
+    # Non-searchable parameters are taken along the whole path even without owndata
+    parameterIDs = pathIDs
     if not inherited:
       pathIDs = pathIDs[-1:]
+      parameterIDs = pathIDs
     if not owndata:
       pathIDs = pathIDs[:-1]
-    pathString = ','.join( [ str( x ) for x in pathIDs ] )
-    for meta in metaFields:
-      req = "SELECT Value,DirID FROM FC_Meta_%s WHERE DirID in (%s)" % ( meta, pathString )
-      result = self.db._query( req )
-      if not result['OK']:
-        return result
-      if len( result['Value'] ) > 1:
-        return S_ERROR( 'Metadata conflict for directory %s' % path )
-      if result['Value']:
-        metaDict[meta] = result['Value'][0][0]
-        if int( result['Value'][0][1] ) == dirID:
-          metaOwnerDict[meta] = 'OwnMetadata'
+
+    reqList = []
+    if pathIDs:
+      pathString = ','.join( [ str( x ) for x in pathIDs ] )
+      for meta in metaFields:
+        reqList.append( "SELECT 1,'%s',DirID,CAST(Value AS CHAR) FROM FC_Meta_%s WHERE DirID IN (%s)" %
+                        ( meta, meta, pathString ) )
+    parameterString = ','.join( [ str( x ) for x in parameterIDs ] )
+    reqList.append( "SELECT 0,MetaKey,DirID,MetaValue FROM FC_DirMeta WHERE DirID IN (%s)" % parameterString )
+    req = ' UNION ALL '.join( reqList )
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+
+    parameterDict = {}
+    for indexed, meta, dID, value in result['Value']:
+      if not indexed:
+        if meta in parameterDict:
+          if type( parameterDict[meta] ) != types.ListType:
+            parameterDict[meta] = [parameterDict[meta]]
+          parameterDict[meta].append( value )
         else:
-          metaOwnerDict[meta] = 'ParentMetadata'
+          parameterDict[meta] = value
+        continue
+      if meta in metaDict:
+        return S_ERROR( 'Metadata conflict for directory %s' % path )
+      metaDict[meta] = self.__castMetaValue( value, metaFields[meta] )
+      if int( dID ) == dirID:
+        metaOwnerDict[meta] = 'OwnMetadata'
+      else:
+        metaOwnerDict[meta] = 'ParentMetadata'
+
+    for meta in metaFields:
       metaTypeDict[meta] = metaFields[meta]
 
-    # Get also non-searchable data  
-    result = self.getDirectoryMetaParameters( path, credDict, inherited, owndata )
-    if result['OK']:
-      metaDict.update( result['Value'] )
-      for meta in result['Value']:
-        metaOwnerDict[meta] = 'OwnParameter'
+    # Non-searchable data
+    metaDict.update( parameterDict )
+    for meta in parameterDict:
+      metaOwnerDict[meta] = 'OwnParameter'
 
     result = S_OK( metaDict )
     result['MetadataOwner'] = metaOwnerDict
@@ -372,102 +653,244 @@ class DirectoryMetadata:
 
   def __transformMetaParameterToData( self, metaname ):
     """ Relocate the meta parameters of all the directories to the corresponding
-        indexed metadata table
+        indexed metadata table. The values set in a subdirectory of another
+        directory having the parameter are dropped. The rows are moved in DirID
+        order by chunks, each chunk being copied and then removed from
+        FC_DirMeta, so that an interrupted migration can be resumed. Returns
+        the number of moved rows
     """
 
-    req = "SELECT DirID,MetaValue from FC_DirMeta WHERE MetaKey='%s'" % metaname
+    req = "SELECT DirID FROM FC_DirMeta WHERE MetaKey=%s" % formatValue( metaname )
     result = self.db._query( req )
     if not result['OK']:
       return result
     if not result['Value']:
-      return S_OK()
+      return S_OK( 0 )
+    pendingIDs = set( [ row[0] for row in result['Value'] ] )
 
-    dirDict = {}
-    for dirID, meta in result['Value']:
-      dirDict[dirID] = meta
-    dirList = dirDict.keys()
+    # The directories moved by an interrupted migration still shadow their subdirectories
+    req = "SELECT DirID FROM FC_Meta_%s" % metaname
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    ownerIDs = pendingIDs.union( [ row[0] for row in result['Value'] ] )
 
     # Exclude child directories from the list
-    for dirID in dirList:
-      result = self.db.dtree.getSubdirectoriesByID( dirID )
+    result = self.db.dtree.getAllSubdirectoriesByID( list( ownerIDs ) )
+    if not result['OK']:
+      return result
+    excludedIDs = pendingIDs.intersection( result['Value'] )
+
+    total = len( pendingIDs )
+    gLogger.info( 'Moving %d values of %s to the indexed table, %d shadowed by a parent directory' % \
+                  ( total, metaname, len( excludedIDs ) ) )
+    moved = 0
+    lastID = 0
+    while True:
+      req = "SELECT DirID,MetaValue FROM FC_DirMeta WHERE MetaKey=%s AND DirID>%d ORDER BY DirID LIMIT %d" % \
+            ( formatValue( metaname ), lastID, MIGRATION_CHUNK_SIZE )
+      result = self.db._query( req )
       if not result['OK']:
         return result
       if not result['Value']:
-        continue
-      childIDs = result['Value'].keys()
-      for childID in childIDs:
-        if childID in dirList:
-          del dirList[dirList.index( childID )]
+        break
 
-    insertValueList = []
-    for dirID in dirList:
-      insertValueList.append( "( %d,'%s' )" % ( dirID, dirDict[dirID] ) )
+      insertValueList = [ "(%d,%s)" % ( dirID, formatValue( value ) ) for dirID, value in result['Value']
+                          if not dirID in excludedIDs ]
+      dirIDs = [ str( dirID ) for dirID, _value in result['Value'] ]
+      lastID = result['Value'][-1][0]
 
-    req = "INSERT INTO FC_Meta_%s (DirID,Value) VALUES %s" % ( metaname, ', '.join( insertValueList ) )
-    result = self.db._update( req )
-    if not result['OK']:
-      return result
+      if insertValueList:
+        req = "INSERT INTO FC_Meta_%s (DirID,Value) VALUES %s ON DUPLICATE KEY UPDATE Value=VALUES(Value)" % \
+              ( metaname, ','.join( insertValueList ) )
+        result = self.db._update( req )
+        if not result['OK']:
+          return result
+      req = "DELETE FROM FC_DirMeta WHERE MetaKey=%s AND DirID IN (%s)" % ( formatValue( metaname ),
+                                                                           ','.join( dirIDs ) )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
 
-    req = "DELETE FROM FC_DirMeta WHERE MetaKey='%s'" % metaname
-    result = self.db._update( req )
-    return result
+      moved += len( dirIDs )
+      gLogger.info( 'Moved %d/%d values of %s to the indexed table' % ( moved, total, metaname ) )
+
+    return S_OK( moved )
 
 ############################################################################################
 #
-# Find directories corresponding to the metadata 
+# Effective metadata: the value of each indexed field inherited by every directory,
+# optionally kept in the FC_EffMeta_<field> tables
 #
-############################################################################################  
+############################################################################################
 
-  def __createMetaSelection( self, meta, value, table = '' ):
-
-    if type( value ) == types.DictType:
-      selectList = []
-      for operation, operand in value.items():
-        if operation in ['>', '<', '>=', '<=']:
-          if type( operand ) == types.ListType:
-            return S_ERROR( 'Illegal query: list of values for comparison operation' )
-          if type( operand ) in [types.IntType, types.LongType]:
-            selectList.append( "%sValue%s%d" % ( table, operation, operand ) )
-          elif type( operand ) == types.FloatType:
-            selectList.append( "%sValue%s%f" % ( table, operation, operand ) )
-          else:
-            selectList.append( "%sValue%s'%s'" % ( table, operation, operand ) )
-        elif operation == 'in' or operation == "=":
-          if type( operand ) == types.ListType:
-            vString = ','.join( [ "'" + str( x ) + "'" for x in operand] )
-            selectList.append( "%sValue IN (%s)" % ( table, vString ) )
-          else:
-            selectList.append( "%sValue='%s'" % ( table, operand ) )
-        elif operation == 'nin' or operation == "!=":
-          if type( operand ) == types.ListType:
-            vString = ','.join( [ "'" + str( x ) + "'" for x in operand] )
-            selectList.append( "%sValue NOT IN (%s)" % ( table, vString ) )
-          else:
-            selectList.append( "%sValue!='%s'" % ( table, operand ) )
-        selectString = ' AND '.join( selectList )
-    elif type( value ) == types.ListType:
-      vString = ','.join( [ "'" + str( x ) + "'" for x in value] )
-      selectString = "%sValue in (%s)" % ( table, vString )
+  def __createEffectiveTable( self, meta, metaType ):
+    """ Create the effective metadata table for the given field if necessary
+    """
+    req = "CREATE TABLE IF NOT EXISTS FC_EffMeta_%s ( DirID INTEGER NOT NULL, Value %s, " % \
+                              ( meta, self.__getValueType( metaType ) )
+    req += "SrcDirID INTEGER NOT NULL, PRIMARY KEY (DirID), INDEX (Value), INDEX (SrcDirID) )"
+    return self.db._update( req )
+
+  def __propagateEffectiveMetadata( self, meta, dirID ):
+    """ Give the value of the meta datum defined in the directory dirID to the directory
+        itself and all its subdirectories. The subdirectories getting the value from a
+        closer definition keep it
+    """
+    result = self.db.dtree.getPathIDsByID( dirID )
+    if not result['OK']:
+      return result
+    ancestorString = ','.join( [ str( x ) for x in result['Value'] ] )
+
+    result = self.db.dtree.getAllSubdirectoriesByID( [dirID] )
+    if not result['OK']:
+      return result
+    dirList = [dirID] + result['Value']
+
+    table = 'FC_EffMeta_%s' % meta
+    treeTable = self.db.dtree.getTreeTable()
+    for i in range( 0, len( dirList ), EFFECTIVE_CHUNK_SIZE ):
+      dirString = ','.join( [ str( x ) for x in dirList[i:i + EFFECTIVE_CHUNK_SIZE] ] )
+      req = "INSERT INTO %s (DirID,Value,SrcDirID) SELECT D.DirID,M.Value,M.DirID " % table
+      req += "FROM FC_Meta_%s AS M, %s AS D WHERE M.DirID=%d AND D.DirID IN (%s) " % \
+                                                           ( meta, treeTable, dirID, dirString )
+      # Only overwrite values inherited from this directory or from its parents
+      req += "ON DUPLICATE KEY UPDATE %s.Value=IF(%s.SrcDirID IN (%s),VALUES(Value),%s.Value)," % \
+                                                               ( table, table, ancestorString, table )
+      req += "%s.SrcDirID=IF(%s.SrcDirID IN (%s),VALUES(SrcDirID),%s.SrcDirID)" % \
+                                                               ( table, table, ancestorString, table )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+
+    return S_OK()
+
+  def __withdrawEffectiveMetadata( self, meta, dirID ):
+    """ Remove the effective values inherited from the definition of the meta datum
+        in the directory dirID. They are replaced by a parent definition if any
+    """
+    result = self.db.dtree.getPathIDsByID( dirID )
+    if not result['OK']:
+      return result
+    parentIDs = result['Value'][:-1]
+
+    sourceID = 0
+    if parentIDs:
+      parentString = ','.join( [ str( x ) for x in parentIDs ] )
+      req = "SELECT DirID FROM FC_Meta_%s WHERE DirID IN (%s)" % ( meta, parentString )
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      definedIDs = [ row[0] for row in result['Value'] ]
+      # The closest definition wins
+      for parentID in parentIDs:
+        if parentID in definedIDs:
+          sourceID = parentID
+
+    if sourceID:
+      req = "UPDATE FC_EffMeta_%s AS E, FC_Meta_%s AS M SET E.Value=M.Value, E.SrcDirID=M.DirID " % ( meta, meta )
+      req += "WHERE M.DirID=%d AND E.SrcDirID=%d" % ( sourceID, dirID )
     else:
-      if value == "Any":
-        selectString = ''
+      req = "DELETE FROM FC_EffMeta_%s WHERE SrcDirID=%d" % ( meta, dirID )
+    return self.db._update( req )
+
+  def __rebuildEffectiveField( self, meta, metaType ):
+    """ Rebuild from scratch the effective values of the given field
+    """
+    result = self.__createEffectiveTable( meta, metaType )
+    if not result['OK']:
+      return result
+    result = self.db._update( "DELETE FROM FC_EffMeta_%s" % meta )
+    if not result['OK']:
+      return result
+
+    result = self.db._query( "SELECT DirID FROM FC_Meta_%s" % meta )
+    if not result['OK']:
+      return result
+    # The outcome does not depend on the order of the definitions
+    for row in result['Value']:
+      result = self.__propagateEffectiveMetadata( meta, row[0] )
+      if not result['OK']:
+        return result
+
+    return S_OK()
+
+  def inheritEffectiveMetadata( self, dirID ):
+    """ Give the newly created directory the effective metadata of its parent
+    """
+    if not self.db.effectiveMetadata:
+      return S_OK()
+
+    result = self.db.dtree.getParentID( dirID )
+    if not result['OK'] or not result['Value']:
+      # The root directory has nothing to inherit
+      return S_OK()
+    parentID = result['Value']
+
+    result = self.getMetadataFields( {} )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+    if not metaFields:
+      return S_OK()
+
+    # Find first in one go the fields the parent has got a value for
+    reqList = [ "SELECT '%s' FROM FC_EffMeta_%s WHERE DirID=%d" % ( meta, meta, parentID ) for meta in metaFields ]
+    result = self.db._query( ' UNION ALL '.join( reqList ) )
+    if not result['OK']:
+      return result
+
+    for row in result['Value']:
+      req = "INSERT INTO FC_EffMeta_%s (DirID,Value,SrcDirID) SELECT %d,Value,SrcDirID " % ( row[0], dirID )
+      req += "FROM FC_EffMeta_%s WHERE DirID=%d" % ( row[0], parentID )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+
+    return S_OK()
+
+  def rebuildEffectiveMetadata( self, credDict ):
+    """ Rebuild the effective metadata tables for all the fields
+    """
+    result = self.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+
+    failed = {}
+    successful = {}
+    for meta, metaType in result['Value'].items():
+      result = self.__rebuildEffectiveField( meta, metaType )
+      if not result['OK']:
+        failed[meta] = result['Message']
       else:
-        selectString = "%sValue='%s' " % ( table, value )
+        successful[meta] = 'OK'
 
-    return S_OK( selectString )
+    return S_OK( {'Successful':successful, 'Failed':failed} )
 
-  def __findSubdirByMeta( self, meta, value, pathSelection = '', subdirFlag = True ):
+############################################################################################
+#
+# Find directories corresponding to the metadata 
+#
+############################################################################################  
+
+  @profileStage
+  def __findSubdirByMeta( self, meta, value, pathSelection = '', subdirFlag = True, metaType = '' ):
     """ Find directories for the given meta datum. If the the meta datum type is a list,
         combine values in OR. In case the meta datum is 'Any', finds all the subdirectories
-        for which the meta datum is defined at all.
+        for which the meta datum is defined at all. The values are bound to the field type
     """
 
-    result = self.__createMetaSelection( meta, value, "M." )
+    result = createValueCondition( 'M.Value', value, metaType )
     if not result['OK']:
       return result
     selectString = result['Value']
 
-    req = " SELECT M.DirID FROM FC_Meta_%s AS M" % meta
+    table = 'FC_Meta_%s' % meta
+    if subdirFlag and self.db.effectiveMetadata:
+      # The inherited values are already there, no need to look for subdirectories
+      table = 'FC_EffMeta_%s' % meta
+      subdirFlag = False
+    req = " SELECT M.DirID FROM %s AS M" % table
     if pathSelection:
       req += " JOIN ( %s ) AS P WHERE M.DirID=P.DirID" % pathSelection
     if selectString:
@@ -499,6 +922,29 @@ class DirectoryMetadata:
 
     return S_OK( dirList )
 
+  @profileStage
+  def __findSubdirByRun( self, value, pathSelection = '' ):
+    """ Find directories with the run range satisfying the run query together
+        with all their subdirectories
+    """
+    result = self.db.runIndex.findIDs( 'D', value )
+    if not result['OK']:
+      return result
+    dirList = result['Value']
+    if not dirList:
+      return S_OK( [] )
+    result = self.db.dtree.getAllSubdirectoriesByID( dirList )
+    if not result['OK']:
+      return result
+    dirList += result['Value']
+    if pathSelection:
+      result = self.db._query( pathSelection )
+      if not result['OK']:
+        return result
+      dirList = ( IDSet( dirList ) & [ row[0] for row in result['Value'] ] ).toList()
+    return S_OK( dirList )
+
+  @profileStage
   def __findSubdirMissingMeta( self, meta, pathSelection ):
     """ Find directories not having the given meta datum defined
     """
@@ -518,7 +964,8 @@ class DirectoryMetadata:
     dirList = [ x[0] for x in result['Value'] ]
     return S_OK( dirList )
 
-  def __expandMetaDictionary( self, metaDict, credDict ):
+  @profileStage
+  def expandMetaDictionary( self, metaDict, credDict ):
     """ Expand the dictionary with metadata query 
     """
     result = self.getMetadataFields( credDict )
@@ -551,6 +998,7 @@ class DirectoryMetadata:
     return result
 
   @queryTime
+  @profileStage
   def findDirIDsByMetadata( self, queryDict, path, credDict ):
     """ Find Directories satisfying the given metadata and being subdirectories of 
         the given path
@@ -566,36 +1014,58 @@ class DirectoryMetadata:
         return S_ERROR( 'Path not found: %s' % path )
       pathDirID = int( result['Value'] )
 
-    result = self.__expandMetaDictionary( queryDict, credDict )
+    result = self.expandMetaDictionary( queryDict, credDict )
     if not result['OK']:
       return result
     metaDict = result['Value']
-    if metaDict:
+    extraDict = result['ExtraMetadata']
+    result = self.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+    runQuery = None
+    for key, value in extraDict.items():
+      if isRunQuery( key, value ):
+        if not self.db.runIndex:
+          return S_ERROR( 'Run range queries need the run index' )
+        result = self.db.runIndex.getIndexType( credDict )
+        if not result['OK']:
+          return result
+        if not result['Value']:
+          return S_ERROR( 'Run range metadata are not defined' )
+        if result['Value'] == 'D':
+          runQuery = value
+    if metaDict or runQuery:
       pathSelection = ''
       if pathDirID:
         result = self.db.dtree.getSubdirectoriesByID( pathDirID, includeParent = True, requestString = True )
         if not result['OK']:
           return result
         pathSelection = result['Value']
-      dirList = []
-      first = True
-      for meta, value in metaDict.items():
+      idLists = []
+      if runQuery:
+        result = self.__findSubdirByRun( runQuery, pathSelection )
+        if not result['OK']:
+          return result
+        idLists.append( result['Value'] )
+      metaItems = metaDict.items()
+      if self.db.metaStats:
+        # Most selective first, the evaluation stops at the first empty result
+        metaItems = self.db.metaStats.orderConstraints( 'D', metaDict )
+      for meta, value in metaItems:
         if value == "Missing":
           result = self.__findSubdirMissingMeta( meta, pathSelection )
         else:
-          result = self.__findSubdirByMeta( meta, value, pathSelection )
+          result = self.__findSubdirByMeta( meta, value, pathSelection, metaType = metaFields.get( meta, '' ) )
         if not result['OK']:
           return result
         mList = result['Value']
-        if first:
-          dirList = mList
-          first = False
-        else:
-          newList = []
-          for d in dirList:
-            if d in mList:
-              newList.append( d )
-          dirList = newList
+        if not mList:
+          # Nothing can satisfy the query, no need to evaluate the other fields
+          idLists = [ [] ]
+          break
+        idLists.append( mList )
+      dirList = intersectIDs( idLists ).toList()
     else:
       if pathDirID:
         result = self.db.dtree.getSubdirectoriesByID( pathDirID, includeParent = True )
@@ -605,11 +1075,11 @@ class DirectoryMetadata:
 
     finalList = []
     dirSelect = False
-    if metaDict:
+    if metaDict or runQuery:
       dirSelect = True
       finalList = dirList
       if pathDirList:
-        finalList = [ d for d in dirList if d in pathDirList ]
+        finalList = ( IDSet( dirList ) & pathDirList ).toList()
     else:
       if pathDirList:
         dirSelect = True
@@ -685,7 +1155,7 @@ class DirectoryMetadata:
 # metadata selectors 
 #
 ################################################################################################  
-  def __findCompatibleDirectories( self, meta, value, fromDirs ):
+  def __findCompatibleDirectories( self, meta, value, fromDirs, metaType = '' ):
     """ Find directories compatible with the given meta datum.
         Optionally limit the list of compatible directories to only those in the
         fromDirs list 
@@ -697,7 +1167,7 @@ class DirectoryMetadata:
     # - all the directories in the parent hierarchy of the above directory
 
     # Find directories defining the meta datum and their subdirectories
-    result = self.__findSubdirByMeta( meta, value, subdirFlag = False )
+    result = self.__findSubdirByMeta( meta, value, subdirFlag = False, metaType = metaType )
     if not result['OK']:
       return result
     selectedDirs = result['Value']
@@ -710,37 +1180,36 @@ class DirectoryMetadata:
     subDirs = result['Value']
 
     # Find parent directories of the directories defining the meta datum
+    result = self.db.dtree.getPathIDsByIDs( selectedDirs )
+    if not result['OK']:
+      return result
     parentDirs = []
-    for psub in selectedDirs:
-      result = self.db.dtree.getPathIDsByID( psub )
-      if not result['OK']:
-        return result
-      parentDirs += result['Value']
+    for pathIDs in result['Value'].values():
+      parentDirs += pathIDs
 
     # Constrain the output to only those that are present in the input list  
-    resDirs = parentDirs + subDirs + selectedDirs
+    resDirs = IDSet( parentDirs + subDirs + selectedDirs )
     if fromDirs:
-      resDirs = []
-      for dir_ in parentDirs + subDirs + selectedDirs:
-        if dir_ in fromDirs:
-          resDirs.append( dir_ )
+      resDirs = resDirs & fromDirs
 
-    return S_OK( resDirs )
+    return S_OK( resDirs.toList() )
 
   def __findDistinctMetadata( self, metaList, dList ):
     """ Find distinct metadata values defined for the list of the input directories.
-        Limit the search for only metadata in the input list
+        Limit the search for only metadata in the input list. The values of the
+        removed directories waiting for the tombstone sweep are left out
     """
 
+    conditions = []
     if dList:
-      dString = ','.join( [ str( x ) for x in dList ] )
-    else:
-      dString = None
+      conditions.append( "DirID in (%s)" % ','.join( [ str( x ) for x in dList ] ) )
+    if self.db.deferredMetadataCleanup:
+      conditions.append( "DirID NOT IN (SELECT DirID FROM FC_DirMetaTombstones)" )
     metaDict = {}
     for meta in metaList:
       req = "SELECT DISTINCT(Value) FROM FC_Meta_%s" % meta
-      if dString:
-        req += " WHERE DirID in (%s)" % dString
+      if conditions:
+        req += " WHERE %s" % ' AND '.join( conditions )
       result = self.db._query( req )
       if not result['OK']:
         return result
@@ -763,18 +1232,6 @@ class DirectoryMetadata:
       if not result['Value']:
         return S_ERROR( 'Path not found: %s' % path )
       pathDirID = int( result['Value'] )
-    pathDirs = []
-    if pathDirID:
-      result = self.db.dtree.getSubdirectoriesByID( pathDirID, includeParent = True )
-      if not result['OK']:
-        return result
-      if result['Value']:
-        pathDirs = result['Value'].keys()
-      result = self.db.dtree.getPathIDsByID( pathDirID )
-      if not result['OK']:
-        return result
-      if result['Value']:
-        pathDirs += result['Value']
 
     # Get the list of metadata fields to inspect
     result = self.getMetadataFields( credDict )
@@ -788,17 +1245,37 @@ class DirectoryMetadata:
     #  if m in comFields:
     #    del comFields[comFields.index( m )]
 
-    result = self.__expandMetaDictionary( queryDict, credDict )
+    result = self.expandMetaDictionary( queryDict, credDict )
     if not result['OK']:
       return result
     metaDict = result['Value']
 
+    if self.db.metadataFacets and self.__isFacetQuery( metaDict ):
+      result = self.__isFacetIndexValid()
+      if not result['OK']:
+        return result
+      if result['Value']:
+        return self.__getCompatibleMetadataFromFacets( metaDict, pathDirID, metaFields )
+
+    pathDirs = []
+    if pathDirID:
+      result = self.db.dtree.getSubdirectoriesByID( pathDirID, includeParent = True )
+      if not result['OK']:
+        return result
+      if result['Value']:
+        pathDirs = result['Value'].keys()
+      result = self.db.dtree.getPathIDsByID( pathDirID )
+      if not result['OK']:
+        return result
+      if result['Value']:
+        pathDirs += result['Value']
+
     fromList = pathDirs
     anyMeta = True
     if metaDict:
       anyMeta = False
       for meta, value in metaDict.items():
-        result = self.__findCompatibleDirectories( meta, value, fromList )
+        result = self.__findCompatibleDirectories( meta, value, fromList, metaFields.get( meta, '' ) )
         if not result['OK']:
           return result
         cdirList = result['Value']
@@ -814,31 +1291,272 @@ class DirectoryMetadata:
       result = S_OK( {} )
     return result
 
+  def __isFacetQuery( self, metaDict ):
+    """ Check that the query only contains simple values or lists of values
+        which can be looked up in the facet index
+    """
+    for value in metaDict.values():
+      if type( value ) == types.DictType:
+        if value.keys() not in [ ['='], ['in'] ]:
+          return False
+      elif value in ['Any', 'Missing']:
+        return False
+    return True
+
+  def __isFacetIndexValid( self ):
+    """ Check that the facet index was built from the current catalog contents,
+        that is at the current Catalog generation
+    """
+    req = "SELECT Generation FROM FC_Generations WHERE Name='MetaFacets'"
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      # Never built
+      return S_OK( False )
+    builtGeneration = result['Value'][0][0]
+    result = self.db.getGeneration( 'Catalog' )
+    if not result['OK']:
+      return result
+    return S_OK( result['Value'] == builtGeneration )
+
+  def __getCompatibleMetadataFromFacets( self, metaDict, pathDirID, metaFields ):
+    """ Get the metadata values compatible with the query together with the number
+        of files and events for each value with a single query of the facet index
+    """
+    tables = [ 'FC_MetaFacets AS G' ]
+    index = 0
+    for meta, value in metaDict.items():
+      index += 1
+      if type( value ) == types.DictType:
+        value = value.values()[0]
+      result = createValueCondition( 'C%d.Value' % index, value )
+      if not result['OK']:
+        return result
+      tables.append( "JOIN FC_MetaFacets AS C%d ON C%d.DirID=G.DirID AND C%d.MetaName='%s' AND %s" %
+                     ( index, index, index, meta, result['Value'] ) )
+    if pathDirID:
+      if isCompilerSupported( self.db ):
+        result = self.db.dtree.getSubdirectoriesByID( pathDirID, includeParent = True, requestString = True )
+        if not result['OK']:
+          return result
+        tables.append( 'JOIN ( %s ) AS P ON P.DirID=G.DirID' % result['Value'] )
+      else:
+        result = self.db.dtree.getSubdirectoriesByID( pathDirID, includeParent = True )
+        if not result['OK']:
+          return result
+        dirString = ','.join( [ str( x ) for x in [pathDirID] + result['Value'].keys() ] )
+        tables.append( 'JOIN %s AS P ON P.DirID=G.DirID AND P.DirID IN (%s)' %
+                       ( self.db.dtree.getTreeTable(), dirString ) )
+    tables.append( 'LEFT JOIN FC_MetaFacetCounts AS N ON N.DirID=G.DirID' )
+
+    req = "SELECT G.MetaName,G.Value,IFNULL(SUM(N.Files),0),IFNULL(SUM(N.Events),0) FROM %s" % ' '.join( tables )
+    req += " GROUP BY G.MetaName,G.Value"
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+
+    valueDict = {}
+    countDict = {}
+    for meta, value, files, events in result['Value']:
+      if not meta in metaFields:
+        continue
+      value = self.__castMetaValue( value, metaFields[meta] )
+      valueDict.setdefault( meta, [] )
+      valueDict[meta].append( value )
+      countDict.setdefault( meta, {} )
+      countDict[meta][value] = { 'Files' : int( files ), 'Events' : int( events ) }
+
+    result = S_OK( valueDict )
+    result['Counts'] = countDict
+    return result
+
+  def createFacetTables( self, suffix = '' ):
+    """ Create the tables of the facet index if they do not exist yet
+    """
+    req = "CREATE TABLE IF NOT EXISTS FC_MetaFacets%s ( MetaName VARCHAR(64) NOT NULL, " % suffix
+    req += "Value VARCHAR(128) NOT NULL, DirID INTEGER NOT NULL, PRIMARY KEY (MetaName,Value,DirID), "
+    req += "INDEX (DirID,MetaName) )"
+    result = self.db._update( req )
+    if not result['OK']:
+      return result
+    req = "CREATE TABLE IF NOT EXISTS FC_MetaFacetCounts%s ( DirID INTEGER NOT NULL, " % suffix
+    req += "Files INTEGER NOT NULL DEFAULT 0, Events BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (DirID) )"
+    return self.db._update( req )
+
+  def rebuildMetadataFacets( self, credDict ):
+    """ Rebuild the facet index used by getCompatibleMetadata from the effective
+        metadata tables. The new index replaces the old one in one go and is
+        used until the next change of the catalog
+    """
+    if not self.db.effectiveMetadata:
+      return S_ERROR( 'The facet index needs the effective metadata tables' )
+
+    result = self.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+    result = self.db.fmeta.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    eventField = self.db.facetEventField
+    if not eventField in result['Value']:
+      eventField = ''
+
+    # The changes made during the rebuild leave the new index outdated
+    result = self.db._query( "SELECT Generation FROM FC_Generations WHERE Name='Catalog'" )
+    if not result['OK']:
+      return result
+    generation = 0
+    if result['Value']:
+      generation = result['Value'][0][0]
+
+    for table in [ 'FC_MetaFacets_New', 'FC_MetaFacetCounts_New' ]:
+      result = self.db._update( "DROP TABLE IF EXISTS %s" % table )
+      if not result['OK']:
+        return result
+    result = self.createFacetTables( '_New' )
+    if not result['OK']:
+      return result
+
+    if eventField:
+      req = "INSERT INTO FC_MetaFacetCounts_New (DirID,Files,Events) SELECT F.DirID,COUNT(*),IFNULL(SUM(E.Value),0) "
+      req += "FROM FC_Files AS F LEFT JOIN FC_FileMeta_%s AS E ON E.FileID=F.FileID GROUP BY F.DirID" % eventField
+    else:
+      req = "INSERT INTO FC_MetaFacetCounts_New (DirID,Files) SELECT DirID,COUNT(*) FROM FC_Files GROUP BY DirID"
+    result = self.db._update( req )
+    if not result['OK']:
+      return result
+
+    for meta in metaFields:
+      req = "INSERT INTO FC_MetaFacets_New (MetaName,Value,DirID) "
+      req += "SELECT '%s',CAST(Value AS CHAR),DirID FROM FC_EffMeta_%s WHERE Value IS NOT NULL" % ( meta, meta )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+
+    for table in [ 'FC_MetaFacets', 'FC_MetaFacetCounts' ]:
+      req = "CREATE TABLE IF NOT EXISTS %s LIKE %s_New" % ( table, table )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+      result = self.db._update( "RENAME TABLE %s TO %s_Old, %s_New TO %s" % ( table, table, table, table ) )
+      if not result['OK']:
+        return result
+      result = self.db._update( "DROP TABLE %s_Old" % table )
+      if not result['OK']:
+        return result
+
+    req = "INSERT INTO FC_Generations (Name,Generation) VALUES ('MetaFacets',%d) " % generation
+    req += "ON DUPLICATE KEY UPDATE Generation=VALUES(Generation)"
+    return self.db._update( req )
+
   def removeMetadataForDirectory( self, dirList, credDict ):
-    """ Remove all the metadata for the given directory list
+    """ Remove all the metadata for the given directory list. The directories
+        are recorded in the FC_DirMetaTombstones table and their metadata is
+        removed from all the field tables at once, or later by
+        sweepMetadataTombstones if the cleanup is deferred. The fields left to
+        the sweep are listed under Deferred
     """
 
-    failed = {}
-    successful = {}
     dirs = dirList
     if type( dirList ) != types.ListType:
       dirs = [dirList]
 
-    dirListString = ','.join( [ str( d ) for d in dirs ] )
-
     # Get the list of metadata fields to inspect
     result = self.getMetadataFields( credDict )
     if not result['OK']:
       return result
     metaFields = result['Value']
+    if not dirs:
+      return S_OK( {'Successful':{}, 'Failed':{}, 'Deferred':[]} )
 
-    for meta in metaFields:
-      req = "DELETE FROM FC_Meta_%s WHERE DirID in ( %s )" % ( meta, dirListString )
-      result = self.db._query( req )
+    for i in range( 0, len( dirs ), CLEANUP_CHUNK_SIZE ):
+      req = "INSERT IGNORE INTO FC_DirMetaTombstones (DirID,RemovalDate) VALUES %s" % \
+            ','.join( [ '(%d,UTC_TIMESTAMP())' % int( d ) for d in dirs[i:i + CLEANUP_CHUNK_SIZE] ] )
+      result = self.db._update( req )
       if not result['OK']:
-        failed[meta] = result['Message']
-      else:
+        return result
+
+    if self.db.deferredMetadataCleanup:
+      return S_OK( {'Successful':{}, 'Failed':{}, 'Deferred':metaFields.keys()} )
+
+    failed = {}
+    successful = {}
+    for i in range( 0, len( dirs ), CLEANUP_CHUNK_SIZE ):
+      result = self.__cleanTombstones( dirs[i:i + CLEANUP_CHUNK_SIZE], metaFields )
+      if not result['OK']:
+        for meta in metaFields:
+          failed[meta] = result['Message']
+        break
+    else:
+      for meta in metaFields:
         successful[meta] = 'OK'
 
-    return S_OK( {'Successful':successful, 'Failed':failed} )
+    return S_OK( {'Successful':successful, 'Failed':failed, 'Deferred':[]} )
+
+  def __cleanTombstones( self, dirIDs, metaFields ):
+    """ Remove the metadata of the given tombstoned directories from all the
+        field tables with multi-table deletes and drop their tombstones, all
+        in one transaction
+    """
+    tables = [ 'FC_DirMeta' ]
+    for meta in metaFields:
+      tables.append( 'FC_Meta_%s' % meta )
+      if self.db.effectiveMetadata:
+        tables.append( 'FC_EffMeta_%s' % meta )
+    dirString = ','.join( [ str( d ) for d in dirIDs ] )
+
+    reqList = []
+    for i in range( 0, len( tables ), CLEANUP_TABLES ):
+      aliases = []
+      joins = []
+      for table in tables[i:i + CLEANUP_TABLES]:
+        alias = 'M%d' % len( aliases )
+        aliases.append( alias )
+        joins.append( 'LEFT JOIN %s AS %s ON %s.DirID=T.DirID' % ( table, alias, alias ) )
+      reqList.append( "DELETE %s FROM FC_DirMetaTombstones AS T %s WHERE T.DirID IN (%s)" %
+                      ( ','.join( aliases ), ' '.join( joins ), dirString ) )
+    if self.db.runIndex:
+      reqList.append( "DELETE FROM FC_RunIndex WHERE ObjType='D' AND ObjID IN (%s)" % dirString )
+    reqList.append( "DELETE FROM FC_DirMetaTombstones WHERE DirID IN (%s)" % dirString )
+
+    result = self.db._getConnection()
+    if not result['OK']:
+      return result
+    connection = result['Value']
+    result = self.db._update( 'START TRANSACTION', connection )
+    if not result['OK']:
+      return result
+    for req in reqList:
+      result = self.db._update( req, connection )
+      if not result['OK']:
+        self.db._update( 'ROLLBACK', connection )
+        return result
+    return self.db._update( 'COMMIT', connection )
+
+  def sweepMetadataTombstones( self, credDict ):
+    """ Remove the metadata left by the directories removed with a deferred
+        cleanup. Returns the number of cleaned directories
+    """
+    result = self.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+
+    swept = 0
+    while True:
+      req = "SELECT DirID FROM FC_DirMetaTombstones ORDER BY DirID LIMIT %d" % CLEANUP_CHUNK_SIZE
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      if not result['Value']:
+        break
+      dirIDs = [ row[0] for row in result['Value'] ]
+      result = self.__cleanTombstones( dirIDs, metaFields )
+      if not result['OK']:
+        return result
+      swept += len( dirIDs )
+      gLogger.info( 'Cleaned the metadata of %d removed directories' % swept )
 
+    return S_OK( swept )
@@ -10,7 +10,7 @@ __RCSID__ = "$Id:  $"
 
 import os, types
 from DIRAC import S_OK, S_ERROR
-from DIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase     import DirectoryTreeBase
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase     import DirectoryTreeBase
 
 class DirectoryNodeTree( DirectoryTreeBase ):
   """ Class managing Directory Tree as a self-linked structure with directory 
@@ -20,7 +20,7 @@ class DirectoryNodeTree( DirectoryTreeBase ):
     DirectoryTreeBase.__init__( self, database )
     self.treeTable = 'FC_DirectoryTreeM'
 
-  def findDir( self, path ):
+  def _findDir( self, path ):
     """ Find the identifier of a directory specified by its path
     """
     dpath = path
@@ -48,6 +48,7 @@ class DirectoryNodeTree( DirectoryTreeBase ):
   def makeDir( self, path ):
     """ Create a single directory
     """
+    self._dropCachedDir( path )
     result = self.findDir( path )
     if not result['OK']:
       return result
@@ -132,7 +133,7 @@ class DirectoryNodeTree( DirectoryTreeBase ):
 
     return S_OK( result['Value'][0][0] )
 
-  def getDirectoryPath( self, dirID ):
+  def _getDirectoryPath( self, dirID ):
     """ Get directory path by directory ID
     """
 
@@ -9,7 +9,8 @@ __RCSID__ = "$Id:  $"
 
 import os, types
 from DIRAC import S_OK, S_ERROR
-from DIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase     import DirectoryTreeBase
+from DIRAC.Core.Utilities.List import stringListToString
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryTreeBase     import DirectoryTreeBase
 
 class DirectorySimpleTree(DirectoryTreeBase):
   """ Class managing Directory Tree as a simple self-linked structure with full
@@ -20,7 +21,7 @@ class DirectorySimpleTree(DirectoryTreeBase):
     DirectoryTreeBase.__init__(self,database)
     self.treeTable = 'FC_DirectoryTree'
 
-  def findDir(self,path):
+  def _findDir(self,path):
     
     req = "SELECT DirID from FC_DirectoryTree WHERE DirName='%s'" % path
     result = self.db._query(req)
@@ -31,6 +32,18 @@ class DirectorySimpleTree(DirectoryTreeBase):
       return S_OK('')
     
     return S_OK(result['Value'][0][0])  
+
+  def _findDirs(self,paths,connection=False):
+    
+    req = "SELECT DirName,DirID from FC_DirectoryTree WHERE DirName IN (%s)" % stringListToString(paths)
+    result = self.db._query(req)
+    if not result['OK']:
+      return result
+    
+    dirDict = {}
+    for dirName,dirID in result['Value']:
+      dirDict[dirName] = (dirID,None)
+    return S_OK(dirDict)
   
   def removeDir(self,path):
     """ Remove directory
@@ -45,10 +58,12 @@ class DirectorySimpleTree(DirectoryTreeBase):
     dirID = result['Value']
     req = "DELETE FROM FC_DirectoryTree WHERE DirID=%d" % dirID
     result = self.db._update(req)
+    self._directoriesRemoved()
     return result
 
   def makeDir(self,path):
         
+    self._dropCachedDir(path)
     result = self.findDir(path)
     if not result['OK']:
       return result
@@ -96,7 +111,7 @@ class DirectorySimpleTree(DirectoryTreeBase):
     
     return S_OK(result['Value'][0][0])
   
-  def getDirectoryPath(self,dirID):
+  def _getDirectoryPath(self,dirID):
     """ Get directory name by directory ID
     """
     req = "SELECT DirName FROM FC_DirectoryTree WHERE DirID=%d" % int(dirID)
@@ -107,6 +122,20 @@ class DirectorySimpleTree(DirectoryTreeBase):
       return S_ERROR('Directory with id %d not found' % int(dirID) )
     
     return S_OK(result['Value'][0][0])
+
+  def _getDirs(self,dirIDs,connection=False):
+    """ Get the ( path, ParentID, Level ) of the given directories with one query
+    """
+    dirListString = ','.join( [ str(dir_) for dir_ in dirIDs ] )
+    req = "SELECT DirID,DirName,Parent FROM FC_DirectoryTree WHERE DirID IN (%s)" % dirListString
+    result = self.db._query(req,connection)
+    if not result['OK']:
+      return result
+
+    dirDict = {}
+    for dirID,dirName,parentID in result['Value']:
+      dirDict[dirID] = (dirName,parentID,len( [ x for x in dirName.split('/') if x ] ))
+    return S_OK(dirDict)
   
   def getDirectoryName(self,dirID):
     """ Get directory name by directory ID
@@ -7,12 +7,19 @@ __RCSID__ = "$Id$"
 
 from DIRAC.DataManagementSystem.DB.FileCatalogComponents.Utilities  import checkArgumentFormat
 from DIRAC                                                          import S_OK, S_ERROR, gLogger
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.QueryProfiler import profileStage
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.CatalogCache import LRUCache
 import time, threading, os
 from types import StringTypes, ListType
 import stat
 
 DEBUG = 0
 
+# Number of paths resolved by one bulk directory lookup
+FIND_DIRS_CHUNK_SIZE = 1000
+# Number of DirIDs resolved by one bulk directory lookup
+GET_DIRS_CHUNK_SIZE = 1000
+
 #############################################################################
 class DirectoryTreeBase:
 
@@ -20,6 +27,8 @@ class DirectoryTreeBase:
     self.db = database
     self.lock = threading.Lock()
     self.treeTable = ''
+    self.dirCache = None
+    self.idCache = None
 
   def _getConnection( self, connection ):
     if connection:
@@ -44,18 +53,269 @@ class DirectoryTreeBase:
   def removeDir( self, path ):    
     return S_ERROR( 'Should be implemented in a derived class' )
   
-  def findDir( self, path ):    
+  def _findDir( self, path ):    
     return S_ERROR( 'Should be implemented in a derived class' )
   
   def getChildren( self, path ):    
     return S_ERROR( 'Should be implemented in a derived class' )
     
-  def getDirectoryPath( self, path ):    
+  def _getDirectoryPath( self, dirID ):    
     return S_ERROR( 'Should be implemented in a derived class' )  
 
   def getSubdirectoriesByID( self, path, requestString, includeParent ):    
     return S_ERROR( 'Should be implemented in a derived class' )  
 
+#####################################################################
+#
+#  Path lookup cache
+#
+  def setDirectoryCache( self, size ):
+    """ Keep up to size path -> ( DirID, Level ) lookups and as many
+        DirID -> ( path, ParentID, Level ) lookups in memory, 0 disables the caches
+    """
+    self.dirCache = None
+    self.idCache = None
+    if size:
+      self.dirCache = LRUCache( size )
+      self.idCache = LRUCache( size )
+
+  def findDir( self, path, connection = False ):
+    """ Find the directory ID for the given path. The lookups are kept in the path
+        cache, valid for the current DirectoryTree generation. Missing directories
+        are not cached, they can be created by another service instance at any time
+    """
+    if self.dirCache is None:
+      return self.__findDirInDB( path, connection )
+
+    result = self.db.getGeneration( 'DirectoryTree' )
+    if not result['OK']:
+      return self.__findDirInDB( path, connection )
+    generation = result['Value']
+    entry = self.__getCachedDir( path, generation )
+    if entry is not None:
+      dirID, level = entry
+      result = S_OK( dirID )
+      if level is not None:
+        result['Level'] = level
+      return result
+
+    result = self.__findDirInDB( path, connection )
+    if result['OK'] and result['Value']:
+      self.__cacheDir( path, result['Value'], result.get( 'Level' ), generation )
+    return result
+
+  def findDirs( self, paths, connection = False ):
+    """ Find the directory IDs of many paths at once. The paths missing in the path
+        cache are looked up in the database by chunks of FIND_DIRS_CHUNK_SIZE. The
+        result maps the found paths to their DirIDs, the missing paths are left out
+    """
+    generation = None
+    if self.dirCache is not None:
+      result = self.db.getGeneration( 'DirectoryTree' )
+      if result['OK']:
+        generation = result['Value']
+
+    dirDict = {}
+    toFind = []
+    for path in paths:
+      if generation is not None:
+        entry = self.__getCachedDir( path, generation )
+        if entry is not None:
+          dirDict[path] = entry[0]
+          continue
+      toFind.append( path )
+
+    for i in range( 0, len( toFind ), FIND_DIRS_CHUNK_SIZE ):
+      chunk = toFind[i:i + FIND_DIRS_CHUNK_SIZE]
+      result = self._findDirs( chunk, connection )
+      if not result['OK']:
+        return result
+      for path in chunk:
+        dirID, level = result['Value'].get( path, ( 0, None ) )
+        if dirID:
+          dirDict[path] = dirID
+          if generation is not None:
+            self.__cacheDir( path, dirID, level, generation )
+    return S_OK( dirDict )
+
+  def _findDirs( self, paths, connection = False ):
+    """ Get the ( DirID, Level ) of the given paths found in the database. Trees
+        without a bulk lookup fall back to one query per path
+    """
+    dirDict = {}
+    for path in paths:
+      result = self.__findDirInDB( path, connection )
+      if not result['OK']:
+        return result
+      if result['Value']:
+        dirDict[path] = ( result['Value'], result.get( 'Level' ) )
+    return S_OK( dirDict )
+
+  def __findDirInDB( self, path, connection ):
+    if connection:
+      return self._findDir( path, connection )
+    return self._findDir( path )
+
+  def __getCachedDir( self, path, generation ):
+    """ Get the valid ( DirID, Level ) cache entry of the path, None if there is none
+    """
+    entry = self.dirCache.get( os.path.normpath( path ) )
+    if entry is None:
+      return None
+    dirID, level, entryGeneration = entry
+    if entryGeneration != generation:
+      return None
+    return ( dirID, level )
+
+  def __cacheDir( self, path, dirID, level, generation ):
+    self.dirCache.put( os.path.normpath( path ), ( dirID, level, generation ), 1 )
+
+  def _dropCachedDir( self, path ):
+    """ Forget the cached lookup of a directory about to be created
+    """
+    if self.dirCache is not None:
+      self.dirCache.remove( os.path.normpath( path ) )
+
+  def _directoriesRemoved( self ):
+    """ Invalidate the path caches of all the service instances after directories
+        were removed or got a new DirID
+    """
+    if self.dirCache is None:
+      return
+    result = self.db.bumpGeneration( 'DirectoryTree' )
+    if not result['OK']:
+      gLogger.warn( 'Failed to update the DirectoryTree generation', result['Message'] )
+      self.dirCache.clear()
+      self.idCache.clear()
+
+  def getDirectoryCacheStatistics( self ):
+    """ Get the usage statistics of the path cache
+    """
+    if self.dirCache is None:
+      return S_ERROR( 'Directory path cache is disabled' )
+    statDict = self.dirCache.getStatistics()
+    statDict['IDCache'] = self.idCache.getStatistics()
+    for sDict in [ statDict, statDict['IDCache'] ]:
+      lookups = sDict['Hits'] + sDict['Misses']
+      sDict['HitRate'] = 0.
+      if lookups:
+        sDict['HitRate'] = float( sDict['Hits'] ) / lookups
+    return S_OK( statDict )
+
+  def getDirs( self, dirIDs, connection = False ):
+    """ Get the ( path, ParentID, Level ) of many directories at once. The DirIDs
+        missing in the DirID cache are looked up in the database by chunks of
+        GET_DIRS_CHUNK_SIZE. The result maps the found DirIDs to their tuples
+    """
+    generation = None
+    if self.idCache is not None:
+      result = self.db.getGeneration( 'DirectoryTree' )
+      if result['OK']:
+        generation = result['Value']
+
+    dirDict = {}
+    toGet = []
+    for dirID in set( dirIDs ):
+      if generation is not None:
+        entry = self.idCache.get( dirID )
+        if entry is not None and entry[3] == generation:
+          dirDict[dirID] = entry[:3]
+          continue
+      toGet.append( dirID )
+
+    for i in range( 0, len( toGet ), GET_DIRS_CHUNK_SIZE ):
+      result = self._getDirs( toGet[i:i + GET_DIRS_CHUNK_SIZE], connection )
+      if not result['OK']:
+        return result
+      for dirID, dirTuple in result['Value'].items():
+        dirDict[dirID] = dirTuple
+        if generation is not None:
+          self.idCache.put( dirID, dirTuple + ( generation, ), 1 )
+    return S_OK( dirDict )
+
+  def _getDirs( self, dirIDs, connection = False ):
+    """ Get the ( path, ParentID, Level ) of the given DirIDs found in the database.
+        Trees without a bulk lookup fall back to two queries per directory
+    """
+    dirDict = {}
+    for dirID in dirIDs:
+      result = self._getDirectoryPath( dirID )
+      if not result['OK']:
+        continue
+      path = result['Value']
+      parentID = 0
+      if path != '/':
+        result = self.getParentID( dirID )
+        if not result['OK']:
+          return result
+        parentID = result['Value']
+      dirDict[dirID] = ( path, parentID, len( [ x for x in path.split( '/' ) if x ] ) )
+    return S_OK( dirDict )
+
+  def getDirectoryPath( self, dirID ):
+    """ Get directory path by directory ID
+    """
+    result = self.getDirs( [dirID] )
+    if not result['OK']:
+      return result
+    if not dirID in result['Value']:
+      return S_ERROR( 'Directory with id %d not found' % int( dirID ) )
+    return S_OK( result['Value'][dirID][0] )
+
+  def getDirectoryPaths( self, dirIDList ):
+    """ Get directory paths by directory ID list
+    """
+    dirs = dirIDList
+    if type( dirIDList ) != ListType:
+      dirs = [dirIDList]
+    result = self.getDirs( dirs )
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_ERROR( 'Directories not found: %s' % ','.join( [ str( dir_ ) for dir_ in dirs ] ) )
+
+    resultDict = {}
+    for dirID, dirTuple in result['Value'].items():
+      resultDict[int( dirID )] = dirTuple[0]
+    return S_OK( resultDict )
+
+  def getPathIDsByIDs( self, dirIDs ):
+    """ Get the IDs of all the directories in the parent hierarchy of many
+        directories, from the top directory to the directory itself. The paths
+        of the directories and then the IDs of all their ancestors are resolved
+        with one bulk lookup each
+    """
+    result = self.getDirs( dirIDs )
+    if not result['OK']:
+      return result
+    dirDict = result['Value']
+    missing = [ str( dirID ) for dirID in dirIDs if not dirID in dirDict ]
+    if missing:
+      return S_ERROR( 'Directories not found: %s' % ','.join( missing ) )
+
+    ancestorDict = {}
+    for dirID, dirTuple in dirDict.items():
+      ancestors = ['/']
+      dirPath = ''
+      for element in [ x for x in dirTuple[0].split( '/' ) if x ][:-1]:
+        dirPath += '/' + element
+        ancestors.append( dirPath )
+      ancestorDict[dirID] = ancestors
+    allAncestors = set()
+    for ancestors in ancestorDict.values():
+      allAncestors.update( ancestors )
+    result = self.findDirs( list( allAncestors ) )
+    if not result['OK']:
+      return result
+    ancestorIDs = result['Value']
+
+    pathIDDict = {}
+    for dirID, ancestors in ancestorDict.items():
+      pathIDs = [ ancestorIDs[path] for path in ancestors if path in ancestorIDs and ancestorIDs[path] != dirID ]
+      pathIDDict[dirID] = pathIDs + [dirID]
+    return S_OK( pathIDDict )
+
+#####################################################################
   def makeDirectory(self,path,credDict,status=0):
     """Create a new directory. The return value is the dictionary
        containing all the parameters of the newly created directory
@@ -89,6 +349,9 @@ class DirectoryTreeBase:
         resGet = self.getDirectoryParameters( dirID )
         if resGet['OK']:
           dirDict = resGet['Value']
+        resMeta = self.db.dmeta.inheritEffectiveMetadata( dirID )
+        if not resMeta['OK']:
+          gLogger.warn( 'Failed to set the inherited metadata of %s' % path, resMeta['Message'] )
     else:
       return S_OK( dirID )
 
@@ -97,6 +360,126 @@ class DirectoryTreeBase:
       return S_ERROR( 'Failed to create directory %s' % path )
     return S_OK( dirID )
 
+#####################################################################
+  def makeDirectoryTree( self, paths, metaDict, credDict ):
+    """ Create the given directories with all their missing parents and set the
+        directory metadata of metaDict { path : { meta : value } }. The new
+        directories and their metadata are inserted in one transaction, the
+        existing directories only get the metadata values they do not have yet.
+        Returns the DirIDs of the paths
+    """
+    pathMetaDict = {}
+    for path, dirMeta in metaDict.items():
+      pathMetaDict[os.path.normpath( path )] = dirMeta
+    allPaths = set()
+    for path in list( paths ) + metaDict.keys():
+      if not path.startswith( '/' ):
+        return S_ERROR( 'Not an absolute path: %s' % path )
+      dirPath = os.path.normpath( path )
+      while not dirPath in allPaths:
+        allPaths.add( dirPath )
+        dirPath = os.path.dirname( dirPath )
+
+    result = self.findDirs( list( allPaths ) )
+    if not result['OK']:
+      return result
+    dirIDs = result['Value']
+    toMake = [ path for path in allPaths if not path in dirIDs ]
+    toMake.sort( key = lambda x: ( x.rstrip( '/' ).count( '/' ), x ) )
+
+    newDirs = {}
+    if toMake:
+      newMeta = {}
+      for path in toMake:
+        if path in pathMetaDict:
+          newMeta[path] = pathMetaDict[path]
+      result = self.db._getConnection()
+      if not result['OK']:
+        return result
+      connection = result['Value']
+      result = self.db._update( 'START TRANSACTION', connection )
+      if not result['OK']:
+        return result
+      result = self.__insertDirectoryTree( toMake, newMeta, credDict, connection )
+      if not result['OK']:
+        self.db._update( 'ROLLBACK', connection )
+        return result
+      newDirs = result['Value']
+      result = self.db._update( 'COMMIT', connection )
+      if not result['OK']:
+        return result
+      for path in toMake:
+        self._dropCachedDir( path )
+      dirIDs.update( newDirs )
+
+      result = self.db.dmeta.indexNewDirectories( newDirs, newMeta, credDict )
+      if not result['OK']:
+        gLogger.warn( 'Failed to index the metadata of the new directories', result['Message'] )
+
+    failed = {}
+    for path, dirMeta in pathMetaDict.items():
+      if path in newDirs:
+        continue
+      result = self.db.dmeta.getDirectoryMetadata( path, credDict, inherited = False )
+      if not result['OK']:
+        failed[path] = result['Message']
+        continue
+      ownMeta = result['Value']
+      toSet = {}
+      for meta, value in dirMeta.items():
+        if not meta in ownMeta or str( ownMeta[meta] ) != str( value ):
+          toSet[meta] = value
+      if toSet:
+        result = self.db.dmeta.setMetadata( path, toSet, credDict )
+        if not result['OK']:
+          failed[path] = result['Message']
+
+    successful = {}
+    for path in paths:
+      if not os.path.normpath( path ) in failed:
+        successful[path] = dirIDs[os.path.normpath( path )]
+    return S_OK( {'Successful':successful, 'Failed':failed} )
+
+  def __insertDirectoryTree( self, paths, pathMetaDict, credDict, connection ):
+    """ Insert the new directories sorted by level, their parameters and metadata
+    """
+    result = self.db.ugManager.getUserAndGroupID( credDict )
+    if not result['OK']:
+      return result
+    uid, gid = result['Value']
+
+    result = self._makeDirs( paths, connection )
+    if not result['OK']:
+      return result
+    newDirs = result['Value']
+    if not newDirs:
+      return S_OK( newDirs )
+
+    rows = []
+    for path, dirID in newDirs.items():
+      if path == '/':
+        rows.append( "(%d,0,0,UTC_TIMESTAMP(),UTC_TIMESTAMP(),%d,0)" % ( dirID, self.db.umask ) )
+      else:
+        rows.append( "(%d,%d,%d,UTC_TIMESTAMP(),UTC_TIMESTAMP(),%d,0)" % ( dirID, uid, gid, self.db.umask ) )
+    req = "INSERT INTO FC_DirectoryInfo (DirID,UID,GID,CreationDate,ModificationDate,Mode,Status) VALUES %s" % \
+          ','.join( rows )
+    result = self.db._update( req, connection )
+    if not result['OK']:
+      return result
+
+    if pathMetaDict:
+      result = self.db.dmeta.setNewDirectoryMetadata( newDirs, pathMetaDict, credDict, connection )
+      if not result['OK']:
+        return result
+    return S_OK( newDirs )
+
+  def _makeDirs( self, paths, connection = False ):
+    """ Insert the given new directories sorted by level within the transaction
+        of the connection. Returns their DirIDs. To be implemented by the trees
+        supporting makeDirectoryTree
+    """
+    return S_ERROR( 'Bulk directory creation is not supported by %s' % self.__class__.__name__ )
+
 #####################################################################
   def makeDirectories( self, path, credDict ):
     """Make all the directories recursively in the path. The return value
@@ -133,14 +516,12 @@ class DirectoryTreeBase:
   def exists( self, lfns ):
     successful = {}
     failed = {}
+    res = self.findDirs( lfns )
     for lfn in lfns:
-      res = self.findDir( lfn )
       if not res['OK']:
         failed[lfn] = res['Message']
-      if not res['Value']:
-        successful[lfn] = False
       else:
-        successful[lfn] = True
+        successful[lfn] = lfn in res['Value']
     return S_OK( {'Successful':successful, 'Failed':failed} )
 
   def existsDir( self, path ):
@@ -165,14 +546,12 @@ class DirectoryTreeBase:
     dirs = paths.keys()
     successful = {}
     failed = {}
+    result = self.findDirs( dirs )
     for dir_ in dirs:
-      result = self.existsDir( dir_ )
       if not result['OK']:
         failed[dir_] = result['Message']
-      elif result['Value']['Exists']:
-        successful[dir_] = True
-      else: 
-        successful[dir_] = False  
+      else:
+        successful[dir_] = dir_ in result['Value']
           
     return S_OK({'Successful':successful,'Failed':failed})
   
@@ -446,19 +825,70 @@ class DirectoryTreeBase:
     return self.__setDirectoryParameter( path, 'Status', status )
 
   def getPathPermissions( self, lfns, credDict ):
-    """ Get permissions for the given user/group to manipulate the given lfns 
+    """ Get permissions for the given user/group to manipulate the given lfns.
+        The paths not in the catalog get the permissions of their nearest existing
+        parent, the paths and all their parents are resolved together
     """
-    successful = {}
-    failed = {}
+    result = self.db.ugManager.getUserAndGroupID( credDict )
+    if not result['OK']:
+      return result
+    uid, gid = result['Value']
+
+    pathChains = {}
+    allPaths = set()
     for path in lfns:
-      result = self.getDirectoryPermissions( path, credDict )
+      chain = [ path ]
+      parent = os.path.dirname( path )
+      while parent and parent != chain[-1]:
+        chain.append( parent )
+        parent = os.path.dirname( parent )
+      pathChains[path] = chain
+      allPaths.update( chain )
+
+    result = self.findDirs( list( allPaths ) )
+    if not result['OK']:
+      return result
+    dirIDs = result['Value']
+    modeDict = {}
+    idList = list( set( dirIDs.values() ) )
+    for i in range( 0, len( idList ), FIND_DIRS_CHUNK_SIZE ):
+      idString = ','.join( [ str( dirID ) for dirID in idList[i:i + FIND_DIRS_CHUNK_SIZE] ] )
+      req = "SELECT DirID,UID,GID,Mode FROM FC_DirectoryInfo WHERE DirID IN (%s)" % idString
+      result = self.db._query( req )
       if not result['OK']:
-        failed[path] = result['Message']
+        return result
+      for dirID, dUid, dGid, mode in result['Value']:
+        modeDict[dirID] = ( dUid, dGid, mode )
+
+    successful = {}
+    failed = {}
+    for path, chain in pathChains.items():
+      for dirPath in chain:
+        dirID = dirIDs.get( dirPath )
+        if dirID in modeDict:
+          dUid, dGid, mode = modeDict[dirID]
+          successful[path] = self.__getPermissions( uid, gid, dUid, dGid, mode )
+          break
       else:
-        successful[path] = result['Value']
+        failed[path] = 'Directory not found'
 
     return S_OK( {'Successful':successful, 'Failed':failed} )
 
+  def __getPermissions( self, uid, gid, dUid, dGid, mode ):
+    """ Get the permissions of the user/group on a directory with the given owner and mode
+    """
+    owner = uid == dUid
+    group = gid == dGid
+
+    resultDict = {}
+    if self.db.globalReadAccess:
+      resultDict['Read'] = True
+    else:
+      resultDict['Read'] = ( owner and mode & stat.S_IRUSR > 0 ) or ( group and mode & stat.S_IRGRP > 0 ) or mode & stat.S_IROTH > 0
+    resultDict['Write'] = ( owner and mode & stat.S_IWUSR > 0 ) or ( group and mode & stat.S_IWGRP > 0 ) or mode & stat.S_IWOTH > 0
+    resultDict['Execute'] = ( owner and mode & stat.S_IXUSR > 0 ) or ( group and mode & stat.S_IXGRP > 0 ) or mode & stat.S_IXOTH > 0
+    return resultDict
+
   #####################################################################
   def getDirectoryPermissions( self, path, credDict ):
     """ Get permissions for the given user/group to manipulate the given directory 
@@ -482,17 +912,7 @@ class DirectoryTreeBase:
     dGid = result['Value']['GID']
     mode = result['Value']['Mode']
 
-    owner = uid == dUid
-    group = gid == dGid
-
-    resultDict = {}
-    if self.db.globalReadAccess:
-      resultDict['Read'] = True
-    else:
-      resultDict['Read'] = ( owner and mode & stat.S_IRUSR > 0 ) or ( group and mode & stat.S_IRGRP > 0 ) or mode & stat.S_IROTH > 0
-    resultDict['Write'] = ( owner and mode & stat.S_IWUSR > 0 ) or ( group and mode & stat.S_IWGRP > 0 ) or mode & stat.S_IWOTH > 0
-    resultDict['Execute'] = ( owner and mode & stat.S_IXUSR > 0 ) or ( group and mode & stat.S_IXGRP > 0 ) or mode & stat.S_IXOTH > 0
-    return S_OK( resultDict )
+    return S_OK( self.__getPermissions( uid, gid, dUid, dGid, mode ) )
 
   def getFileIDsInDirectory( self, dirID, credDict, startItem = 1, maxItems = 25 ):
     """ Get file IDs for the given directory
@@ -527,6 +947,7 @@ class DirectoryTreeBase:
     return result
 
 
+  @profileStage
   def getFilesInDirectory( self, dirID, credDict ):
     """ Get file IDs for the given directory
     """
@@ -539,6 +960,7 @@ class DirectoryTreeBase:
     result = self.db._query( req )
     return result
 
+  @profileStage
   def getFileLFNsInDirectory( self, dirID, credDict ):
     """ Get file lfns for the given directory or directory list 
     """
@@ -556,6 +978,7 @@ class DirectoryTreeBase:
     lfnList = [ x[0] for x in result['Value'] ]
     return S_OK( lfnList )
 
+  @profileStage
   def getFileLFNsInDirectoryByDirectory( self, dirID, credDict ):
     """ Get file lfns for the given directory or directory list 
     """
@@ -593,11 +1016,16 @@ class DirectoryTreeBase:
 
     # Get subdirectories
     dirIDList = result['Value']
-    for dirID in dirIDList:
-      result = self.getDirectoryPath( dirID )
+    dirNameDict = {}
+    if dirIDList:
+      result = self.getDirectoryPaths( dirIDList )
       if not result['OK']:
         return result
-      dirName = result['Value']
+      dirNameDict = result['Value']
+    for dirID in dirIDList:
+      if not dirID in dirNameDict:
+        return S_ERROR( 'Directory with id %d not found' % int( dirID ) )
+      dirName = dirNameDict[dirID]
       if details:
         result = self.getDirectoryParameters( dirID )
         if not result['OK']:
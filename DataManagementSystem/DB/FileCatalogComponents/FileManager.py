@@ -5,7 +5,7 @@
 __RCSID__ = "$Id$"
 
 from DIRAC                                                                import S_OK, S_ERROR, gLogger
-from DIRAC.DataManagementSystem.DB.FileCatalogComponents.FileManagerBase  import FileManagerBase
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.FileManagerBase import FileManagerBase
 from DIRAC.Core.Utilities.List                                            import stringListToString, intListToString
 
 DEBUG = 0
@@ -26,16 +26,16 @@ class FileManager(FileManagerBase):
     dirDict = self._getFileDirectories(lfns)
     failed = {}
     directoryIDs = {}
+    res = self.db.dtree.findDirs(dirDict.keys())
     for dirPath in dirDict:
-      res = self.db.dtree.findDir(dirPath)
-      if (not res['OK']) or (not res['Value']):
+      if (not res['OK']) or (not dirPath in res['Value']):
         error = res.get('Message','No such file or directory')
         for fileName in dirDict[dirPath]:
           fname = '%s/%s' % (dirPath,fileName)
           fname = fname.replace('//','/')
           failed[fname] = error
       else:
-        directoryIDs[dirPath] = res['Value']
+        directoryIDs[dirPath] = res['Value'][dirPath]
     successful = {}
     for dirPath in directoryIDs:
       fileNames = dirDict[dirPath]
@@ -141,19 +141,27 @@ class FileManagerBase:
     return S_ERROR( "To be implemented on derived class" )
 
   def _getFileLFNs(self,fileIDs):
-    """ Get the file LFNs for a given list of file IDs
+    """ Get the file LFNs for a given list of file IDs. The directory paths are
+        resolved in bulk through the directory cache
     """
     stringIDs = intListToString(fileIDs)
-    treeTable = self.db.dtree.getTreeTable()
-
-    req = "SELECT F.FileID, CONCAT(D.DirName,'/',F.FileName) from FC_Files as F, %s as D WHERE F.FileID IN ( %s ) AND F.DirID=D.DirID" % (treeTable,stringIDs)
+    req = "SELECT FileID, DirID, FileName from FC_Files WHERE FileID IN ( %s )" % stringIDs
     result = self.db._query(req)
     if not result['OK']:
       return result
+    rows = result['Value']
+
+    dirPathDict = {}
+    if rows:
+      result = self.db.dtree.getDirs( [ row[1] for row in rows ] )
+      if not result['OK']:
+        return result
+      dirPathDict = result['Value']
 
     fileNameDict = {}
-    for row in result['Value']:
-      fileNameDict[row[0]] = row[1]
+    for fileID,dirID,fileName in rows:
+      if dirID in dirPathDict:
+        fileNameDict[fileID] = '%s/%s' % (dirPathDict[dirID][0],fileName)
     
     failed = {}
     successful = fileNameDict
@@ -344,11 +352,12 @@ class FileManagerBase:
 
   def _updateDirectoryUsage( self, directorySEDict, change, connection = False ):
     connection = self._getConnection( connection )
+    result = self.db.dtree.getPathIDsByIDs( directorySEDict.keys() )
+    if not result['OK']:
+      return result
+    pathIDDict = result['Value']
     for directoryID in directorySEDict.keys():
-      result = self.db.dtree.getPathIDsByID( directoryID )
-      if not result['OK']:
-        return result
-      parentIDs = result['Value']
+      parentIDs = pathIDDict[directoryID]
       dirDict = directorySEDict[directoryID]
       for seID in dirDict.keys() :
         seDict = dirDict[seID]
@@ -667,6 +676,10 @@ class FileManagerBase:
     else:
       # Update the directory usage
       self._updateDirectoryUsage( directorySESizeDict, '-', connection = connection )
+      if self.db.runIndex:
+        res = self.db.runIndex.remove( 'F', fileIDLfns.keys() )
+        if not res['OK']:
+          gLogger.warn( "Failed to remove files from the run index", res['Message'] )
       for lfn in fileIDLfns.values():
         successful[lfn] = True
     return S_OK( {"Successful":successful, "Failed":failed} )
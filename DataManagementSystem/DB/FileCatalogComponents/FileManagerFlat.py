@@ -6,7 +6,7 @@ __RCSID__ = "$Id$"
 
 from DIRAC                                  import S_OK, S_ERROR
 from DIRAC.Core.Utilities.List              import stringListToString, intListToString, sortList
-from DIRAC.DataManagementSystem.DB.FileCatalogComponents.FileManagerBase import FileManagerBase
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.FileManagerBase import FileManagerBase
 
 import time,os
 from types import TupleType, ListType, StringTypes
@@ -25,15 +25,14 @@ class FileManagerFlat(FileManagerBase):
     dirDict = self._getFileDirectories(lfns)
     failed = {}
     directoryIDs = {}
+    res = self.db.dtree.findDirs(dirDict.keys())
     for dirPath in dirDict.keys():
-      startTime = time.time()
-      res = self.db.dtree.findDir(dirPath)
-      if (not res['OK']) or (not res['Value']):
+      if (not res['OK']) or (not dirPath in res['Value']):
         error = res.get('Message','No such file or directory')
         for fileName in dirDict[dirPath]:
           failed['%s/%s' % (dirPath,fileName)] = error
       else:
-        directoryIDs[dirPath] = res['Value']
+        directoryIDs[dirPath] = res['Value'][dirPath]
     successful = {}
     for dirPath in directoryIDs.keys():
       fileNames = dirDict[dirPath]
@@ -8,9 +8,26 @@
 
 __RCSID__ = "$Id$"
 
-import time, types
-from DIRAC import S_OK, S_ERROR
+import time, types, base64
+try:
+  import hashlib
+  md5 = hashlib
+except ImportError:
+  import md5
+from DIRAC import S_OK, S_ERROR, gLogger
 from DIRAC.DataManagementSystem.DB.FileCatalogComponents.Utilities import queryTime
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.IDSet import intersectIDs
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.MetaQueryCompiler import MetaQueryCompiler, \
+                                                                                  isCompilerSupported, formatValue, \
+                                                                                  createValueCondition
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.CatalogCache import normalizeQuery
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.RunIndex import isRunQuery
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.QueryProfiler import profileStage, getProfile
+
+# Number of files or rows handled by a single statement in the bulk operations
+BULK_CHUNK_SIZE = 1000
+# Number of rows moved at once when a meta parameter becomes an indexed field
+MIGRATION_CHUNK_SIZE = 5000
 
 class FileMetadata:
 
@@ -42,6 +59,13 @@ class FileMetadata:
       return result
     if pname in result['Value'].keys():
       if ptype.lower() == result['Value'][pname].lower():
+        # Complete an interrupted migration of the parameter values
+        result = self.__transformMetaParameterToData( pname )
+        if not result['OK']:
+          return result
+        if result['Value']:
+          self.__rebuildRunIndex( pname, credDict )
+          self.__rebuildTextIndex( pname )
         return S_OK( 'Already exists' )
       else:
         return S_ERROR( 'Attempt to add an existing metadata with different type: %s/%s' %
@@ -59,11 +83,14 @@ class FileMetadata:
     result = self.db._insert( 'FC_FileMetaFields', ['MetaName', 'MetaType'], [pname, ptype] )
     if not result['OK']:
       return result
+    self.__invalidateMetadataFields()
 
     metadataID = result['lastRowId']
     result = self.__transformMetaParameterToData( pname )
     if not result['OK']:
       return result
+    self.__rebuildRunIndex( pname, credDict )
+    self.__rebuildTextIndex( pname )
 
     return S_OK( "Added new metadata: %d" % metadataID )
 
@@ -78,15 +105,38 @@ class FileMetadata:
       error = result["Message"]
     req = "DELETE FROM FC_FileMetaFields WHERE MetaName='%s'" % pname
     result = self.db._update( req )
+    self.__invalidateMetadataFields()
+    self.__rebuildRunIndex( pname, credDict )
+    if self.db.textIndex and pname in self.db.textIndex.fields:
+      self.__checkTextIndexResult( self.db.textIndex.remove( pname ) )
     if not result['OK']:
       if error:
         result["Message"] = error + "; " + result["Message"] 
     return result
 
+  def __invalidateMetadataFields( self ):
+    """ Drop the cached field definitions here and in the other service instances
+    """
+    self.db.metaFields.pop( 'File', None )
+    result = self.db.bumpGeneration( 'MetaFields' )
+    if not result['OK']:
+      gLogger.warn( 'Failed to update the MetaFields generation', result['Message'] )
+    self.db.catalogChanged()
+
   def getFileMetadataFields( self, credDict ):
-    """ Get all the defined metadata fields
+    """ Get all the defined metadata fields. The definitions are cached and
+        reloaded when the MetaFields generation changes
     """
 
+    result = self.db.getGeneration( 'MetaFields' )
+    if not result['OK']:
+      return result
+    generation = result['Value']
+    if 'File' in self.db.metaFields:
+      cachedGeneration, metaDict = self.db.metaFields['File']
+      if cachedGeneration == generation:
+        return S_OK( dict( metaDict ) )
+
     req = "SELECT MetaName,MetaType FROM FC_FileMetaFields"
     result = self.db._query( req )
     if not result['OK']:
@@ -96,7 +146,8 @@ class FileMetadata:
     for row in result['Value']:
       metaDict[row[0]] = row[1]
 
-    return S_OK( metaDict )                 
+    self.db.metaFields['File'] = ( generation, metaDict )
+    return S_OK( dict( metaDict ) )                 
           
 ###########################################################
 #
@@ -124,18 +175,101 @@ class FileMetadata:
       if not metaName in metaFields:
         result = self.__setFileMetaParameter( fileID, metaName, metaValue, credDict )
       else:
-        result = self.db._insert( 'FC_FileMeta_%s' % metaName, ['FileID', 'Value'], [fileID, metaValue] )
+        try:
+          value = formatValue( metaValue, metaFields[metaName] )
+        except ( TypeError, ValueError ):
+          return S_ERROR( 'Illegal value %s for %s of type %s' % ( metaValue, metaName, metaFields[metaName] ) )
+        req = "INSERT INTO FC_FileMeta_%s (FileID,Value) VALUES (%d,%s) ON DUPLICATE KEY UPDATE Value=VALUES(Value)" % \
+              ( metaName, fileID, value )
+        result = self.db._update( req )
         if not result['OK']:
-          if result['Message'].find( 'Duplicate' ) != -1:
-            req = "UPDATE FC_FileMeta_%s SET Value='%s' WHERE FileID=%d" % ( metaName, metaValue, fileID )
-            result = self.db._update( req )
-            if not result['OK']:
-              return result
+          return result
+
+    if self.db.runIndex and self.db.runIndex.isIndexed( metadict, metaFields ):
+      self.__updateRunIndex( [fileID] )
+    self.__updateTextIndex( metadict, [fileID] )
+    return S_OK()
+
+  def setFileMetadataBulk( self, lfnMetaDict, credDict ):
+    """ Set metadata for many files at once, lfnMetaDict is { lfn : metaDict }.
+        The file IDs are resolved in chunks and the values are written with
+        multi-row statements per metadata table. The statements are independent:
+        a file reported as failed because of one table can have the values of
+        its other fields already written
+    """
+    result = self.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+
+    successful = {}
+    failed = {}
+    fileIDs = {}
+    lfns = lfnMetaDict.keys()
+    for i in range( 0, len( lfns ), BULK_CHUNK_SIZE ):
+      result = self.db.fileManager._findFiles( lfns[i:i + BULK_CHUNK_SIZE] )
+      if not result['OK']:
+        return result
+      for lfn, fileDict in result['Value']['Successful'].items():
+        fileIDs[lfn] = fileDict['FileID']
+      for lfn in result['Value']['Failed']:
+        failed[lfn] = 'File not found'
+
+    # Group the values by metadata table, binding them to the field types
+    metaRows = {}
+    paramRows = []
+    for lfn, fileID in fileIDs.items():
+      lfnMetaRows = []
+      lfnParamRows = []
+      try:
+        for metaName, metaValue in lfnMetaDict[lfn].items():
+          if metaName in metaFields:
+            lfnMetaRows.append( ( metaName, '(%d,%s)' % ( fileID, formatValue( metaValue, metaFields[metaName] ) ) ) )
           else:
-            return result
+            lfnParamRows.append( '(%d,%s,%s)' % ( fileID, formatValue( metaName ), formatValue( str( metaValue ) ) ) )
+      except ( TypeError, ValueError ):
+        failed[lfn] = 'Illegal value %s for %s of type %s' % ( metaValue, metaName,
+                                                                metaFields.get( metaName, 'parameter' ) )
+        continue
+      for metaName, row in lfnMetaRows:
+        metaRows.setdefault( metaName, [] ).append( ( lfn, row ) )
+      paramRows.extend( [ ( lfn, row ) for row in lfnParamRows ] )
+
+    for metaName, rows in metaRows.items():
+      req = "INSERT INTO FC_FileMeta_%s (FileID,Value) VALUES " % metaName
+      self.__insertBulk( req, " ON DUPLICATE KEY UPDATE Value=VALUES(Value)", rows, failed )
+    if paramRows:
+      req = "INSERT INTO FC_FileMeta (FileID,MetaKey,MetaValue) VALUES "
+      self.__insertBulk( req, " ON DUPLICATE KEY UPDATE MetaValue=VALUES(MetaValue)", paramRows, failed )
+
+    runFileIDs = []
+    textFileIDs = {}
+    for lfn, fileID in fileIDs.items():
+      if not lfn in failed:
+        successful[lfn] = True
+        if self.db.runIndex and self.db.runIndex.isIndexed( lfnMetaDict[lfn], metaFields ):
+          runFileIDs.append( fileID )
+        if self.db.textIndex:
+          for meta in self.db.textIndex.isIndexed( lfnMetaDict[lfn] ):
+            textFileIDs.setdefault( meta, [] ).append( fileID )
+    if runFileIDs:
+      self.__updateRunIndex( runFileIDs )
+    for meta, metaFileIDs in textFileIDs.items():
+      self.__updateTextIndex( [meta], metaFileIDs )
+    return S_OK( { 'Successful' : successful, 'Failed' : failed } )
+
+  def __insertBulk( self, req, update, rows, failed ):
+    """ Execute the multi-row insertion in chunks, the files of a failed chunk
+        are reported in the failed dictionary. Their rows in the other tables
+        are not removed
+    """
+    for i in range( 0, len( rows ), BULK_CHUNK_SIZE ):
+      chunk = rows[i:i + BULK_CHUNK_SIZE]
+      result = self.db._update( req + ','.join( [ row for _lfn, row in chunk ] ) + update )
+      if not result['OK']:
+        for lfn, _row in chunk:
+          failed[lfn] = result['Message']
 
-    return S_OK()     
-  
   def removeMetadata( self, path, metadata, credDict ):
     """ Remove the specified metadata for the given file
     """
@@ -166,7 +300,10 @@ class FileMetadata:
         result = self.db._update(req)
         if not result['OK']:
           failedMeta[meta] = result['Value']    
-          
+
+    if self.db.runIndex and self.db.runIndex.isIndexed( metadata, metaFields ):
+      self.__updateRunIndex( [fileID] )
+    self.__updateTextIndex( metadata, [fileID] )
     if failedMeta:
       metaExample = failedMeta.keys()[0]
       result = S_ERROR('Failed to remove %d metadata, e.g. %s' % (len(failedMeta),failedMeta[metaExample]) )
@@ -174,6 +311,39 @@ class FileMetadata:
     else:
       return S_OK()     
   
+  def __updateRunIndex( self, fileIDs ):
+    """ Keep the run range index in line with the run metadata of the files
+    """
+    result = self.db.runIndex.update( 'F', fileIDs )
+    if not result['OK']:
+      gLogger.warn( 'Failed to update the run index', result['Message'] )
+
+  def __rebuildRunIndex( self, pname, credDict ):
+    """ The index changes completely when a run metadata field is added or removed
+    """
+    if self.db.runIndex and pname in [ self.db.runIndex.lowField, self.db.runIndex.highField ]:
+      result = self.db.runIndex.rebuild( credDict )
+      if not result['OK']:
+        gLogger.warn( 'Failed to rebuild the run index', result['Message'] )
+
+  def __updateTextIndex( self, metaNames, fileIDs ):
+    """ Keep the text index in line with the indexed text metadata of the files
+    """
+    if not self.db.textIndex:
+      return
+    for meta in self.db.textIndex.isIndexed( metaNames ):
+      self.__checkTextIndexResult( self.db.textIndex.update( meta, fileIDs ) )
+
+  def __rebuildTextIndex( self, pname ):
+    """ Index the values of a new text field
+    """
+    if self.db.textIndex and pname in self.db.textIndex.fields:
+      self.__checkTextIndexResult( self.db.textIndex.rebuildField( pname ) )
+
+  def __checkTextIndexResult( self, result ):
+    if not result['OK']:
+      gLogger.warn( 'Failed to update the text index', result['Message'] )
+
   def __getFileID( self, path ):
     
     result = self.db.fileManager._findFiles( [path] )
@@ -299,79 +469,61 @@ class FileMetadata:
     return self.__getFileMetaParameters( fileID,credDict )
   
   def __transformMetaParameterToData( self, metaname ):
-    """ Relocate the meta parameters of all the directories to the corresponding
-        indexed metadata table
+    """ Relocate the meta parameters of all the files to the corresponding
+        indexed metadata table. The rows are moved in FileID order by chunks,
+        each chunk being copied and then removed from FC_FileMeta, so that the
+        tables are never locked for long and an interrupted migration can be
+        resumed. Returns the number of moved rows
     """
 
-    req = "SELECT FileID,MetaValue from FC_FileMeta WHERE MetaKey='%s'" % metaname
+    req = "SELECT COUNT(*) FROM FC_FileMeta WHERE MetaKey=%s" % formatValue( metaname )
     result = self.db._query( req )
     if not result['OK']:
       return result
-    if not result['Value']:
-      return S_OK()
-
-    fileDict = {}
-    for fileID, meta in result['Value']:
-      fileDict[fileID] = meta
-    fileList = fileDict.keys()
-
-    insertValueList = []
-    for fileID in fileList:
-      insertValueList.append( "( %d,'%s' )" % ( fileID, meta ) )
+    total = int( result['Value'][0][0] )
+    if not total:
+      return S_OK( 0 )
+
+    moved = 0
+    lastID = 0
+    while True:
+      req = "SELECT FileID,MetaValue FROM FC_FileMeta WHERE MetaKey=%s AND FileID>%d ORDER BY FileID LIMIT %d" % \
+            ( formatValue( metaname ), lastID, MIGRATION_CHUNK_SIZE )
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      if not result['Value']:
+        break
 
-    req = "INSERT INTO FC_FileMeta_%s (FileID,Value) VALUES %s" % ( metaname, ', '.join( insertValueList ) )
-    result = self.db._update( req )
-    if not result['OK']:
-      return result
+      insertValueList = [ "(%d,%s)" % ( fileID, formatValue( value ) ) for fileID, value in result['Value'] ]
+      fileIDs = [ str( fileID ) for fileID, _value in result['Value'] ]
+      lastID = result['Value'][-1][0]
 
-    req = "DELETE FROM FC_FileMeta WHERE MetaKey='%s'" % metaname
-    result = self.db._update( req )
-    return result
+      req = "INSERT INTO FC_FileMeta_%s (FileID,Value) VALUES %s ON DUPLICATE KEY UPDATE Value=VALUES(Value)" % \
+            ( metaname, ','.join( insertValueList ) )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+      req = "DELETE FROM FC_FileMeta WHERE MetaKey=%s AND FileID IN (%s)" % ( formatValue( metaname ),
+                                                                             ','.join( fileIDs ) )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
 
-  def __createMetaSelection( self,meta,value,table='' ):
-
-    if type( value ) == types.DictType:
-      selectList = []
-      for operation, operand in value.items():
-        if operation in ['>', '<', '>=', '<=']:
-          if type( operand ) == types.ListType:
-            return S_ERROR( 'Illegal query: list of values for comparison operation' )
-          if type( operand ) in [types.IntType, types.LongType]:
-            selectList.append( "%sValue%s%d" % ( table, operation, operand ) )
-          elif type( operand ) == types.FloatType:
-            selectList.append( "%sValue%s%f" % ( table, operation, operand ) )
-          else:
-            selectList.append( "%sValue%s'%s'" % ( table, operation, operand ) )
-        elif operation == 'in' or operation == "=":
-          if type( operand ) == types.ListType:
-            vString = ','.join( [ "'" + str( x ) + "'" for x in operand] )
-            selectList.append( "%sValue IN (%s)" % ( table, vString) )
-          else:
-            selectList.append( "%sValue='%s'" % ( table, operand ) )
-        elif operation == 'nin' or operation == "!=":
-          if type( operand ) == types.ListType:
-            vString = ','.join( [ "'" + str( x ) + "'" for x in operand] )
-            selectList.append( "%sValue NOT IN (%s)" % ( table, vString ) )
-          else:
-            selectList.append( "%sValue!='%s'" % ( table, operand ) )
-        selectString = ' AND '.join( selectList )
-    elif type( value ) == types.ListType:
-      vString = ','.join( [ "'" + str( x ) + "'" for x in value] )
-      selectString = "%sValue in %s" % ( table, vString )
-    else:
-      if value == "Any":
-        selectString = ''
-      else:
-        selectString = "%sValue='%s' " % ( table, value )
+      moved += len( fileIDs )
+      gLogger.info( 'Moved %d/%d values of %s to the indexed table' % ( moved, total, metaname ) )
 
-    return S_OK(selectString)
+    return S_OK( moved )
 
-  def __findFilesForMetaValue( self, meta, value, dirList ):
+  @profileStage
+  def __findFilesForMetaValue( self, meta, value, dirList, metaType = '' ):
     """ Find files in the given list of directories corresponding to the given
-        selection criteria
+        selection criteria, the values being bound to the field type
     """
+    if isRunQuery( meta, value ):
+      return self.__findFilesByRun( value, dirList )
 
-    result = self.__createMetaSelection( meta, value, "M." )
+    result = createValueCondition( 'M.Value', value, metaType )
     if not result['OK']:
       return result
     selectString = result['Value']
@@ -379,6 +531,12 @@ class FileMetadata:
     dirString = ','.join([ str(x) for x in dirList])
 
     req = " SELECT F.FileID, F.DirID FROM FC_FileMeta_%s AS M, FC_Files AS F" % meta
+    if self.db.textIndex:
+      textSelection = self.db.textIndex.getTextSelection( meta, value )
+      if textSelection:
+        # Only check the substring match on the candidates of the text index
+        req = " SELECT F.FileID, F.DirID FROM ( %s ) AS TX JOIN FC_FileMeta_%s AS M ON M.FileID=TX.FileID, FC_Files AS F" % \
+              ( textSelection, meta )
     if dirString:
       req += " WHERE F.DirID in (%s)" % dirString
     if selectString:
@@ -402,31 +560,162 @@ class FileMetadata:
     return S_OK( fileList )
 
 
+  @profileStage
+  def __findFilesByRun( self, value, dirList ):
+    """ Find files in the given list of directories with the run range
+        satisfying the run query
+    """
+    result = self.db.runIndex.getRunCondition( 'R', 'F', value )
+    if not result['OK']:
+      return result
+    # Only the files still in the catalog
+    req = "SELECT R.ObjID FROM FC_RunIndex AS R JOIN FC_Files AS F ON F.FileID=R.ObjID WHERE %s" % result['Value']
+    if dirList:
+      req += " AND F.DirID IN (%s)" % ','.join( [ str( x ) for x in dirList ] )
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    return S_OK( [ row[0] for row in result['Value'] ] )
+
   def __findFilesByMetadata( self,metaDict,dirList,credDict ):
     """ Find a list of file IDs meeting the metaDict requirements and belonging
         to directories in dirList 
     """
 
-    fileList = []
-    first = True    
-    for meta,value in metaDict.items():
-      result = self.__findFilesForMetaValue( meta,value,dirList )
+    result = self.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+
+    metaItems = metaDict.items()
+    if self.db.metaStats:
+      # Most selective first, the evaluation stops at the first empty result
+      metaItems = self.db.metaStats.orderConstraints( 'F', metaDict )
+    idLists = []
+    for meta,value in metaItems:
+      result = self.__findFilesForMetaValue( meta,value,dirList,metaFields.get( meta, '' ) )
       if not result['OK']:
         return result
       mList = result['Value']
-      if first:
-        fileList = mList
-        first = False
-      else:
-        newList = []
-        for f in fileList:
-          if f in mList:
-            newList.append( f )
-        fileList = newList
+      if not mList:
+        # Nothing can satisfy the query, no need to evaluate the other fields
+        return S_OK( [] )
+      idLists.append( mList )
+
+    return S_OK( intersectIDs( idLists ).toList() )
+
+  @profileStage
+  def __getFileLFNs( self, fileList ):
+    """ Get the LFNs of the selected files
+    """
+    return self.db.fileManager._getFileLFNs( fileList )
+
+  @profileStage
+  def __findFilesByCompiledQuery( self, metaDict, path, credDict ):
+    """ Find files satisfying the given metadata with a single query combining
+        both directory and file metadata. The output is the same as the one
+        of the step by step evaluation
+    """
+    result = MetaQueryCompiler( self.db ).compileQuery( metaDict, path, credDict )
+    if not result['OK']:
+      return result
+    req = result['Value']
+    fileMetaFlag = result['FileMetadata']
+    if not req:
+      return S_OK( [] )
+
+    profile = getProfile()
+    if profile:
+      result = self.db._query( 'EXPLAIN %s' % req )
+      if result['OK']:
+        profile.addExplain( req, [ list( row ) for row in result['Value'] ] )
+
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_OK( [] )
 
-    return S_OK(fileList)
+    if not fileMetaFlag:
+      # Only directories were selected, return files grouped by directory
+      lfnDict = {}
+      for _fileID, dirName, fileName in result['Value']:
+        lfnDict.setdefault( dirName, [] )
+        lfnDict[dirName].append( fileName )
+      return S_OK( lfnDict )
+
+    lfnList = [ '%s/%s' % ( dirName, fileName ) for _fileID, dirName, fileName in result['Value'] ]
+    return S_OK( lfnList )
+
+  def __encodeCursor( self, lastFileID, total, queryKey ):
+    """ Opaque continuation token of a paged query
+    """
+    checksum = md5.md5( queryKey ).hexdigest()[:8]
+    return base64.urlsafe_b64encode( '%d:%d:%s' % ( lastFileID, total, checksum ) )
+
+  def __decodeCursor( self, cursor, queryKey ):
+    """ Get the last FileID and the total number of files from the token
+    """
+    try:
+      lastFileID, total, checksum = base64.urlsafe_b64decode( str( cursor ) ).split( ':' )
+      lastFileID = int( lastFileID )
+      total = int( total )
+    except Exception:
+      return S_ERROR( 'Invalid cursor' )
+    if checksum != md5.md5( queryKey ).hexdigest()[:8]:
+      return S_ERROR( 'Cursor does not belong to this query' )
+    return S_OK( ( lastFileID, total ) )
+
+  def findFilesByMetadataPage( self, metaDict, path, credDict, cursor = '', pageSize = 1000 ):
+    """ Get a page of files satisfying the given metadata in the order of FileID.
+        The next page is obtained with the returned cursor, which is empty after
+        the last page. The total number of files is only counted for the first page
+    """
+    if not isCompilerSupported( self.db ):
+      return S_ERROR( 'Paged metadata queries need the DirectoryLevelTree directory manager' )
+    if pageSize < 1:
+      return S_ERROR( 'Illegal page size: %s' % pageSize )
+    if not path:
+      path = '/'
+    queryKey = '%s:%s' % ( path, normalizeQuery( metaDict ) )
+
+    compiler = MetaQueryCompiler( self.db )
+    lastFileID = 0
+    if cursor:
+      result = self.__decodeCursor( cursor, queryKey )
+      if not result['OK']:
+        return result
+      lastFileID, total = result['Value']
+    else:
+      result = compiler.compileQuery( metaDict, path, credDict, count = True )
+      if not result['OK']:
+        return result
+      total = 0
+      if result['Value']:
+        result = self.db._query( result['Value'] )
+        if not result['OK']:
+          return result
+        total = int( result['Value'][0][0] )
+
+    lfnList = []
+    if total:
+      result = compiler.compileQuery( metaDict, path, credDict, afterFileID = lastFileID, limit = pageSize )
+      if not result['OK']:
+        return result
+      result = self.db._query( result['Value'] )
+      if not result['OK']:
+        return result
+      for fileID, dirName, fileName in result['Value']:
+        lfnList.append( '%s/%s' % ( dirName, fileName ) )
+        lastFileID = fileID
+
+    nextCursor = ''
+    if len( lfnList ) == pageSize:
+      nextCursor = self.__encodeCursor( lastFileID, total, queryKey )
+    return S_OK( { 'LFNs' : lfnList, 'TotalRecords' : total, 'Cursor' : nextCursor } )
 
   @queryTime
+  @profileStage
   def findFilesByMetadata( self, metaDict, path, credDict ):
     """ Find Files satisfying the given metadata
     """
@@ -436,6 +725,9 @@ class FileMetadata:
     if not path:
       path = '/'
 
+    if isCompilerSupported( self.db ):
+      return self.__findFilesByCompiledQuery( metaDict, path, credDict )
+
     result = self.db.dmeta.findDirIDsByMetadata( metaDict, path, credDict )
     if not result['OK']:
       return result
@@ -446,11 +738,22 @@ class FileMetadata:
     result = self.getFileMetadataFields( credDict )
     if not result['OK']:
       return result
+    metaFields = result['Value']
 
     fileMetaDict = {}
     for key,value in metaDict.items():
-      if key in result['Value']:
+      if key in metaFields:
         fileMetaDict[key] = value
+      elif isRunQuery( key, value ):
+        if not self.db.runIndex:
+          return S_ERROR( 'Run range queries need the run index' )
+        result = self.db.runIndex.getIndexType( credDict )
+        if not result['OK']:
+          return result
+        if not result['Value']:
+          return S_ERROR( 'Run range metadata are not defined' )
+        if result['Value'] == 'F':
+          fileMetaDict[key] = value
 
     fileList = []
     lfnList = []
@@ -463,7 +766,7 @@ class FileMetadata:
         return result
       fileList = result['Value']
       if fileList:
-        result = self.db.fileManager._getFileLFNs(fileList)
+        result = self.__getFileLFNs( fileList )
         lfnList = [ x[1] for x in result['Value']['Successful'].items() ]   
         return S_OK(lfnList)  
       else:
@@ -479,7 +782,7 @@ class FileMetadata:
       return result
 
     if fileList:
-      result = self.db.fileManager._getFileLFNs(fileList)
+      result = self.__getFileLFNs( fileList )
       lfnList = [ x[1] for x in result['Value']['Successful'].items() ]
 
     return S_OK( lfnList ) 
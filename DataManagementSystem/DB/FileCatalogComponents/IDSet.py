@@ -0,0 +1,132 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog helper to combine per-field metadata query results.
+    Directory and file IDs returned by the individual metadata selections
+    are combined here with AND/OR/NOT set operations instead of list scans.
+    Stored ID lists use a delta encoded, compressed form.
+"""
+
+__RCSID__ = "$Id$"
+
+import zlib
+
+class IDSet:
+  """ Set of integer identifiers (DirID or FileID)
+  """
+
+  def __init__( self, ids = None ):
+    if ids is None:
+      self.ids = set()
+    elif isinstance( ids, IDSet ):
+      self.ids = set( ids.ids )
+    else:
+      self.ids = set( ids )
+
+  def __len__( self ):
+    return len( self.ids )
+
+  def __iter__( self ):
+    return iter( self.ids )
+
+  def __contains__( self, id_ ):
+    return id_ in self.ids
+
+  def __nonzero__( self ):
+    return len( self.ids ) > 0
+
+  def __and__( self, other ):
+    return self.intersection( other )
+
+  def __or__( self, other ):
+    return self.union( other )
+
+  def __sub__( self, other ):
+    return self.difference( other )
+
+  def __repr__( self ):
+    return 'IDSet(%d ids)' % len( self.ids )
+
+  def __getIDs( self, other ):
+    if isinstance( other, IDSet ):
+      return other.ids
+    return other
+
+  def intersection( self, other ):
+    """ AND combination
+    """
+    ids = self.__getIDs( other )
+    # Iterate over the smaller of the two sets
+    if len( self.ids ) > len( ids ):
+      return IDSet( set( ids ).intersection( self.ids ) )
+    return IDSet( self.ids.intersection( ids ) )
+
+  def union( self, other ):
+    """ OR combination
+    """
+    return IDSet( self.ids.union( self.__getIDs( other ) ) )
+
+  def difference( self, other ):
+    """ AND NOT combination
+    """
+    return IDSet( self.ids.difference( self.__getIDs( other ) ) )
+
+  def complement( self, universe ):
+    """ NOT with respect to the given universe of IDs
+    """
+    return IDSet( universe ).difference( self )
+
+  def toList( self ):
+    """ Get the IDs as a sorted list
+    """
+    return sorted( self.ids )
+
+def intersectIDs( idLists ):
+  """ Intersect the given ID lists starting from the shortest one. The
+      result is an IDSet, empty as soon as any of the inputs is empty
+  """
+  idSets = [ IDSet( ids ) for ids in idLists ]
+  if not idSets:
+    return IDSet()
+  idSets.sort( key = len )
+  result = idSets[0]
+  for idSet in idSets[1:]:
+    if not result:
+      break
+    result = result.intersection( idSet )
+  return result
+
+def unionIDs( idLists ):
+  """ Union of the given ID lists
+  """
+  result = set()
+  for ids in idLists:
+    result.update( ids )
+  return IDSet( result )
+
+def encodeIDs( ids ):
+  """ Compact form of a list of IDs: the differences of the sorted IDs,
+      zlib compressed
+  """
+  deltas = []
+  last = 0
+  for id_ in sorted( ids ):
+    deltas.append( id_ - last )
+    last = id_
+  return zlib.compress( ','.join( [ str( delta ) for delta in deltas ] ) )
+
+def decodeIDs( data ):
+  """ Get back the sorted list of IDs from their compact form
+  """
+  ids = []
+  if not data:
+    return ids
+  text = zlib.decompress( data )
+  if not text:
+    return ids
+  last = 0
+  for delta in text.split( ',' ):
+    last += int( delta )
+    ids.append( last )
+  return ids
@@ -0,0 +1,434 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog helper compiling a metadata query into a single SQL
+    statement. Directory and file metadata constraints are turned into joins
+    ordered by their estimated selectivity, directory metadata being
+    inherited by the subdirectories through the enumerated paths of the
+    DirectoryLevelTree, selected level by level with the LPATH index, or read directly from the effective metadata tables
+    if these are enabled. Run range queries are resolved with the run index
+    table.
+"""
+
+__RCSID__ = "$Id$"
+
+import types, math
+from DIRAC import S_OK, S_ERROR
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryLevelTree import MAX_LEVELS
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.RunIndex import isRunQuery
+
+def isCompilerSupported( database ):
+  """ The compiled queries rely on the enumerated paths of the level tree
+  """
+  return database.dtree.getTreeTable() == 'FC_DirectoryLevelTree'
+
+# MySQL types of the metadata fields by kind of value
+INT_TYPES = [ 'TINYINT', 'SMALLINT', 'MEDIUMINT', 'INT', 'INTEGER', 'BIGINT' ]
+FLOAT_TYPES = [ 'FLOAT', 'DOUBLE', 'REAL', 'DECIMAL', 'NUMERIC' ]
+DATE_TYPES = [ 'DATE', 'DATETIME', 'TIMESTAMP' ]
+
+def getValueKind( ptype ):
+  """ Kind of the values of a metadata field declared with the given MySQL
+      type: 'int', 'float', 'date' or 'string'
+  """
+  words = ptype.upper().split( '(' )[0].split()
+  if not words:
+    return 'string'
+  if words[0] in INT_TYPES:
+    return 'int'
+  if words[0] in FLOAT_TYPES:
+    return 'float'
+  if words[0] in DATE_TYPES:
+    return 'date'
+  return 'string'
+
+def formatValue( value, ptype = '' ):
+  """ Format a metadata value for the use in SQL. If the type of the field is
+      given the literal is bound to it, so that the comparison with the column
+      can use its index. ValueError is raised if the value does not fit a
+      numeric field and TypeError if it is not a scalar
+  """
+  kind = ''
+  if ptype:
+    kind = getValueKind( ptype )
+  if kind == 'int':
+    if type( value ) == types.FloatType and ( math.isinf( value ) or value != int( value ) ):
+      raise ValueError( 'Not an integer: %s' % value )
+    if type( value ) in types.StringTypes:
+      return '%d' % int( value.strip() )
+    return '%d' % int( value )
+  elif kind == 'float':
+    value = float( value )
+    if math.isnan( value ) or math.isinf( value ):
+      raise ValueError( 'Not a finite number: %s' % value )
+    return repr( value )
+  elif not kind:
+    if type( value ) == types.BooleanType:
+      return '%d' % int( value )
+    elif type( value ) in [types.IntType, types.LongType]:
+      return '%d' % value
+    elif type( value ) == types.FloatType:
+      if math.isnan( value ) or math.isinf( value ):
+        raise ValueError( 'Not a finite number: %s' % value )
+      return repr( value )
+  return "'%s'" % str( value ).replace( '\\', '\\\\' ).replace( "'", "\\'" )
+
+def formatPattern( text, prefix = '%', suffix = '%' ):
+  """ Format the LIKE pattern matching the text literally
+  """
+  text = str( text ).replace( '\\', '\\\\' ).replace( '%', '\\%' ).replace( '_', '\\_' )
+  return formatValue( prefix + text + suffix )
+
+def createValueCondition( column, value, ptype = '' ):
+  """ Create the SQL condition on the metadata value column for the given
+      query value, the operands being bound to the field type if given.
+      Returns an empty string if any value is accepted
+  """
+  try:
+    if type( value ) == types.DictType:
+      selectList = []
+      for operation, operand in value.items():
+        if operation in ['>', '<', '>=', '<=']:
+          if type( operand ) == types.ListType:
+            return S_ERROR( 'Illegal query: list of values for comparison operation' )
+          selectList.append( "%s%s%s" % ( column, operation, formatValue( operand, ptype ) ) )
+        elif operation == 'in' or operation == "=":
+          if type( operand ) == types.ListType:
+            vString = ','.join( [ formatValue( x, ptype ) for x in operand ] )
+            selectList.append( "%s IN (%s)" % ( column, vString ) )
+          else:
+            selectList.append( "%s=%s" % ( column, formatValue( operand, ptype ) ) )
+        elif operation == 'nin' or operation == "!=":
+          if type( operand ) == types.ListType:
+            vString = ','.join( [ formatValue( x, ptype ) for x in operand ] )
+            selectList.append( "%s NOT IN (%s)" % ( column, vString ) )
+          else:
+            selectList.append( "%s!=%s" % ( column, formatValue( operand, ptype ) ) )
+        elif operation == 'contains':
+          selectList.append( "%s LIKE %s" % ( column, formatPattern( operand ) ) )
+        elif operation == 'startswith':
+          selectList.append( "%s LIKE %s" % ( column, formatPattern( operand, prefix = '' ) ) )
+        else:
+          return S_ERROR( 'Illegal query: unknown operation %s' % operation )
+      selectString = ' AND '.join( selectList )
+    elif type( value ) == types.ListType:
+      vString = ','.join( [ formatValue( x, ptype ) for x in value ] )
+      selectString = "%s IN (%s)" % ( column, vString )
+    elif value == "Any":
+      selectString = ''
+    else:
+      selectString = "%s=%s" % ( column, formatValue( value, ptype ) )
+  except ( TypeError, ValueError ), x:
+    return S_ERROR( 'Illegal query: value not of type %s: %s' % ( ptype, str( x ) ) )
+
+  return S_OK( selectString )
+
+class MetaQueryCompiler:
+  """ Compiler of metadata queries into a single SELECT statement
+  """
+
+  def __init__( self, database = None ):
+    self.db = database
+    self.treeTable = 'FC_DirectoryLevelTree'
+
+  def _estimateSelectivity( self, meta, value, metaType = 'D' ):
+    """ Estimate of the number of values accepted by the constraint, taken from
+        the metadata statistics if available. The smaller the number the earlier
+        the table is joined
+    """
+    if metaType == 'F' and self.__getTextSelection( meta, value ):
+      # Start from the few candidates of the text index
+      return 0
+    if self.db.metaStats:
+      estimate = self.db.metaStats.estimateRows( metaType, meta, value )
+      if estimate is not None:
+        return estimate
+    if type( value ) == types.ListType:
+      return len( value )
+    if type( value ) == types.DictType:
+      estimate = 1000
+      for operation, operand in value.items():
+        if operation in ['in', '=']:
+          if type( operand ) == types.ListType:
+            estimate = min( estimate, len( operand ) )
+          else:
+            estimate = 1
+        elif operation in ['>', '<', '>=', '<=']:
+          estimate = min( estimate, 100 )
+      if len( value ) > 1 and estimate == 100:
+        # A closed range
+        estimate = 10
+      return estimate
+    if value == "Any":
+      return 1000
+    return 1
+
+  def __orderConstraints( self, metaDict, metaType ):
+    """ Split the constraints into the positive ones ordered by the estimated
+        selectivity and the list of missing meta data
+    """
+    selectList = []
+    missingList = []
+    for meta, value in metaDict.items():
+      if value == "Missing":
+        missingList.append( meta )
+      else:
+        selectList.append( ( self._estimateSelectivity( meta, value, metaType ), meta, value ) )
+    selectList.sort()
+    return [ ( meta, value ) for _estimate, meta, value in selectList ], missingList
+
+  def __getTextSelection( self, meta, value ):
+    if not self.db.textIndex:
+      return ''
+    return self.db.textIndex.getTextSelection( meta, value )
+
+  def __subtreeSelection( self, table, keyColumn, condition ):
+    """ Statement selecting the DirIDs of the directories keyColumn of the table
+        satisfying the condition together with all their subdirectories. There is
+        one branch per level of the selected directories, so that the
+        subdirectories are found by equality on the leading LPATH columns, served
+        by the enumerated path index of the tree table
+    """
+    reqList = []
+    for level in range( MAX_LEVELS + 1 ):
+      joinConds = [ 'D.LPATH%d=A.LPATH%d' % ( i, i ) for i in range( 1, level + 1 ) ]
+      joinConds.append( 'D.Level>=%d' % level )
+      whereConds = [ 'A.Level=%d' % level ]
+      if condition:
+        whereConds.append( condition )
+      reqList.append( 'SELECT D.DirID FROM %s JOIN %s AS A ON A.DirID=%s JOIN %s AS D ON %s WHERE %s' %
+                      ( table, self.treeTable, keyColumn, self.treeTable,
+                        ' AND '.join( joinConds ), ' AND '.join( whereConds ) ) )
+    return ' UNION ALL '.join( reqList )
+
+  def __getRunSelection( self, queryDict, credDict ):
+    """ Take the run range query out of the query dictionary. Returns the
+        type of the indexed objects ( 'F' or 'D' ) and the condition on the
+        index table R
+    """
+    for key, value in queryDict.items():
+      if isRunQuery( key, value ):
+        break
+    else:
+      return S_OK( ( '', '' ) )
+    if not self.db.runIndex:
+      return S_ERROR( 'Run range queries need the run index' )
+    del queryDict[key]
+    result = self.db.runIndex.getIndexType( credDict )
+    if not result['OK']:
+      return result
+    runType = result['Value']
+    if not runType:
+      return S_ERROR( 'Run range metadata are not defined' )
+    result = self.db.runIndex.getRunCondition( 'R', runType, value )
+    if not result['OK']:
+      return result
+    return S_OK( ( runType, result['Value'] ) )
+
+  def splitQuery( self, queryDict, credDict ):
+    """ Expand the query and split it into the directory and file metadata
+        constraints. Unknown metadata are ignored
+    """
+    result = self.db.dmeta.expandMetaDictionary( queryDict, credDict )
+    if not result['OK']:
+      return result
+    dirMetaDict = result['Value']
+
+    result = self.db.fmeta.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    fileMetaDict = {}
+    for key, value in queryDict.items():
+      if key in result['Value']:
+        fileMetaDict[key] = value
+
+    return S_OK( ( dirMetaDict, fileMetaDict ) )
+
+  def compileQuery( self, queryDict, path, credDict, afterFileID = 0, limit = 0, count = False ):
+    """ Compile the metadata query for files in the given path into a single
+        statement selecting FileID, DirName, FileName of the matching files or
+        their number if count is True. The statement is empty if the query has
+        no constraints. result['FileMetadata'] tells whether file metadata
+        constraints are part of the query
+    """
+    pathDirID = 0
+    if path and path != '/':
+      result = self.db.dtree.findDir( path )
+      if not result['OK']:
+        return result
+      if not result['Value']:
+        return S_ERROR( 'Path not found: %s' % path )
+      pathDirID = int( result['Value'] )
+
+    queryDict = dict( queryDict )
+    result = self.__getRunSelection( queryDict, credDict )
+    if not result['OK']:
+      return result
+    runType, runCondition = result['Value']
+
+    result = self.splitQuery( queryDict, credDict )
+    if not result['OK']:
+      return result
+    dirMetaDict, fileMetaDict = result['Value']
+
+    # The field types to bind the query values to
+    result = self.db.dmeta.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    dirTypes = result['Value']
+    result = self.db.fmeta.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    fileTypes = result['Value']
+
+    pathSelection = ''
+    if pathDirID:
+      result = self.db.dtree.getSubdirectoriesByID( pathDirID, includeParent = True, requestString = True )
+      if not result['OK']:
+        return result
+      pathSelection = result['Value']
+
+    if not dirMetaDict and not fileMetaDict and not pathSelection and not runType:
+      result = S_OK( '' )
+      result['FileMetadata'] = False
+      return result
+
+    dirSelects, dirMissing = self.__orderConstraints( dirMetaDict, 'D' )
+    fileSelects, fileMissing = self.__orderConstraints( fileMetaDict, 'F' )
+
+    tables = []
+    conditions = []
+    haveDirs = False
+
+    # Directory side first: the directories defining the most selective
+    # meta datum give the candidate directories with all their subdirectories.
+    # A run range is the most selective one
+    if runType == 'D':
+      tables.append( '( %s ) AS SR' % self.__subtreeSelection( 'FC_RunIndex AS R', 'R.ObjID', runCondition ) )
+      tables.append( 'JOIN %s AS D ON D.DirID=SR.DirID' % self.treeTable )
+      haveDirs = True
+      if pathSelection:
+        tables.append( 'JOIN ( %s ) AS P ON P.DirID=D.DirID' % pathSelection )
+    index = 0
+    for meta, value in dirSelects:
+      index += 1
+      if not self.db.effectiveMetadata:
+        # The value condition goes into the selection of the defining directories
+        result = createValueCondition( 'M.Value', value, dirTypes.get( meta, '' ) )
+        if not result['OK']:
+          return result
+        selection = self.__subtreeSelection( 'FC_Meta_%s AS M' % meta, 'M.DirID', result['Value'] )
+        if not haveDirs:
+          tables.append( '( %s ) AS S%d' % ( selection, index ) )
+          tables.append( 'JOIN %s AS D ON D.DirID=S%d.DirID' % ( self.treeTable, index ) )
+          haveDirs = True
+          if pathSelection:
+            tables.append( 'JOIN ( %s ) AS P ON P.DirID=D.DirID' % pathSelection )
+        else:
+          tables.append( 'JOIN ( %s ) AS S%d ON S%d.DirID=D.DirID' % ( selection, index, index ) )
+        continue
+      result = createValueCondition( 'M%d.Value' % index, value, dirTypes.get( meta, '' ) )
+      if not result['OK']:
+        return result
+      if result['Value']:
+        conditions.append( result['Value'] )
+      # Inherited values are materialized, simple lookups by DirID
+      if not haveDirs:
+        tables.append( 'FC_EffMeta_%s AS M%d' % ( meta, index ) )
+        tables.append( 'JOIN %s AS D ON D.DirID=M%d.DirID' % ( self.treeTable, index ) )
+        haveDirs = True
+        if pathSelection:
+          tables.append( 'JOIN ( %s ) AS P ON P.DirID=D.DirID' % pathSelection )
+      else:
+        tables.append( 'JOIN FC_EffMeta_%s AS M%d ON M%d.DirID=D.DirID' % ( meta, index, index ) )
+    if not haveDirs:
+      if pathSelection:
+        tables.append( '( %s ) AS P' % pathSelection )
+        tables.append( 'JOIN %s AS D ON D.DirID=P.DirID' % self.treeTable )
+        haveDirs = True
+      elif dirMissing:
+        tables.append( '%s AS D' % self.treeTable )
+        haveDirs = True
+
+    for meta in dirMissing:
+      index += 1
+      if self.db.effectiveMetadata:
+        tables.append( 'LEFT JOIN FC_EffMeta_%s AS M%d ON M%d.DirID=D.DirID' % ( meta, index, index ) )
+        conditions.append( 'M%d.DirID IS NULL' % index )
+        continue
+      tables.append( 'LEFT JOIN ( %s ) AS S%d ON S%d.DirID=D.DirID' %
+                     ( self.__subtreeSelection( 'FC_Meta_%s AS M' % meta, 'M.DirID', '' ), index, index ) )
+      conditions.append( 'S%d.DirID IS NULL' % index )
+
+    # File side
+    haveFiles = haveDirs
+    if haveDirs:
+      tables.append( 'JOIN FC_Files AS F ON F.DirID=D.DirID' )
+    if runType == 'F':
+      conditions.append( runCondition )
+      if haveFiles:
+        tables.append( 'JOIN FC_RunIndex AS R ON R.ObjID=F.FileID' )
+      else:
+        tables.append( 'FC_RunIndex AS R' )
+        tables.append( 'JOIN FC_Files AS F ON F.FileID=R.ObjID' )
+        haveFiles = True
+    index = 0
+    for meta, value in fileSelects:
+      index += 1
+      result = createValueCondition( 'FM%d.Value' % index, value, fileTypes.get( meta, '' ) )
+      if not result['OK']:
+        return result
+      if result['Value']:
+        conditions.append( result['Value'] )
+      # The substring matches are only checked on the candidates of the text index
+      textSelection = self.__getTextSelection( meta, value )
+      if not haveFiles:
+        if textSelection:
+          tables.append( '( %s ) AS TX1' % textSelection )
+          tables.append( 'JOIN FC_FileMeta_%s AS FM1 ON FM1.FileID=TX1.FileID' % meta )
+        else:
+          tables.append( 'FC_FileMeta_%s AS FM1' % meta )
+        tables.append( 'JOIN FC_Files AS F ON F.FileID=FM1.FileID' )
+        haveFiles = True
+      else:
+        if textSelection:
+          tables.append( 'JOIN ( %s ) AS TX%d ON TX%d.FileID=F.FileID' % ( textSelection, index, index ) )
+        tables.append( 'JOIN FC_FileMeta_%s AS FM%d ON FM%d.FileID=F.FileID' % ( meta, index, index ) )
+    if not haveFiles:
+      tables.append( 'FC_Files AS F' )
+
+    for meta in fileMissing:
+      index += 1
+      tables.append( 'LEFT JOIN FC_FileMeta_%s AS FM%d ON FM%d.FileID=F.FileID' % ( meta, index, index ) )
+      conditions.append( 'FM%d.FileID IS NULL' % index )
+
+    if not haveDirs:
+      tables.append( 'JOIN %s AS D ON D.DirID=F.DirID' % self.treeTable )
+
+    if afterFileID:
+      conditions.append( 'F.FileID>%d' % afterFileID )
+
+    # Several ancestors can only match the same directory in case of inconsistent metadata,
+    # but let us be safe
+    distinct = ''
+    if ( dirSelects and not self.db.effectiveMetadata ) or runType == 'D':
+      distinct = 'DISTINCT '
+    # Pages ordered by FileID are better served by the plan the server chooses
+    straight = 'STRAIGHT_JOIN '
+    if afterFileID or limit:
+      straight = ''
+    if count:
+      req = 'SELECT %sCOUNT(%sF.FileID) FROM %s' % ( straight, distinct, ' '.join( tables ) )
+    else:
+      req = 'SELECT %s%sF.FileID,D.DirName,F.FileName FROM %s' % ( straight, distinct, ' '.join( tables ) )
+    if conditions:
+      req += ' WHERE %s' % ' AND '.join( conditions )
+    if not count and ( afterFileID or limit ):
+      req += ' ORDER BY F.FileID'
+    if not count and limit:
+      req += ' LIMIT %d' % limit
+
+    result = S_OK( req )
+    result['FileMetadata'] = len( fileMetaDict ) > 0 or runType == 'F'
+    return result
@@ -0,0 +1,261 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog statistics of the metadata values. For every directory
+    and file metadata field the number of rows, the number of distinct values,
+    the most common values and, for numeric fields, an equi-width histogram
+    are kept in the FC_MetaStats table. They are used to estimate the number
+    of rows selected by a query constraint, so that the most selective
+    constraints are evaluated first
+"""
+
+__RCSID__ = "$Id$"
+
+import types
+from DIRAC import S_OK, S_ERROR, gLogger
+from DIRAC.Core.Utilities import DEncode
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.MetaQueryCompiler import formatValue
+
+# Number of the most common values kept per field
+MCV_SIZE = 20
+# Number of buckets of the histograms of numeric fields
+HISTOGRAM_SIZE = 20
+
+NUMERIC_TYPES = [ types.IntType, types.LongType, types.FloatType ]
+
+class MetadataStatistics:
+
+  def __init__( self, database = None ):
+    self.db = database
+    self.statistics = {}
+    self.generation = None
+
+  def setDatabase( self, database ):
+    self.db = database
+
+  def createTables( self ):
+    """ Create the statistics table if it does not exist yet
+    """
+    req = "CREATE TABLE IF NOT EXISTS FC_MetaStats ( MetaType CHAR(1) NOT NULL, MetaName VARCHAR(64) NOT NULL, "
+    req += "NRows BIGINT NOT NULL DEFAULT 0, NDistinct BIGINT NOT NULL DEFAULT 0, Statistics BLOB, "
+    req += "LastUpdate DATETIME, PRIMARY KEY (MetaType,MetaName) )"
+    return self.db._update( req )
+
+  def __getTable( self, metaType, meta ):
+    if metaType == 'F':
+      return 'FC_FileMeta_%s' % meta
+    return 'FC_Meta_%s' % meta
+
+  ############################################################################
+  #
+  #  Collection
+  #
+
+  def __collectField( self, metaType, meta ):
+    """ Compute the statistics of one metadata field
+    """
+    table = self.__getTable( metaType, meta )
+    req = "SELECT COUNT(*),COUNT(DISTINCT Value),MIN(Value),MAX(Value) FROM %s" % table
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    nRows, nDistinct, minValue, maxValue = result['Value'][0]
+    statDict = { 'NRows' : int( nRows ), 'NDistinct' : int( nDistinct ), 'MCV' : {} }
+
+    req = "SELECT Value,COUNT(*) AS N FROM %s GROUP BY Value ORDER BY N DESC LIMIT %d" % ( table, MCV_SIZE )
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    for value, count in result['Value']:
+      statDict['MCV'][str( value )] = int( count )
+
+    if type( minValue ) in NUMERIC_TYPES and type( maxValue ) in NUMERIC_TYPES:
+      width = float( maxValue - minValue ) / HISTOGRAM_SIZE
+      if width <= 0:
+        width = 1.
+      histogram = [ 0 ] * HISTOGRAM_SIZE
+      req = "SELECT FLOOR((Value-%s)/%s),COUNT(*) FROM %s GROUP BY 1" % ( minValue, width, table )
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      for bucket, count in result['Value']:
+        # The maximum value falls into the last bucket
+        histogram[min( int( bucket ), HISTOGRAM_SIZE - 1 )] += int( count )
+      statDict['Min'] = float( minValue )
+      statDict['Width'] = width
+      statDict['Histogram'] = histogram
+
+    return S_OK( statDict )
+
+  def collectStatistics( self, credDict, metaType = '' ):
+    """ Refresh the statistics of all the directory ( metaType 'D' ) and/or
+        file ( metaType 'F' ) metadata fields
+    """
+    fieldDict = {}
+    if metaType in [ '', 'D' ]:
+      result = self.db.dmeta.getMetadataFields( credDict )
+      if not result['OK']:
+        return result
+      fieldDict['D'] = [ meta for meta, ptype in result['Value'].items() if ptype != 'MetaSet' ]
+    if metaType in [ '', 'F' ]:
+      result = self.db.fmeta.getFileMetadataFields( credDict )
+      if not result['OK']:
+        return result
+      fieldDict['F'] = [ meta for meta, ptype in result['Value'].items() if ptype != 'MetaSet' ]
+
+    successful = {}
+    failed = {}
+    for mType, metaList in fieldDict.items():
+      req = "DELETE FROM FC_MetaStats WHERE MetaType='%s'" % mType
+      if metaList:
+        req += " AND MetaName NOT IN (%s)" % ','.join( [ formatValue( meta ) for meta in metaList ] )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+      for meta in metaList:
+        result = self.__collectField( mType, meta )
+        if result['OK']:
+          statDict = result['Value']
+          req = "REPLACE INTO FC_MetaStats (MetaType,MetaName,NRows,NDistinct,Statistics,LastUpdate) "
+          req += "VALUES ('%s',%s,%d,%d,%s,UTC_TIMESTAMP())" % ( mType, formatValue( meta ), statDict['NRows'],
+                                                                 statDict['NDistinct'],
+                                                                 formatValue( DEncode.encode( statDict ) ) )
+          result = self.db._update( req )
+        if not result['OK']:
+          failed[meta] = result['Message']
+          gLogger.warn( 'Failed to collect the statistics of %s' % meta, result['Message'] )
+        else:
+          successful[meta] = statDict['NRows']
+
+    result = self.db.bumpGeneration( 'MetaStats' )
+    if not result['OK']:
+      gLogger.warn( 'Failed to update the MetaStats generation', result['Message'] )
+    return S_OK( { 'Successful' : successful, 'Failed' : failed } )
+
+  def getStatistics( self ):
+    """ Get the current statistics as { metaType : { meta : statDict } }
+    """
+    result = self.db.getGeneration( 'MetaStats' )
+    if not result['OK']:
+      return result
+    generation = result['Value']
+    if generation == self.generation:
+      return S_OK( self.statistics )
+
+    req = "SELECT MetaType,MetaName,Statistics,LastUpdate FROM FC_MetaStats"
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    statistics = { 'D' : {}, 'F' : {} }
+    for metaType, meta, encoded, lastUpdate in result['Value']:
+      try:
+        statDict = DEncode.decode( encoded )[0]
+      except Exception, x:
+        gLogger.warn( 'Bad statistics record for %s' % meta, str( x ) )
+        continue
+      statDict['LastUpdate'] = str( lastUpdate )
+      statistics.setdefault( metaType, {} )[meta] = statDict
+
+    self.statistics = statistics
+    self.generation = generation
+    return S_OK( statistics )
+
+  ############################################################################
+  #
+  #  Estimation
+  #
+
+  def __estimateEqual( self, statDict, value ):
+    key = str( value )
+    if key in statDict['MCV']:
+      return statDict['MCV'][key]
+    if len( statDict['MCV'] ) >= statDict['NDistinct']:
+      # All the values are known and this one is not among them
+      return 0
+    rest = statDict['NRows'] - sum( statDict['MCV'].values() )
+    return max( rest / float( statDict['NDistinct'] - len( statDict['MCV'] ) ), 1. )
+
+  def __estimateRange( self, statDict, low, high ):
+    if not 'Histogram' in statDict:
+      # No distribution known for non numeric values
+      return statDict['NRows'] / 3.
+    width = statDict['Width']
+    histogram = statDict['Histogram']
+    estimate = 0.
+    for i in range( len( histogram ) ):
+      bucketLow = statDict['Min'] + i * width
+      if low == high:
+        # A single value, assume the distinct values evenly spread over the buckets
+        if bucketLow <= low <= bucketLow + width:
+          return histogram[i] * len( histogram ) / float( max( statDict['NDistinct'], 1 ) )
+        continue
+      overlap = min( high, bucketLow + width ) - max( low, bucketLow )
+      if overlap > 0:
+        estimate += histogram[i] * overlap / width
+    return estimate
+
+  def __estimateOperation( self, statDict, operation, operand ):
+    if operation in [ 'in', '=' ]:
+      if type( operand ) == types.ListType:
+        return sum( [ self.__estimateEqual( statDict, x ) for x in operand ] )
+      return self.__estimateEqual( statDict, operand )
+    if operation in [ 'nin', '!=' ]:
+      if type( operand ) == types.ListType:
+        excluded = sum( [ self.__estimateEqual( statDict, x ) for x in operand ] )
+      else:
+        excluded = self.__estimateEqual( statDict, operand )
+      return max( statDict['NRows'] - excluded, 0 )
+    return statDict['NRows']
+
+  def estimateRows( self, metaType, meta, value ):
+    """ Estimate the number of rows of the metadata table selected by the
+        query value. Returns None if there are no statistics for the field
+    """
+    result = self.getStatistics()
+    if not result['OK']:
+      return None
+    statDict = result['Value'].get( metaType, {} ).get( meta )
+    if statDict is None:
+      return None
+
+    if type( value ) == types.ListType:
+      return sum( [ self.__estimateEqual( statDict, x ) for x in value ] )
+    if type( value ) != types.DictType:
+      if value == "Any":
+        return statDict['NRows']
+      return self.__estimateEqual( statDict, value )
+
+    estimate = statDict['NRows']
+    low = high = None
+    for operation, operand in value.items():
+      if operation in [ '>', '>=' ]:
+        low = operand
+      elif operation in [ '<', '<=' ]:
+        high = operand
+      else:
+        estimate = min( estimate, self.__estimateOperation( statDict, operation, operand ) )
+    if low is not None or high is not None:
+      try:
+        low = float( low ) if low is not None else float( '-inf' )
+        high = float( high ) if high is not None else float( 'inf' )
+        estimate = min( estimate, self.__estimateRange( statDict, low, high ) )
+      except ( TypeError, ValueError ):
+        estimate = min( estimate, statDict['NRows'] / 3. )
+    return estimate
+
+  def orderConstraints( self, metaType, metaDict ):
+    """ Get the ( meta, value ) items of the query ordered by the estimated
+        number of selected rows, the fields without statistics and the
+        Missing constraints coming last
+    """
+    estimated = []
+    for meta, value in metaDict.items():
+      estimate = None
+      if value != "Missing":
+        estimate = self.estimateRows( metaType, meta, value )
+      if estimate is None:
+        estimate = float( 'inf' )
+      estimated.append( ( estimate, meta, value ) )
+    estimated.sort()
+    return [ ( meta, value ) for _estimate, meta, value in estimated ]
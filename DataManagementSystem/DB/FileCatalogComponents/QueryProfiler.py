@@ -0,0 +1,114 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog profiler of the metadata queries. A profile is attached
+    to the thread serving the request. The methods decorated with
+    profileStage open a stage of the profile and every database round trip
+    made while the profile is active is recorded, with its SQL text, number
+    of rows and time, in the innermost open stage
+"""
+
+__RCSID__ = "$Id$"
+
+import time, threading, types
+from DIRAC import S_OK
+
+# Longest SQL text kept in the profile
+MAX_SQL_LENGTH = 2000
+
+gThreadProfile = threading.local()
+
+class QueryProfile:
+  """ Per stage record of the database round trips of a request
+  """
+
+  def __init__( self ):
+    self.start = time.time()
+    self.stages = []
+    self.openStages = []
+    self.explains = []
+    self.startStage( 'Total' )
+
+  def startStage( self, name ):
+    stage = { 'Stage'      : name,
+              'Depth'      : len( self.openStages ),
+              'Start'      : time.time(),
+              'Time'       : 0.,
+              'RoundTrips' : 0,
+              'Rows'       : 0,
+              'Queries'    : [] }
+    self.stages.append( stage )
+    self.openStages.append( stage )
+
+  def endStage( self ):
+    stage = self.openStages.pop()
+    stage['Time'] = time.time() - stage.pop( 'Start' )
+
+  def recordQuery( self, sql, result, queryTime ):
+    """ Record one database round trip in the innermost open stage
+    """
+    rows = 0
+    if result['OK']:
+      if type( result['Value'] ) in [ types.TupleType, types.ListType ]:
+        rows = len( result['Value'] )
+      elif type( result['Value'] ) in [ types.IntType, types.LongType ]:
+        # Number of affected rows
+        rows = result['Value']
+    queryDict = { 'SQL'  : sql[:MAX_SQL_LENGTH],
+                  'Rows' : rows,
+                  'Time' : queryTime }
+    if not result['OK']:
+      queryDict['Error'] = result['Message']
+    stage = self.openStages[-1]
+    stage['Queries'].append( queryDict )
+    stage['RoundTrips'] += 1
+    stage['Rows'] += rows
+
+  def addExplain( self, sql, plan ):
+    """ Keep the execution plan of a statement
+    """
+    self.explains.append( { 'SQL' : sql[:MAX_SQL_LENGTH], 'Plan' : plan } )
+
+  def getReport( self ):
+    while self.openStages:
+      self.endStage()
+    return { 'TotalTime'  : time.time() - self.start,
+             'RoundTrips' : sum( [ stage['RoundTrips'] for stage in self.stages ] ),
+             'Stages'     : self.stages,
+             'Explain'    : self.explains }
+
+def getProfile():
+  """ Get the profile of the current thread, None if not profiling
+  """
+  return getattr( gThreadProfile, 'profile', None )
+
+def profileCall( method, *args ):
+  """ Call the method with a profile attached to the current thread. The
+      result of the call goes to result['Value']['Result'] and the profile
+      report to result['Value']['Profile']
+  """
+  gThreadProfile.profile = QueryProfile()
+  try:
+    result = method( *args )
+  finally:
+    report = gThreadProfile.profile.getReport()
+    gThreadProfile.profile = None
+  return S_OK( { 'Result' : result, 'Profile' : report } )
+
+def profileStage( method ):
+  """ Decorator making a profile stage of the method, named after it
+  """
+  name = method.__name__.lstrip( '_' )
+  def profiled( *args, **kwargs ):
+    profile = getProfile()
+    if profile is None:
+      return method( *args, **kwargs )
+    profile.startStage( name )
+    try:
+      return method( *args, **kwargs )
+    finally:
+      profile.endStage()
+  profiled.__name__ = method.__name__
+  profiled.__doc__ = method.__doc__
+  return profiled
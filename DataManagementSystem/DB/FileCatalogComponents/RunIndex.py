@@ -0,0 +1,199 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog run range index. The runL/runH metadata of the files or
+    directories are kept as intervals in a single table sorted by the lower
+    run. The length of the longest interval bounds the index scan of the run
+    coverage and overlap queries:
+
+    { 'run' : { 'covers' : 11414 } }
+    { 'run' : { 'overlaps' : [ 11400, 11500 ] } }
+"""
+
+__RCSID__ = "$Id$"
+
+import types
+from DIRAC import S_OK, S_ERROR
+
+# Pseudo metadata name of the run queries
+RUN_QUERY_KEY = 'run'
+# Number of files or directories refreshed by one statement
+RUN_CHUNK_SIZE = 1000
+
+def isRunQuery( key, value ):
+  """ Check if the query item is a run range query
+  """
+  return key == RUN_QUERY_KEY and type( value ) == types.DictType and \
+         ( 'covers' in value or 'overlaps' in value )
+
+class RunIndex:
+
+  def __init__( self, database = None, lowField = 'runL', highField = 'runH' ):
+    self.db = database
+    self.lowField = lowField
+    self.highField = highField
+
+  def setDatabase( self, database ):
+    self.db = database
+
+  def createTables( self ):
+    """ Create the index tables if they do not exist yet
+    """
+    req = "CREATE TABLE IF NOT EXISTS FC_RunIndex ( ObjType CHAR(1) NOT NULL, ObjID INTEGER NOT NULL, "
+    req += "RunL INTEGER NOT NULL, RunH INTEGER NOT NULL, PRIMARY KEY (ObjType,ObjID), INDEX (ObjType,RunL,RunH) )"
+    result = self.db._update( req )
+    if not result['OK']:
+      return result
+    req = "CREATE TABLE IF NOT EXISTS FC_RunIndexSpan ( ObjType CHAR(1) NOT NULL, "
+    req += "MaxSpan INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (ObjType) )"
+    return self.db._update( req )
+
+  def isIndexed( self, metaNames, metaFields ):
+    """ Check if setting the given metadata changes the run ranges
+    """
+    if not self.lowField in metaFields or not self.highField in metaFields:
+      return False
+    return self.lowField in metaNames or self.highField in metaNames
+
+  def getIndexType( self, credDict ):
+    """ Get 'F' if the run range is file metadata, 'D' if it is directory
+        metadata and an empty string if the run fields are not defined
+    """
+    result = self.db.fmeta.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    if self.lowField in result['Value'] and self.highField in result['Value']:
+      return S_OK( 'F' )
+    result = self.db.dmeta.getMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    if self.lowField in result['Value'] and self.highField in result['Value']:
+      return S_OK( 'D' )
+    return S_OK( '' )
+
+  def __getMetaTables( self, objType ):
+    if objType == 'F':
+      return 'FC_FileMeta_%s', 'FileID'
+    return 'FC_Meta_%s', 'DirID'
+
+  def __getMaxSpan( self, objType ):
+    req = "SELECT MaxSpan FROM FC_RunIndexSpan WHERE ObjType='%s'" % objType
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    if not result['Value']:
+      return S_OK( 0 )
+    return S_OK( int( result['Value'][0][0] ) )
+
+  def __updateMaxSpan( self, objType, idString = '' ):
+    """ The longest interval only grows, it is recomputed by the rebuild
+    """
+    req = "INSERT INTO FC_RunIndexSpan (ObjType,MaxSpan) SELECT ObjType,MAX(RunH-RunL) FROM FC_RunIndex "
+    req += "WHERE ObjType='%s'" % objType
+    if idString:
+      req += " AND ObjID IN (%s)" % idString
+    req += " GROUP BY ObjType ON DUPLICATE KEY UPDATE MaxSpan=GREATEST(MaxSpan,VALUES(MaxSpan))"
+    return self.db._update( req )
+
+  def getRunCondition( self, alias, objType, value ):
+    """ Get the SQL condition of the run query on the index table alias
+    """
+    result = self.__getMaxSpan( objType )
+    if not result['OK']:
+      return result
+    maxSpan = result['Value']
+
+    conditions = [ "%s.ObjType='%s'" % ( alias, objType ) ]
+    for operation, operand in value.items():
+      try:
+        if operation == 'covers':
+          low = high = int( operand )
+        elif operation == 'overlaps':
+          low, high = [ int( x ) for x in operand ]
+        else:
+          return S_ERROR( 'Illegal run query: unknown operation %s' % operation )
+      except ( TypeError, ValueError ):
+        return S_ERROR( 'Illegal run query: bad operand for %s' % operation )
+      if low > high:
+        return S_ERROR( 'Illegal run query: empty run range %d-%d' % ( low, high ) )
+      # Intervals starting more than the longest span before the range can not reach it
+      conditions.append( '%s.RunL BETWEEN %d AND %d' % ( alias, low - maxSpan, high ) )
+      conditions.append( '%s.RunH>=%d' % ( alias, low ) )
+    return S_OK( ' AND '.join( conditions ) )
+
+  def findIDs( self, objType, value ):
+    """ Get the IDs of the files or directories satisfying the run query
+    """
+    result = self.getRunCondition( 'R', objType, value )
+    if not result['OK']:
+      return result
+    req = "SELECT R.ObjID FROM FC_RunIndex AS R WHERE %s" % result['Value']
+    result = self.db._query( req )
+    if not result['OK']:
+      return result
+    return S_OK( [ row[0] for row in result['Value'] ] )
+
+  def update( self, objType, objIDs ):
+    """ Refresh the index entries of the given files ( objType 'F' ) or
+        directories ( objType 'D' ) from their metadata
+    """
+    table, idColumn = self.__getMetaTables( objType )
+    lowTable = table % self.lowField
+    highTable = table % self.highField
+    for i in range( 0, len( objIDs ), RUN_CHUNK_SIZE ):
+      idString = ','.join( [ str( x ) for x in objIDs[i:i + RUN_CHUNK_SIZE] ] )
+      req = "DELETE FROM FC_RunIndex WHERE ObjType='%s' AND ObjID IN (%s)" % ( objType, idString )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+      req = "INSERT INTO FC_RunIndex (ObjType,ObjID,RunL,RunH) SELECT '%s',L.%s,L.Value,H.Value " % ( objType, idColumn )
+      req += "FROM %s AS L JOIN %s AS H ON H.%s=L.%s " % ( lowTable, highTable, idColumn, idColumn )
+      req += "WHERE L.%s IN (%s) AND H.Value>=L.Value" % ( idColumn, idString )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+      result = self.__updateMaxSpan( objType, idString )
+      if not result['OK']:
+        return result
+    return S_OK()
+
+  def remove( self, objType, objIDs ):
+    """ Drop the index entries of the given removed files or directories
+    """
+    for i in range( 0, len( objIDs ), RUN_CHUNK_SIZE ):
+      idString = ','.join( [ str( x ) for x in objIDs[i:i + RUN_CHUNK_SIZE] ] )
+      req = "DELETE FROM FC_RunIndex WHERE ObjType='%s' AND ObjID IN (%s)" % ( objType, idString )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+    return S_OK()
+
+  def rebuild( self, credDict ):
+    """ Fill again the index from the run metadata tables
+    """
+    result = self.getIndexType( credDict )
+    if not result['OK']:
+      return result
+    objType = result['Value']
+
+    for req in [ "DELETE FROM FC_RunIndex", "DELETE FROM FC_RunIndexSpan" ]:
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+    if not objType:
+      return S_OK( 0 )
+
+    table, idColumn = self.__getMetaTables( objType )
+    req = "INSERT INTO FC_RunIndex (ObjType,ObjID,RunL,RunH) SELECT '%s',L.%s,L.Value,H.Value " % ( objType, idColumn )
+    req += "FROM %s AS L JOIN %s AS H ON H.%s=L.%s " % ( table % self.lowField, table % self.highField,
+                                                        idColumn, idColumn )
+    req += "WHERE H.Value>=L.Value"
+    result = self.db._update( req )
+    if not result['OK']:
+      return result
+    nIntervals = result['Value']
+    result = self.__updateMaxSpan( objType )
+    if not result['OK']:
+      return result
+    return S_OK( nIntervals )
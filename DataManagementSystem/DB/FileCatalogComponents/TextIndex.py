@@ -0,0 +1,158 @@
+########################################################################
+# $HeadURL$
+########################################################################
+
+""" DIRAC FileCatalog trigram index of free text file metadata. For the file
+    metadata fields listed in the TextIndexFields option every three character
+    sequence of the ( lower case ) values is kept in the FC_TextIndex table.
+    The substring queries
+
+    { 'description' : { 'contains' : 'psi(3770)' } }
+
+    then only check the files having all the trigrams of the searched text
+    instead of scanning the whole field table. Prefix queries
+
+    { 'description' : { 'startswith' : 'jobOptions_sim' } }
+
+    are served by the index of the field table itself
+"""
+
+__RCSID__ = "$Id$"
+
+import types
+from DIRAC import S_OK, gLogger
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.MetaQueryCompiler import formatValue
+
+# Length of the indexed character sequences
+GRAM_SIZE = 3
+# Number of files or index rows handled by one statement
+TEXT_CHUNK_SIZE = 1000
+
+def getGrams( text ):
+  """ Get the set of trigrams of the text
+  """
+  text = str( text ).lower()
+  return set( [ text[i:i + GRAM_SIZE] for i in range( len( text ) - GRAM_SIZE + 1 ) ] )
+
+class TextIndex:
+
+  def __init__( self, database = None, fields = [] ):
+    self.db = database
+    self.fields = list( fields )
+
+  def setDatabase( self, database ):
+    self.db = database
+
+  def createTables( self ):
+    """ Create the index table if it does not exist yet
+    """
+    req = "CREATE TABLE IF NOT EXISTS FC_TextIndex ( MetaName VARCHAR(64) NOT NULL, Gram VARBINARY(%d) NOT NULL, " % GRAM_SIZE
+    req += "FileID INTEGER NOT NULL, PRIMARY KEY (MetaName,Gram,FileID), INDEX (FileID) )"
+    return self.db._update( req )
+
+  def isIndexed( self, metaNames ):
+    """ Get the indexed fields among the given metadata names
+    """
+    return [ meta for meta in metaNames if meta in self.fields ]
+
+  def getTextSelection( self, meta, value ):
+    """ Get the statement selecting the FileIDs of the candidate files of a
+        'contains' query on an indexed field, or an empty string if the index
+        can not help: the field is not indexed or the text is too short
+    """
+    if not meta in self.fields or type( value ) != types.DictType:
+      return ''
+    if type( value.get( 'contains' ) ) not in types.StringTypes:
+      return ''
+    grams = getGrams( value['contains'] )
+    if not grams:
+      return ''
+    req = "SELECT FileID FROM FC_TextIndex WHERE MetaName=%s AND Gram IN (%s) GROUP BY FileID HAVING COUNT(*)=%d" % \
+          ( formatValue( meta ), ','.join( [ formatValue( gram ) for gram in grams ] ), len( grams ) )
+    return req
+
+  def __insertGrams( self, meta, rows ):
+    """ Index the values of the ( fileID, value ) rows
+    """
+    insertList = []
+    for fileID, value in rows:
+      if value is None:
+        continue
+      for gram in getGrams( value ):
+        insertList.append( "(%s,%s,%d)" % ( formatValue( meta ), formatValue( gram ), fileID ) )
+    for i in range( 0, len( insertList ), TEXT_CHUNK_SIZE ):
+      req = "INSERT IGNORE INTO FC_TextIndex (MetaName,Gram,FileID) VALUES %s" % \
+            ','.join( insertList[i:i + TEXT_CHUNK_SIZE] )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+    return S_OK()
+
+  def update( self, meta, fileIDs ):
+    """ Index again the value of the field for the given files
+    """
+    for i in range( 0, len( fileIDs ), TEXT_CHUNK_SIZE ):
+      idString = ','.join( [ str( fileID ) for fileID in fileIDs[i:i + TEXT_CHUNK_SIZE] ] )
+      req = "DELETE FROM FC_TextIndex WHERE MetaName=%s AND FileID IN (%s)" % ( formatValue( meta ), idString )
+      result = self.db._update( req )
+      if not result['OK']:
+        return result
+      req = "SELECT FileID,Value FROM FC_FileMeta_%s WHERE FileID IN (%s)" % ( meta, idString )
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      result = self.__insertGrams( meta, result['Value'] )
+      if not result['OK']:
+        return result
+    return S_OK()
+
+  def remove( self, meta ):
+    """ Drop the index of the field
+    """
+    return self.db._update( "DELETE FROM FC_TextIndex WHERE MetaName=%s" % formatValue( meta ) )
+
+  def rebuildField( self, meta ):
+    """ Index all the values of the field, reading them by chunks
+    """
+    result = self.remove( meta )
+    if not result['OK']:
+      return result
+    indexed = 0
+    lastID = 0
+    while True:
+      req = "SELECT FileID,Value FROM FC_FileMeta_%s WHERE FileID>%d ORDER BY FileID LIMIT %d" % \
+            ( meta, lastID, TEXT_CHUNK_SIZE )
+      result = self.db._query( req )
+      if not result['OK']:
+        return result
+      if not result['Value']:
+        break
+      rows = result['Value']
+      lastID = rows[-1][0]
+      result = self.__insertGrams( meta, rows )
+      if not result['OK']:
+        return result
+      indexed += len( rows )
+    return S_OK( indexed )
+
+  def rebuild( self, credDict ):
+    """ Index again all the text fields defined as file metadata
+    """
+    result = self.db.fmeta.getFileMetadataFields( credDict )
+    if not result['OK']:
+      return result
+    metaFields = result['Value']
+
+    successful = {}
+    failed = {}
+    for meta in self.fields:
+      if not meta in metaFields:
+        failed[meta] = 'Not a file metadata field'
+        continue
+      result = self.rebuildField( meta )
+      if not result['OK']:
+        failed[meta] = result['Message']
+        gLogger.warn( 'Failed to rebuild the text index of %s' % meta, result['Message'] )
+      else:
+        successful[meta] = result['Value']
+    return S_OK( { 'Successful' : successful, 'Failed' : failed } )
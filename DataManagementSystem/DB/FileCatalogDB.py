@@ -5,6 +5,7 @@
 
 __RCSID__ = "$Id$"
 
+import time, threading
 from DIRAC                                                                     import gLogger, S_OK, S_ERROR
 from DIRAC.Core.Base.DB                                                        import DB
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryMetadata  import DirectoryMetadata
@@ -12,6 +13,7 @@ from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.FileMetadata
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectorySimpleTree   import DirectorySimpleTree 
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryNodeTree     import DirectoryNodeTree 
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryLevelTree    import DirectoryLevelTree
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryClosureTree  import DirectoryClosureTree
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DirectoryFlatTree     import DirectoryFlatTree
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.FileManagerFlat       import FileManagerFlat
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.FileManager           import FileManager
@@ -19,6 +21,11 @@ from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.SEManager
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.SecurityManager       import NoSecurityManager,DirectorySecurityManager,FullSecurityManager
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.UserAndGroupManager   import UserAndGroupManagerCS,UserAndGroupManagerDB
 from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.Utilities             import checkArgumentDict 
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.RunIndex              import RunIndex
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.MetadataStatistics    import MetadataStatistics
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.QueryProfiler         import getProfile
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.DatasetSnapshots      import DatasetSnapshots
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.TextIndex             import TextIndex
 
 #############################################################################
 class FileCatalogDB(DB):
@@ -53,6 +60,23 @@ class FileCatalogDB(DB):
     self.resolvePfn = databaseConfig['ResolvePFN']
     self.umask = databaseConfig['DefaultUmask']
     self.visibleStatus = databaseConfig['VisibleStatus']
+    self.generationCheckInterval = databaseConfig.get( 'GenerationCheckInterval', 10 )
+    self.effectiveMetadata = databaseConfig.get( 'EffectiveMetadata', False )
+    self.metadataFacets = databaseConfig.get( 'MetadataFacets', False )
+    self.facetEventField = databaseConfig.get( 'FacetEventField', 'eventNum' )
+    self.deferredMetadataCleanup = databaseConfig.get( 'DeferredMetadataCleanup', False )
+    # The Catalog generation is only kept up to date for the query result cache
+    # and the facet index
+    self.queryCacheEnabled = databaseConfig.get( 'QueryCacheSize', 0 ) > 0
+    if self.metadataFacets and not self.effectiveMetadata:
+      gLogger.warn( "The metadata facet index needs EffectiveMetadata, not using it" )
+      self.metadataFacets = False
+
+    # In memory caches validated by the generation counters
+    self.generations = {}
+    self.generationLock = threading.Lock()
+    self.metaFields = {}
+    self.metaSets = None
 
     try:
       # Obtain the plugins to be used for DB interaction
@@ -66,12 +90,98 @@ class FileCatalogDB(DB):
     except Exception, x:
       gLogger.fatal("Failed to create database objects",x)
       return S_ERROR("Failed to create database objects")
+    self.dtree.setDirectoryCache( databaseConfig.get( 'DirectoryCacheSize', 100000 ) )
+
+    req = "CREATE TABLE IF NOT EXISTS FC_Generations ( Name VARCHAR(64) NOT NULL, "
+    req += "Generation BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (Name) )"
+    result = self._update( req )
+    if not result['OK']:
+      gLogger.fatal("Failed to create the generation table",result['Message'])
+      return result
+
+    req = "CREATE TABLE IF NOT EXISTS FC_DirMetaTombstones ( DirID INTEGER NOT NULL, "
+    req += "RemovalDate DATETIME, PRIMARY KEY (DirID) )"
+    result = self._update( req )
+    if not result['OK']:
+      gLogger.fatal("Failed to create the directory tombstone table",result['Message'])
+      return result
+
+    if isinstance( self.dtree, DirectoryLevelTree ):
+      result = self.dtree.createIndexes()
+      if not result['OK']:
+        gLogger.fatal("Failed to create the enumerated path index",result['Message'])
+        return result
+
+    if isinstance( self.dtree, DirectoryClosureTree ):
+      result = self.dtree.createTables()
+      if not result['OK']:
+        gLogger.fatal("Failed to create the directory closure table",result['Message'])
+        return result
+
+    if self.metadataFacets:
+      result = self.dmeta.createFacetTables()
+      if not result['OK']:
+        gLogger.fatal("Failed to create the metadata facet tables",result['Message'])
+        return result
+
+    self.snapshots = DatasetSnapshots(self)
+    result = self.snapshots.createTables()
+    if not result['OK']:
+      gLogger.fatal("Failed to create the dataset snapshot table",result['Message'])
+      return result
+
+    self.runIndex = None
+    if databaseConfig.get( 'RunIndex', False ):
+      self.runIndex = RunIndex( self, databaseConfig.get( 'RunLowField', 'runL' ),
+                                databaseConfig.get( 'RunHighField', 'runH' ) )
+      result = self.runIndex.createTables()
+      if not result['OK']:
+        gLogger.fatal("Failed to create the run index tables",result['Message'])
+        return result
+
+    self.textIndex = None
+    if databaseConfig.get( 'TextIndexFields', [] ):
+      self.textIndex = TextIndex( self, databaseConfig['TextIndexFields'] )
+      result = self.textIndex.createTables()
+      if not result['OK']:
+        gLogger.fatal("Failed to create the text index table",result['Message'])
+        return result
+
+    self.metaStats = None
+    if databaseConfig.get( 'MetadataStatistics', False ):
+      self.metaStats = MetadataStatistics( self )
+      result = self.metaStats.createTables()
+      if not result['OK']:
+        gLogger.fatal("Failed to create the metadata statistics table",result['Message'])
+        return result
 
     return S_OK()
     
   def setUmask(self,umask):
     self.umask = umask
 
+  def _query(self,cmd,conn=False):
+    """ Execute the query, recording it in the profile of the request if any
+    """
+    profile = getProfile()
+    if profile is None:
+      return DB._query(self,cmd,conn)
+    start = time.time()
+    result = DB._query(self,cmd,conn)
+    profile.recordQuery(cmd,result,time.time()-start)
+    return result
+
+  def _update(self,cmd,conn=False):
+    """ Execute the update, recording it in the profile of the request if any
+    """
+    profile = getProfile()
+    if profile is None:
+      return DB._update(self,cmd,conn)
+    start = time.time()
+    result = DB._update(self,cmd,conn)
+    profile.recordQuery(cmd,result,time.time()-start)
+    return result
+
   ########################################################################
   #
   #  SE based write methods
@@ -251,6 +361,8 @@ class FileCatalogDB(DB):
       return res
     failed.update(res['Value']['Failed'])
     successful = res['Value']['Successful']
+    if successful:
+      self.catalogChanged()
     return S_OK( {'Successful':successful,'Failed':failed} )
   
   def removeFile(self, lfns, credDict):
@@ -263,6 +375,8 @@ class FileCatalogDB(DB):
       return res
     failed.update(res['Value']['Failed'])
     successful = res['Value']['Successful']
+    if successful:
+      self.catalogChanged()
     return S_OK( {'Successful':successful,'Failed':failed} )
   
   def addReplica(self, lfns, credDict):
@@ -498,6 +612,24 @@ class FileCatalogDB(DB):
     successful = res['Value']['Successful']
     return S_OK( {'Successful':successful,'Failed':failed} )
 
+  def makeDirectoryTree(self,paths,metaDict,credDict):
+    """ Create the directories with all their missing parents and set their
+        directory metadata, the new directories in one transaction
+    """
+    res = self._checkPathPermissions('Write', list(paths) + metaDict.keys(), credDict)
+    if not res['OK']:
+      return res
+    failed = res['Value']['Failed']
+    allowed = res['Value']['Successful']
+    paths = [ path for path in paths if path in allowed ]
+    metaDict = dict( [ (path,meta) for path,meta in metaDict.items() if path in allowed ] )
+    res = self.dtree.makeDirectoryTree(paths,metaDict,credDict)
+    if not res['OK']:
+      return res
+    self.catalogChanged()
+    failed.update(res['Value']['Failed'])
+    return S_OK( {'Successful':res['Value']['Successful'],'Failed':failed} )
+
   def removeDirectory(self,lfns,credDict):
     res = self._checkPathPermissions('Write', lfns, credDict)
     if not res['OK']:
@@ -514,6 +646,7 @@ class FileCatalogDB(DB):
         return S_OK( {'Successful':successful,'Failed':failed} )
     else:
       return S_OK( {'Successful':successful,'Failed':failed} )
+    self.catalogChanged()
     
     # Remove the directory metadata now
     dirIdList = [ successful[p]['DirID'] for p in successful ]
@@ -522,7 +655,7 @@ class FileCatalogDB(DB):
       return result
     failed.update(result['Value']['Failed'])
     successful = result['Value']['Successful']
-    return S_OK( {'Successful':successful,'Failed':failed} )
+    return S_OK( {'Successful':successful,'Failed':failed,'Deferred':result['Value']['Deferred']} )
 
   ########################################################################
   #
@@ -617,10 +750,12 @@ class FileCatalogDB(DB):
       return S_ERROR('Failed to determine the path type')
     if result['Value']['Successful'][path]:
       # This is a directory
-      return self.dmeta.setMetadata(path,metadataDict,credDict)
+      result = self.dmeta.setMetadata(path,metadataDict,credDict)
     else:
       # This is a file      
-      return self.fmeta.setMetadata(path,metadataDict,credDict)      
+      result = self.fmeta.setMetadata(path,metadataDict,credDict)
+    self.catalogChanged()
+    return result      
     
   def removeMetadata(self, path, metadata, credDict):
     """ Add metadata to the given path
@@ -640,11 +775,160 @@ class FileCatalogDB(DB):
       return S_ERROR('Failed to determine the path type')
     if result['Value']['Successful'][path]:
       # This is a directory
-      return self.dmeta.removeMetadata(path,metadata,credDict)
+      result = self.dmeta.removeMetadata(path,metadata,credDict)
     else:
       # This is a file      
-      return self.fmeta.removeMetadata(path,metadata,credDict)                                  
-    
+      result = self.fmeta.removeMetadata(path,metadata,credDict)
+    self.catalogChanged()
+    return result
+
+  def setFileMetadataBulk(self, lfns, credDict):
+    """ Add metadata to many files, lfns is a dictionary { lfn : metadataDict }
+    """
+    res = self._checkPathPermissions('Write', lfns, credDict)
+    if not res['OK']:
+      return res
+    failed = res['Value']['Failed']
+    res = self.fmeta.setFileMetadataBulk(res['Value']['Successful'],credDict)
+    if not res['OK']:
+      return res
+    failed.update(res['Value']['Failed'])
+    successful = res['Value']['Successful']
+    if successful:
+      self.catalogChanged()
+    return S_OK( {'Successful':successful,'Failed':failed} )
+
+  def rebuildEffectiveMetadata(self,credDict):
+    """ Fill again the effective directory metadata tables
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    if not self.effectiveMetadata:
+      return S_ERROR("Effective metadata tables are not enabled")
+    return self.dmeta.rebuildEffectiveMetadata(credDict)
+
+  def rebuildRunIndex(self,credDict):
+    """ Fill again the run range index from the run metadata
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    if not self.runIndex:
+      return S_ERROR("Run index is not enabled")
+    result = self.runIndex.rebuild(credDict)
+    self.catalogChanged()
+    return result
+
+  def rebuildTextIndex(self,credDict):
+    """ Fill again the trigram index of the text metadata fields
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    if not self.textIndex:
+      return S_ERROR("Text index is not enabled")
+    result = self.textIndex.rebuild(credDict)
+    self.catalogChanged()
+    return result
+
+  def refreshMetadataStatistics(self,credDict,metaType=''):
+    """ Collect again the statistics of the metadata values
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    if not self.metaStats:
+      return S_ERROR("Metadata statistics are not enabled")
+    return self.metaStats.collectStatistics(credDict,metaType)
+
+  def sweepMetadataTombstones(self,credDict):
+    """ Remove the metadata of the directories removed with a deferred cleanup
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    return self.dmeta.sweepMetadataTombstones(credDict)
+
+  def createDatasetSnapshot(self,setName,credDict,refresh=False):
+    """ Freeze the file list of the metadata set. The metadata sets have no
+        owner, the snapshots are managed by the catalog administrators
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    return self.snapshots.createSnapshot(setName,credDict,refresh)
+
+  def removeDatasetSnapshot(self,setName,credDict):
+    """ Drop the snapshot of the metadata set
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    return self.snapshots.removeSnapshot(setName)
+
+  def rebuildDirectoryClosure(self,credDict):
+    """ Fill again the directory closure table from the directory tree
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    if not isinstance( self.dtree, DirectoryClosureTree ):
+      return S_ERROR("Directory closure table needs the DirectoryClosureTree")
+    result = self.dtree.rebuildClosure()
+    self.catalogChanged()
+    return result
+
+  def benchmarkSubdirectoryExpansion(self,path,depth,credDict):
+    """ Time the expansion of the subtrees of the directories depth levels below path
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    if self.dtree.getTreeTable() != 'FC_DirectoryLevelTree':
+      return S_ERROR("Subtree expansion benchmark needs the DirectoryLevelTree")
+    return self.dtree.benchmarkSubdirectoryExpansion(path,depth)
+
+  def getMetadataStatistics(self,credDict):
+    """ Get the statistics of the metadata values
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    if not self.metaStats:
+      return S_ERROR("Metadata statistics are not enabled")
+    return self.metaStats.getStatistics()
+
+  def rebuildMetadataFacets(self,credDict):
+    """ Refresh the facet index of the metadata selector
+    """
+    res = self._checkAdminPermission(credDict)
+    if not res['OK']:
+      return res
+    if not res['Value']:
+      return S_ERROR("Permission denied")
+    return self.dmeta.rebuildMetadataFacets(credDict)
+
   #######################################################################
   #
   #  Catalog admin methods
@@ -675,6 +959,64 @@ class FileCatalogDB(DB):
     counterDict.update(res['Value'])
     return S_OK(counterDict)
 
+  ########################################################################
+  #
+  #  Generation counters shared by all the service instances
+  #
+
+  def getGeneration(self,name):
+    """ Get the current generation of the given kind of catalog data.
+        The result is read from the database at most every GenerationCheckInterval
+        seconds
+    """
+    now = time.time()
+    self.generationLock.acquire()
+    try:
+      if name in self.generations:
+        generation,checkTime = self.generations[name]
+        if now - checkTime < self.generationCheckInterval:
+          return S_OK(generation)
+    finally:
+      self.generationLock.release()
+
+    req = "SELECT Generation FROM FC_Generations WHERE Name='%s'" % name
+    result = self._query(req)
+    if not result['OK']:
+      return result
+    generation = 0
+    if result['Value']:
+      generation = result['Value'][0][0]
+
+    self.generationLock.acquire()
+    self.generations[name] = (generation,now)
+    self.generationLock.release()
+    return S_OK(generation)
+
+  def bumpGeneration(self,name):
+    """ Invalidate the cached copies of the given kind of catalog data in all
+        the service instances
+    """
+    req = "INSERT INTO FC_Generations (Name,Generation) VALUES ('%s',1) " % name
+    req += "ON DUPLICATE KEY UPDATE Generation=Generation+1"
+    result = self._update(req)
+    # The local copy is checked again at the next access in any case
+    self.generationLock.acquire()
+    self.generations.pop(name,None)
+    self.generationLock.release()
+    return result
+
+  def catalogChanged(self):
+    """ Invalidate the cached results of the catalog queries after a change of
+        the files, directories or metadata and mark the facet index as outdated.
+        Nothing to do without the query cache and the facet index
+    """
+    if not self.queryCacheEnabled and not self.metadataFacets:
+      return S_OK()
+    result = self.bumpGeneration('Catalog')
+    if not result['OK']:
+      gLogger.warn("Failed to update the Catalog generation",result['Message'])
+    return result
+
   ########################################################################
   #
   #  Security based methods
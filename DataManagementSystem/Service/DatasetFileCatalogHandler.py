@@ -18,8 +18,13 @@ from types import IntType, LongType, DictType, StringTypes, BooleanType, ListTyp
 from DIRAC.Core.DISET.RequestHandler import RequestHandler
 from DIRAC import gLogger, S_OK, S_ERROR, gConfig
 from BESDIRAC.DataManagementSystem.DB.FileCatalogDB import FileCatalogDB
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.CatalogCache import QueryResultCache
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.QueryProfiler import profileCall
 from DIRAC.Core.Utilities.List import sortList
 
+# Largest number of files returned in one page of findFilesByMetadataCursor
+MAX_PAGE_SIZE = 10000
+
 # getServiceOption
 def getServiceOption( serviceInfo, optionName, defaultValue ):
   """ Get service option resolving default values from the master service
@@ -34,11 +39,14 @@ def getServiceOption( serviceInfo, optionName, defaultValue ):
 
 # This is a global instance of the FileCatalogDB class
 gFileCatalogDB = None
+# Cache of the metadata query results
+gQueryCache = None
 
 def initializeDatasetFileCatalogHandler( serviceInfo ):
   """ handler initialisation """
 
   global gFileCatalogDB
+  global gQueryCache
 
   dbLocation = getServiceOption( serviceInfo, 'Database', 'DataManagement/FileCatalogDB' )
   gFileCatalogDB = FileCatalogDB( dbLocation )
@@ -66,13 +74,30 @@ def initializeDatasetFileCatalogHandler( serviceInfo ):
                     'LFNPFNConvention'  : True,
                     'ResolvePFN'        : True,
                     'DefaultUmask'      : 0775,
-                    'VisibleStatus'     : ['AprioriGood']}
+                    'VisibleStatus'     : ['AprioriGood'],
+                    'GenerationCheckInterval' : 10,
+                    'EffectiveMetadata' : False,
+                    'MetadataFacets'    : False,
+                    'FacetEventField'   : 'eventNum',
+                    'RunIndex'          : False,
+                    'RunLowField'       : 'runL',
+                    'RunHighField'      : 'runH',
+                    'MetadataStatistics' : False,
+                    'DeferredMetadataCleanup' : False,
+                    'TextIndexFields'   : [],
+                    'DirectoryCacheSize' : 100000,
+                    'QueryCacheSize'    : 0}
   for configKey in sortList( defaultConfig.keys() ):
     defaultValue = defaultConfig[configKey]
     configValue = getServiceOption( serviceInfo, configKey, defaultValue )
     gLogger.info( "%-20s : %-20s" % ( str( configKey ), str( configValue ) ) )
     databaseConfig[configKey] = configValue
   res = gFileCatalogDB.setConfig( databaseConfig )
+
+  # Size of the query result cache in MB, 0 to disable it
+  cacheSize = databaseConfig['QueryCacheSize']
+  if cacheSize:
+    gQueryCache = QueryResultCache( cacheSize * 1024 * 1024 )
   return res
 
 class DatasetFileCatalogHandler( RequestHandler ):
@@ -274,6 +299,13 @@ class DatasetFileCatalogHandler( RequestHandler ):
     """ Create the supplied directories """
     return gFileCatalogDB.createDirectory( lfns, self.getRemoteCredentials() )
 
+  types_makeDirectoryTree = [ ListType, DictType ]
+  def export_makeDirectoryTree( self, paths, metaDict ):
+    """ Create the directories with all their missing parents and set the
+        directory metadata of metaDict { path : { meta : value } } in one call
+    """
+    return gFileCatalogDB.makeDirectoryTree( paths, metaDict, self.getRemoteCredentials() )
+
   types_removeDirectory = [ [ ListType, DictType ] + list( StringTypes ) ]
   def export_removeDirectory( self, lfns ):
     """ Remove the supplied directories """
@@ -375,12 +407,61 @@ class DatasetFileCatalogHandler( RequestHandler ):
     """
     return gFileCatalogDB.setMetadata( path, metadatadict, self.getRemoteCredentials() )
 
+  types_setFileMetadataBulk = [ DictType ]
+  def export_setFileMetadataBulk( self, lfnMetaDict ):
+    """ Set metadata for many files at once, lfnMetaDict is { lfn : metadatadict }
+    """
+    return gFileCatalogDB.setFileMetadataBulk( lfnMetaDict, self.getRemoteCredentials() )
+
   types_removeMetadata = [ StringTypes, ListType ]
   def export_removeMetadata( self, path, metadata ):
     """ Remove the specified metadata for the given path
     """
     return gFileCatalogDB.removeMetadata( path, metadata, self.getRemoteCredentials() )
 
+  types_rebuildEffectiveMetadata = [ ]
+  def export_rebuildEffectiveMetadata( self ):
+    """ Rebuild the tables of the inherited directory metadata
+    """
+    return gFileCatalogDB.rebuildEffectiveMetadata( self.getRemoteCredentials() )
+
+  types_rebuildRunIndex = [ ]
+  def export_rebuildRunIndex( self ):
+    """ Rebuild the run range index from the run metadata
+    """
+    return gFileCatalogDB.rebuildRunIndex( self.getRemoteCredentials() )
+
+  types_rebuildTextIndex = [ ]
+  def export_rebuildTextIndex( self ):
+    """ Rebuild the trigram index of the text metadata fields
+    """
+    return gFileCatalogDB.rebuildTextIndex( self.getRemoteCredentials() )
+
+  types_refreshMetadataStatistics = [ ]
+  def export_refreshMetadataStatistics( self, metaType = '' ):
+    """ Collect the statistics of the directory ( metaType 'D' ) and/or
+        file ( metaType 'F' ) metadata values
+    """
+    return gFileCatalogDB.refreshMetadataStatistics( self.getRemoteCredentials(), metaType )
+
+  types_rebuildDirectoryClosure = [ ]
+  def export_rebuildDirectoryClosure( self ):
+    """ Fill again the ancestor/descendant table of the DirectoryClosureTree
+    """
+    return gFileCatalogDB.rebuildDirectoryClosure( self.getRemoteCredentials() )
+
+  types_sweepMetadataTombstones = [ ]
+  def export_sweepMetadataTombstones( self ):
+    """ Remove the metadata of the directories removed with a deferred cleanup
+    """
+    return gFileCatalogDB.sweepMetadataTombstones( self.getRemoteCredentials() )
+
+  types_getMetadataStatistics = [ ]
+  def export_getMetadataStatistics( self ):
+    """ Get the statistics of the metadata values used to plan the queries
+    """
+    return gFileCatalogDB.getMetadataStatistics( self.getRemoteCredentials() )
+
   types_getDirectoryMetadata = [ StringTypes ]
   def export_getDirectoryMetadata( self, path ):
     """ Get all the metadata valid for the given directory path
@@ -401,9 +482,81 @@ class DatasetFileCatalogHandler( RequestHandler ):
 
   types_findFilesByMetadata = [ DictType, StringTypes ]
   def export_findFilesByMetadata( self, metaDict, path = '/' ):
-    """ Find all the files satisfying the given metadata set
+    """ Find all the files satisfying the given metadata set. With the query cache
+        the result can miss the changes made through another service instance
+        during the last GenerationCheckInterval seconds
     """
-    return gFileCatalogDB.fmeta.findFilesByMetadata( metaDict, path, self.getRemoteCredentials() )
+    if not gQueryCache:
+      return gFileCatalogDB.fmeta.findFilesByMetadata( metaDict, path, self.getRemoteCredentials() )
+
+    result = gFileCatalogDB.getGeneration( 'Catalog' )
+    if not result['OK']:
+      return result
+    generation = result['Value']
+    key = gQueryCache.getKey( metaDict, path )
+    lfns = gQueryCache.get( key, generation )
+    if lfns is not None:
+      return S_OK( lfns )
+
+    result = gFileCatalogDB.fmeta.findFilesByMetadata( metaDict, path, self.getRemoteCredentials() )
+    if result['OK']:
+      gQueryCache.put( key, generation, result['Value'] )
+    return result
+
+  types_profileFindFilesByMetadata = [ DictType, StringTypes ]
+  def export_profileFindFilesByMetadata( self, metaDict, path = '/' ):
+    """ Find the files satisfying the given metadata set bypassing the query cache.
+        Returns the per stage profile of the search and the number of files found
+    """
+    result = profileCall( gFileCatalogDB.fmeta.findFilesByMetadata, metaDict, path, self.getRemoteCredentials() )
+    return self.__summarizeProfiledSearch( result )
+
+  types_profileFindDirectoriesByMetadata = [ DictType, StringTypes ]
+  def export_profileFindDirectoriesByMetadata( self, metaDict, path = '/' ):
+    """ Find the directories satisfying the given metadata set. Returns the per
+        stage profile of the search and the number of directories found
+    """
+    result = profileCall( gFileCatalogDB.dmeta.findDirectoriesByMetadata, metaDict, path,
+                          self.getRemoteCredentials() )
+    return self.__summarizeProfiledSearch( result )
+
+  def __summarizeProfiledSearch( self, result ):
+    """ Replace the result of the profiled search by the number of items found
+    """
+    searchResult = result['Value']['Result']
+    summary = { 'OK' : searchResult['OK'] }
+    if searchResult['OK']:
+      value = searchResult['Value']
+      found = len( value )
+      if type( value ) == DictType and value and type( value.values()[0] ) == ListType:
+        # Files grouped by directory
+        found = sum( [ len( fileList ) for fileList in value.values() ] )
+      summary['Found'] = found
+    else:
+      summary['Message'] = searchResult['Message']
+    result['Value']['Result'] = summary
+    return result
+
+  types_getQueryCacheStats = [ ]
+  def export_getQueryCacheStats( self ):
+    """ Get the hit/miss statistics of the metadata query result cache
+    """
+    if not gQueryCache:
+      return S_ERROR( 'Query result cache is disabled' )
+    return S_OK( gQueryCache.getStatistics() )
+
+  types_getDirectoryCacheStats = [ ]
+  def export_getDirectoryCacheStats( self ):
+    """ Get the hit/miss statistics of the directory path and DirID caches
+    """
+    return gFileCatalogDB.dtree.getDirectoryCacheStatistics()
+
+  types_benchmarkSubdirectoryExpansion = [ StringTypes, IntType ]
+  def export_benchmarkSubdirectoryExpansion( self, path, depth ):
+    """ Compare the level by level and the enumerated path subtree expansion
+        of the directories depth levels below path
+    """
+    return gFileCatalogDB.benchmarkSubdirectoryExpansion( path, depth, self.getRemoteCredentials() )
 
   types_findFilesByMetadataDetailed = [ DictType, StringTypes ]
   def export_findFilesByMetadataDetailed( self, metaDict, path = '/' ):
@@ -443,6 +596,29 @@ class DatasetFileCatalogHandler( RequestHandler ):
     return result
 
 
+  types_findFilesByMetadataCursor = [ DictType, StringTypes, StringTypes, [IntType, LongType] ]
+  def export_findFilesByMetadataCursor( self, metaDict, path, cursor, pageSize ):
+    """ Get a page of files satisfying the given metadata set. The first page is
+        obtained with an empty cursor, the following ones with the cursor returned
+        with the previous page. The pages hold at most MAX_PAGE_SIZE files
+    """
+    result = gFileCatalogDB.fmeta.findFilesByMetadataPage( metaDict, path, self.getRemoteCredentials(),
+                                                          cursor, min( pageSize, MAX_PAGE_SIZE ) )
+    if not result['OK']:
+      return result
+    pageDict = result['Value']
+
+    records = {}
+    if pageDict['LFNs']:
+      resultDetails = gFileCatalogDB.getFileDetails( pageDict['LFNs'], self.getRemoteCredentials() )
+      if not resultDetails['OK']:
+        return resultDetails
+      records = resultDetails['Value']
+
+    return S_OK( { "TotalRecords" : pageDict['TotalRecords'],
+                   "Records"      : records,
+                   "Cursor"       : pageDict['Cursor'] } )
+
   def findFilesByMetadataWeb( self, metaDict, path, startItem, maxItems ):
     """ Find all the files satisfying the given metadata set
     """
@@ -477,6 +653,12 @@ class DatasetFileCatalogHandler( RequestHandler ):
     """
     return gFileCatalogDB.dmeta.getCompatibleMetadata( metaDict, path, self.getRemoteCredentials() )
 
+  types_rebuildMetadataFacets = [ ]
+  def export_rebuildMetadataFacets( self ):
+    """ Refresh the facet index used by getCompatibleMetadata
+    """
+    return gFileCatalogDB.rebuildMetadataFacets( self.getRemoteCredentials() )
+
   types_addMetadataSet = [ StringTypes, DictType ]
   def export_addMetadataSet( self, setName, setDict ):
     """ Add a new metadata set
@@ -494,3 +676,22 @@ class DatasetFileCatalogHandler( RequestHandler ):
     """ Get the list of metadata sets with their definitions
     """
     return gFileCatalogDB.dmeta.listMetadataSets(self.getRemoteCredentials())
+
+  types_createDatasetSnapshot = [ StringTypes, BooleanType ]
+  def export_createDatasetSnapshot( self, setName, refresh = False ):
+    """ Freeze the current file list of the metadata set, or add the files
+        registered since the last snapshot if refresh is True
+    """
+    return gFileCatalogDB.createDatasetSnapshot( setName, self.getRemoteCredentials(), refresh )
+
+  types_getDatasetSnapshot = [ StringTypes, BooleanType ]
+  def export_getDatasetSnapshot( self, setName, withFiles = True ):
+    """ Get the snapshot summary of the metadata set with its frozen file list
+    """
+    return gFileCatalogDB.snapshots.getSnapshot( setName, withFiles )
+
+  types_removeDatasetSnapshot = [ StringTypes ]
+  def export_removeDatasetSnapshot( self, setName ):
+    """ Drop the snapshot of the metadata set
+    """
+    return gFileCatalogDB.removeDatasetSnapshot( setName, self.getRemoteCredentials() )
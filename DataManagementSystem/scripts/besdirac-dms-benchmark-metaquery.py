@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.registerSwitch( "", "sizes=", "Comma separated list of ID list sizes (default 1000,10000,100000)" )
+Script.registerSwitch( "", "fields=", "Number of metadata fields in the query (default 3)" )
+Script.registerSwitch( "", "legacy-limit=", "Skip the list scan above this size (default 20000)" )
+Script.setUsageMessage("""
+Benchmark the combination of per-field metadata query results
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+from BESDIRAC.DataManagementSystem.DB.FileCatalogComponents.IDSet import intersectIDs
+
+sizes = [1000, 10000, 100000]
+nFields = 3
+legacyLimit = 20000
+for switch, value in Script.getUnprocessedSwitches():
+  if switch == "sizes":
+    sizes = [ int( s ) for s in value.split( ',' ) ]
+  elif switch == "fields":
+    nFields = int( value )
+  elif switch == "legacy-limit":
+    legacyLimit = int( value )
+
+def listIntersection( idLists ):
+  """ The nested list scan previously used by the metadata queries
+  """
+  result = []
+  first = True
+  for mList in idLists:
+    if first:
+      result = mList
+      first = False
+    else:
+      newList = []
+      for d in result:
+        if d in mList:
+          newList.append( d )
+      result = newList
+  return result
+
+def timeIt( method, idLists ):
+  start = time.time()
+  result = method( idLists )
+  return time.time() - start, len( result )
+
+print "%10s %10s %12s %12s" % ( 'Size', 'Selected', 'List scan', 'ID set' )
+for size in sizes:
+  universe = range( 1, size * 4 )
+  idLists = [ random.sample( universe, size ) for _i in range( nFields ) ]
+  setTime, nSet = timeIt( intersectIDs, idLists )
+  listTime = '-'
+  if size <= legacyLimit:
+    listTime, nList = timeIt( listIntersection, idLists )
+    if nList != nSet:
+      gLogger.error( 'Result mismatch for size %d: %d != %d' % ( size, nList, nSet ) )
+      DIRAC.exit( -1 )
+    listTime = '%.4f' % listTime
+  print "%10d %10d %12s %12.4f" % ( size, nSet, listTime, setTime )
+
+DIRAC.exit( 0 )
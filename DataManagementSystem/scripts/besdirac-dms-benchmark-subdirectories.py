@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.registerSwitch( "d:", "depth=", "Expand the subtrees of the directories this many levels below the path (default 1)" )
+Script.registerSwitch( "c:", "create=", "First create a synthetic tree of about this many directories under the path" )
+Script.setUsageMessage("""
+Benchmark the level by level and the enumerated path expansion of directory subtrees
+
+Usage:
+   %s [option] path
+
+Example:
+   %s --create=100000 /bes/benchmark
+""" % ( Script.scriptName, Script.scriptName ) )
+
+Script.parseCommandLine( ignoreErrors = True )
+args = Script.getPositionalArgs()
+if len( args ) != 1:
+  Script.showHelp()
+  DIRAC.exit( -1 )
+path = args[0].rstrip( '/' )
+
+depth = 1
+nCreate = 0
+for switch, value in Script.getUnprocessedSwitches():
+  if switch in ( "d", "depth" ):
+    depth = int( value )
+  elif switch in ( "c", "create" ):
+    nCreate = int( value )
+
+# Shape of the BESIII trees: energy point / production round / stream / run
+ENERGIES = [ 'jpsi', 'psip', 'psipp', '4180', '4230' ]
+ROUNDS = [ 'round01', 'round02', 'round03', 'round04' ]
+STREAMS = [ 'stream%03d' % i for i in range( 5 ) ]
+CREATE_CHUNK_SIZE = 1000
+
+def syntheticPaths( nDirs ):
+  """ Get the leaf directories of a tree of about nDirs directories
+  """
+  nStreams = len( ENERGIES ) * len( ROUNDS ) * len( STREAMS )
+  nRuns = max( 1, ( nDirs - nStreams - len( ENERGIES ) * ( 1 + len( ROUNDS ) ) ) / nStreams )
+  paths = []
+  run = 25000
+  for energy in ENERGIES:
+    for roundName in ROUNDS:
+      for stream in STREAMS:
+        for _i in range( nRuns ):
+          run += 1
+          paths.append( '%s/%s/%s/%s/run_%07d' % ( path, energy, roundName, stream, run ) )
+  return paths
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+
+if nCreate:
+  paths = syntheticPaths( nCreate )
+  for i in range( 0, len( paths ), CREATE_CHUNK_SIZE ):
+    result = rpc.createDirectory( paths[i:i + CREATE_CHUNK_SIZE] )
+    if not result['OK']:
+      gLogger.error( result['Message'] )
+      DIRAC.exit( -1 )
+    if result['Value']['Failed']:
+      gLogger.error( 'Failed to create %d directories' % len( result['Value']['Failed'] ) )
+      DIRAC.exit( -1 )
+  gLogger.notice( 'Created %d run directories under %s' % ( len( paths ), path ) )
+
+result = rpc.benchmarkSubdirectoryExpansion( path, depth )
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+resultDict = result['Value']
+
+print "%d roots, %d subdirectories, results %s" % ( resultDict['Roots'], resultDict['Subdirectories'],
+                                                    resultDict['Match'] and 'match' or 'DIFFER' )
+print "%16s %12s %10s" % ( 'Method', 'Round trips', 'Time' )
+for method in [ 'LevelByLevel', 'EnumeratedPaths' ]:
+  print "%16s %12d %10.4f" % ( method, resultDict[method]['RoundTrips'], resultDict[method]['Time'] )
+
+DIRAC.exit( 0 )
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.registerSwitch( "p:", "path=", "Directory to search in (default /)" )
+Script.registerSwitch( "r:", "repeat=", "Number of runs of each query, the best time is kept (default 3)" )
+Script.setUsageMessage("""
+Benchmark range queries on typed file metadata fields and show their execution plans
+
+Usage:
+   %s [option] field=low:high [field=low:high ...]
+
+Example:
+   %s eventNum=1000:50000 runL=25000:26000 date=2014-01-01:2014-02-01
+""" % ( Script.scriptName, Script.scriptName ) )
+
+Script.parseCommandLine( ignoreErrors = True )
+args = Script.getPositionalArgs()
+if not args:
+  Script.showHelp()
+  DIRAC.exit( -1 )
+
+path = '/'
+repeat = 3
+for switch, value in Script.getUnprocessedSwitches():
+  if switch in ( "p", "path" ):
+    path = value
+  elif switch in ( "r", "repeat" ):
+    repeat = int( value )
+
+# The bounds are passed as strings, the service binds them to the field types
+queries = []
+for arg in args:
+  try:
+    meta, bounds = arg.split( '=', 1 )
+    low, high = bounds.split( ':', 1 )
+  except ValueError:
+    gLogger.error( 'Bad range %s, expected field=low:high' % arg )
+    DIRAC.exit( -1 )
+  queries.append( ( meta, { '>=' : low, '<=' : high } ) )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+
+result = rpc.getMetadataFields()
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+fileTypes = result['Value']['FileMetaFields']
+
+for meta, value in queries:
+  if not meta in fileTypes:
+    gLogger.error( '%s is not a file metadata field' % meta )
+    continue
+  bestTime = None
+  for _i in range( repeat ):
+    result = rpc.profileFindFilesByMetadata( { meta : value }, path )
+    if not result['OK']:
+      gLogger.error( result['Message'] )
+      DIRAC.exit( -1 )
+    if not result['Value']['Result']['OK']:
+      gLogger.error( '%s: %s' % ( meta, result['Value']['Result']['Message'] ) )
+      break
+    profile = result['Value']['Profile']
+    if bestTime is None or profile['TotalTime'] < bestTime:
+      bestTime = profile['TotalTime']
+  else:
+    print "%s %s [%s:%s]: %d files, best of %d runs %.4f s" % ( meta, fileTypes[meta], value['>='], value['<='],
+                                                               result['Value']['Result']['Found'], repeat, bestTime )
+    for explain in profile['Explain']:
+      for row in explain['Plan']:
+        print "   ", ' | '.join( [ str( x ) for x in row ] )
+
+DIRAC.exit( 0 )
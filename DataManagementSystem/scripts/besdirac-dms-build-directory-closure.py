@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.setUsageMessage("""
+Fill again the ancestor/descendant table of the DirectoryClosureTree from FC_DirectoryLevelTree
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+result = rpc.rebuildDirectoryClosure()
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+gLogger.notice( 'Added %d directory closure rows' % result['Value'] )
+
+DIRAC.exit( 0 )
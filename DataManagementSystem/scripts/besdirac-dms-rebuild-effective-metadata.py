@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.setUsageMessage("""
+Rebuild the effective (inherited) directory metadata tables of the catalog
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+result = rpc.rebuildEffectiveMetadata()
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+for meta in sorted( result['Value']['Successful'] ):
+  gLogger.notice( 'Rebuilt %s' % meta )
+for meta, error in result['Value']['Failed'].items():
+  gLogger.error( 'Failed to rebuild %s: %s' % ( meta, error ) )
+
+DIRAC.exit( 0 )
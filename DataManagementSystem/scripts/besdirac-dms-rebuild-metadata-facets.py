@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.setUsageMessage("""
+Refresh the metadata facet index used by the metadata selector
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+result = rpc.rebuildMetadataFacets()
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+gLogger.notice( 'Metadata facet index rebuilt' )
+DIRAC.exit( 0 )
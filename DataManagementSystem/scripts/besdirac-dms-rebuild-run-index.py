@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.setUsageMessage("""
+Rebuild the run range index of the catalog from the run metadata
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+result = rpc.rebuildRunIndex()
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+gLogger.notice( 'Indexed %d run ranges' % result['Value'] )
+
+DIRAC.exit( 0 )
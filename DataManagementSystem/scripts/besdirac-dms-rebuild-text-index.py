@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.setUsageMessage("""
+Rebuild the trigram index of the text metadata fields listed in TextIndexFields
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+result = rpc.rebuildTextIndex()
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+for meta, nValues in sorted( result['Value']['Successful'].items() ):
+  gLogger.notice( '%s: indexed %d values' % ( meta, nValues ) )
+for meta, error in result['Value']['Failed'].items():
+  gLogger.error( 'Failed to index %s: %s' % ( meta, error ) )
+
+DIRAC.exit( 0 )
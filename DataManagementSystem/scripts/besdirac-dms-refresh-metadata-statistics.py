@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.registerSwitch( "t:", "type=", "Only directory (D) or file (F) metadata" )
+Script.registerSwitch( "s", "show", "Show the current statistics instead of refreshing them" )
+Script.setUsageMessage("""
+Refresh the statistics of the metadata values used to plan the catalog queries
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+metaType = ''
+show = False
+for switch, value in Script.getUnprocessedSwitches():
+  if switch in ( "t", "type" ):
+    metaType = value.upper()
+  elif switch in ( "s", "show" ):
+    show = True
+
+if not metaType in [ '', 'D', 'F' ]:
+  Script.showHelp()
+  DIRAC.exit( -1 )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+
+if show:
+  result = rpc.getMetadataStatistics()
+  if not result['OK']:
+    gLogger.error( result['Message'] )
+    DIRAC.exit( -1 )
+  print "%4s %-20s %12s %12s  %s" % ( 'Type', 'Field', 'Rows', 'Distinct', 'Updated' )
+  for mType in sorted( result['Value'] ):
+    if metaType and mType != metaType:
+      continue
+    for meta, statDict in sorted( result['Value'][mType].items() ):
+      print "%4s %-20s %12d %12d  %s" % ( mType, meta, statDict['NRows'], statDict['NDistinct'],
+                                          statDict['LastUpdate'] )
+  DIRAC.exit( 0 )
+
+result = rpc.refreshMetadataStatistics( metaType )
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+for meta, nRows in sorted( result['Value']['Successful'].items() ):
+  gLogger.notice( '%s: %d rows' % ( meta, nRows ) )
+for meta, error in result['Value']['Failed'].items():
+  gLogger.error( 'Failed to refresh %s: %s' % ( meta, error ) )
+
+DIRAC.exit( 0 )
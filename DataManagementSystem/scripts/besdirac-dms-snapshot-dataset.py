@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.registerSwitch( "r", "refresh", "Only add the files registered since the last snapshot" )
+Script.registerSwitch( "d", "delete", "Remove the snapshot of the dataset" )
+Script.setUsageMessage("""
+Freeze the current file list of a dataset
+
+Usage:
+   %s [option] datasetName
+""" % Script.scriptName )
+
+Script.parseCommandLine( ignoreErrors = True )
+args = Script.getPositionalArgs()
+if len( args ) != 1:
+  Script.showHelp()
+  DIRAC.exit( -1 )
+datasetName = args[0]
+
+refresh = False
+delete = False
+for switch, value in Script.getUnprocessedSwitches():
+  if switch in ( "r", "refresh" ):
+    refresh = True
+  elif switch in ( "d", "delete" ):
+    delete = True
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+if delete:
+  result = rpc.removeDatasetSnapshot( datasetName )
+else:
+  result = rpc.createDatasetSnapshot( datasetName, refresh )
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+if not delete:
+  snapshot = result['Value']
+  gLogger.notice( '%s: %d files (%d new), %d bytes, %d events' % ( datasetName, snapshot['NFiles'],
+                                                                    snapshot['NewFiles'], snapshot['TotalSize'],
+                                                                    snapshot['EventSum'] ) )
+
+DIRAC.exit( 0 )
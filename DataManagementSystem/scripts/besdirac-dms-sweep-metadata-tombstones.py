@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import DIRAC
+from DIRAC import gLogger
+from DIRAC.Core.Base import Script
+
+Script.setUsageMessage("""
+Remove the metadata of the directories removed with DeferredMetadataCleanup
+""")
+
+Script.parseCommandLine( ignoreErrors = True )
+
+from DIRAC.Core.DISET.RPCClient import RPCClient
+
+rpc = RPCClient( "DataManagement/DatasetFileCatalog", timeout = 3600 )
+result = rpc.sweepMetadataTombstones()
+if not result['OK']:
+  gLogger.error( result['Message'] )
+  DIRAC.exit( -1 )
+
+gLogger.notice( 'Cleaned the metadata of %d removed directories' % result['Value'] )
+
+DIRAC.exit( 0 )